@@ -1,18 +1,52 @@
+import json
 import os
 import signal
 import sys
-from flask import Flask, render_template, request, jsonify, send_file
+import time
+from flask import Flask, Response, g, render_template, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
+from autoscaler import Autoscaler, make_policy
 from aws_utils import check_spot_quotas, cleanup_spot_requests
-from ec2_spot import create_instance, terminate_instance
-from state_manager import StateManager
+from bidding import price_history
+from boot_tracker import BootTracker
+from cost_watcher import CostWatcher
+from deployer import RollingDeployer
+from drainer import VICTIM_POLICIES, Drainer
+from ec2_spot import create_instances, terminate_instance
+from instance_stats import StatsFetcher
+from jobs import JOB_FAILED, JOB_FULFILLED, JobQueue
+from load_balancer import HOP_BY_HOP_HEADERS, LoadBalancer, NoHealthyBackend, UpstreamError
+from metrics_collector import MetricsCollector
+from placement import DEFAULT_RESOURCES, PlacementEngine
+from pool_selector import default_launch_spec, pool_selector
+from reconciler import Reconciler
+from regions import enabled_regions, home_region, region_of
+from state_manager import shared_state_manager
+import telemetry
 from logging_config import logger
-import requests
+from tracing import summarize
+from warm_pool import WarmPool
 
 app = Flask(__name__)
 CORS(app)
 
-state_manager = StateManager()
+state_manager = shared_state_manager(price_source=price_history.latest)
+job_queue = JobQueue()
+stats_fetcher = StatsFetcher()
+metrics_collector = MetricsCollector(state_manager, stats_fetcher)
+metrics_collector.start()
+boot_tracker = BootTracker(state_manager)
+boot_tracker.start()
+warm_pool = WarmPool(state_manager)
+warm_pool.start()
+load_balancer = LoadBalancer(state_manager)
+load_balancer.start()
+deployer = RollingDeployer(state_manager)
+placement = PlacementEngine(state_manager)
+placement.start()
+drainer = Drainer(state_manager, load_balancer, placement, stats_fetcher)
+cost_watcher = CostWatcher(state_manager, price_history)
+cost_watcher.start()
 
 def signal_handler(sig, frame):
     logger.info("\nCleaning up spot requests before exiting...")
@@ -22,6 +56,98 @@ def signal_handler(sig, frame):
 
 signal.signal(signal.SIGINT, signal_handler)
 
+def submit_scale_up(app_name, count, reason='scale_up'):
+    app = state_manager.get_app(app_name)
+    instance_names = state_manager.reserve_instance_names(app_name, count)
+    env_vars = state_manager.get_env_vars(app_name)
+    ecr_image_uri = app['ecr_image_uri']
+    launch_spec = state_manager.get_launch_spec(app_name)
+
+    def provision(progress):
+        if app.get('placement') == 'packed':
+            # containers share hosts; placement launches a host only when none has room
+            instances = placement.place(app_name, instance_names, env_vars, on_progress=progress)
+            if instances:
+                progress(JOB_FULFILLED, instance_ids=[instance['id'] for instance in instances], packed=True)
+        else:
+            # standby instances from the warm pool go first, whatever is left is launched cold
+            instances = warm_pool.assign(app_name, instance_names, env_vars)
+            if instances:
+                progress(JOB_FULFILLED, instance_ids=[instance['id'] for instance in instances], warm=True)
+            if len(instances) < count:
+                instances += create_instances(ecr_image_uri, instance_names[len(instances):], env_vars, on_progress=progress,
+                                              app_name=app_name, launch_spec=launch_spec)
+        return record_provisioned(app_name, count, reason, instances, progress)
+
+    job = job_queue.submit(app_name, provision, count=count, reason=reason)
+    return {**job, 'instance_names': instance_names}
+
+def record_provisioned(app_name, count, reason, instances, progress):
+    # only record the instances once they are live
+    if instances:
+        state_manager.add_instances(app_name, instances)
+    if len(instances) < count and reason == 'scale_up':
+        # a user scale-up that fell short shouldn't leave the reconciler chasing the difference
+        state_manager.adjust_target_replicas(app_name, len(instances) - count)
+    if not instances:
+        raise RuntimeError("Failed to create instance. Please check logs for more details.")
+    if len(instances) < count:
+        progress(JOB_FAILED, error=f"Only {len(instances)} of {count} instances were created")
+    return instances
+
+reconciler = Reconciler(state_manager, job_queue, lambda app_name, count: submit_scale_up(app_name, count, 'replacement'),
+                        stats_fetcher=stats_fetcher)
+reconciler.start()
+
+def retire_instance(instance):
+    # packed replicas only stop their containers; the host stays up for its other tenants
+    if instance.get('host_id'):
+        placement.stop_replica(instance)
+    else:
+        terminate_instance(instance['id'], region_of(instance))
+    stats_fetcher.forget(instance['id'])
+
+def scale_down_instances(app_name, count, policy=None, grace=None):
+    # victims stop getting new traffic at once, then go in one batch once their requests finish
+    victims = drainer.claim(app_name, count, policy)
+    if not victims:
+        return None
+    # count=0: nothing is being brought up, so the reconciler shouldn't wait on it
+    job = job_queue.submit(app_name, lambda progress: drainer.retire(app_name, victims, grace, progress),
+                           count=0, reason='scale_down')
+    return {**job, 'instance_ids': [instance['id'] for instance in victims]}
+
+def autoscale_up(app_name, count):
+    state_manager.adjust_target_replicas(app_name, count)
+    return submit_scale_up(app_name, count, 'autoscale')
+
+autoscaler = Autoscaler(state_manager, metrics_collector.store, autoscale_up, scale_down_instances)
+autoscaler.start()
+
+# gauges derived from state are read when /metrics is scraped, never on the write path
+telemetry.instances.set_function(lambda: {(name,): len(a['instances']) for name, a in state_manager.get_apps().items()})
+telemetry.running_cost.set_function(lambda: {(name,): state_manager.get_cost_rate(name) for name in state_manager.get_apps()})
+telemetry.spend.set_function(lambda: {(name,): state_manager.get_spend(name) for name in state_manager.get_apps()})
+telemetry.total_cost.set_function(lambda: {(): state_manager.get_total_cost()})
+
+def state_size():
+    with state_manager.lock:
+        return {(state_manager.backend.name,): state_manager.backend.size()}
+
+telemetry.state_size_bytes.set_function(state_size)
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    # label by route template so instance ids and app names don't each become a series
+    if 'started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        telemetry.http_request_seconds.labels(request.method, route, response.status_code).observe(time.perf_counter() - g.started)
+    return response
+
 @app.route('/')
 def index():
     if os.getenv('ENVIRONMENT', 'DEVELOPMENT') == 'PRODUCTION':
@@ -31,10 +157,54 @@ def index():
 
 @app.route('/get_state')
 def api():
-    return jsonify(
+    state_manager.refresh()
+    etag = state_manager.get_etag()
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': f'"{etag}"'}
+    response = jsonify(
         apps=state_manager.get_apps(),
         total_cost=state_manager.get_total_cost()
     )
+    response.set_etag(etag)
+    return response
+
+def format_sse(event_type, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id else []
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {json.dumps(data)}")
+    return '\n'.join(lines) + '\n\n'
+
+@app.route('/events')
+def events():
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('since')
+    version = state_manager.parse_version(last_event_id)
+
+    def stream():
+        nonlocal version
+        while True:
+            if version is None:
+                snapshot = state_manager.snapshot()
+                version = state_manager.parse_version(snapshot['version'])
+                yield format_sse('reset', snapshot, snapshot['version'])
+                continue
+            state_manager.refresh()
+            pending = state_manager.events_since(version, timeout=15)
+            if pending is None:
+                version = None
+                continue
+            if not pending:
+                yield ': keep-alive\n\n'
+                continue
+            for event in pending:
+                if event['type'] == 'reset':
+                    version = None
+                    break
+                version = event['version']
+                yield format_sse(event['type'], {**event['data'], 'app_name': event['app_name']},
+                                 f"{state_manager.epoch}-{version}")
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/add_app', methods=['POST'])
 def add_app():
@@ -59,21 +229,79 @@ def scale_up(app_name):
     app = state_manager.get_app(app_name)
     if not app:
         return jsonify(error="App not found"), 404
-    
-    usage, quota = check_spot_quotas()
-    if quota != "Unknown" and usage >= quota:
-        cleanup_spot_requests()  # clean up any lingering requests
-        return jsonify(error="Spot Instance quota reached. Please try again later or request a quota increase."), 429
-    
-    instance_counter = state_manager.get_instance_counter(app_name)
-    instance_name = f"{app_name}-{instance_counter + 1}"
-    env_vars = state_manager.get_env_vars(app_name)
-    instance_dict = create_instance(app['ecr_image_uri'], instance_name, env_vars)
-    if instance_dict and instance_dict['id']:
-        state_manager.add_instance(app_name, instance_dict)
-        return jsonify(success=True, instance=instance_dict)
-    else:
-        return jsonify(success=False, error="Failed to create instance. Please check logs for more details."), 500
+
+    count = request.args.get('count', 1, type=int)
+    rejection = check_scale_up(count, state_manager.get_launch_spec(app_name).get('regions'))
+    if rejection:
+        return jsonify(error=rejection[0]), rejection[1]
+
+    state_manager.adjust_target_replicas(app_name, count)
+    job = submit_scale_up(app_name, count)
+    return jsonify(success=True, job_id=job['id'], status=job['status'], instance_names=job['instance_names']), 202
+
+def check_scale_up(count, regions=None):
+    # returns (error, status) when a scale-up request has to be turned away; with several
+    # regions allowed, only when every one of them is at its quota
+    max_count = int(os.getenv('SPOTTY_MAX_SCALE_UP_COUNT', 20))
+    if count < 1 or count > max_count:
+        return f"count must be between 1 and {max_count}", 400
+    for region in regions or [None]:
+        usage, quota = check_spot_quotas(region)
+        if quota == "Unknown" or usage < quota:
+            return None
+    cleanup_spot_requests()  # clean up any lingering requests
+    return "Spot Instance quota reached. Please try again later or request a quota increase.", 429
+
+@app.route('/scale_down/<app_name>')
+def scale_down(app_name):
+    app = state_manager.get_app(app_name)
+    if not app:
+        return jsonify(error="App not found"), 404
+
+    # count=all scales the app to zero
+    count = request.args.get('count', '1')
+    count = len(app['instances']) if count == 'all' else int(count) if count.isdigit() else 0
+    if count < 1 and request.args.get('count') != 'all':
+        return jsonify(error="count must be a positive number or 'all'"), 400
+    policy = request.args.get('policy')
+    if policy and policy not in VICTIM_POLICIES:
+        return jsonify(error=f"policy must be one of {', '.join(VICTIM_POLICIES)}"), 400
+    grace = request.args.get('grace', type=float)
+
+    job = scale_down_instances(app_name, count, policy, grace)
+    if request.args.get('count') == 'all':
+        # not just less the instances running now: launches still under way would bring it back up
+        state_manager.set_target_replicas(app_name, 0)
+    if not job:
+        return jsonify(error="No instances to scale down"), 409
+    return jsonify(success=True, job_id=job['id'], status=job['status'], instance_ids=job['instance_ids']), 202
+
+@app.route('/deploy/<app_name>', methods=['POST'])
+def deploy(app_name):
+    if not state_manager.get_app(app_name):
+        return jsonify(error="App not found"), 404
+    body = request.get_json(silent=True) or request.form
+    ecr_uri = body.get('ecr_uri')
+    if not ecr_uri:
+        return jsonify(error="ecr_uri is required"), 400
+    if any(job['reason'] == 'deploy' and not job['done'] for job in job_queue.list(app_name)):
+        return jsonify(error="A deploy is already running for this app"), 409
+    batch_size = int(body.get('batch_size') or 0) or None
+    # count=0: a deploy doesn't add instances, so the reconciler shouldn't wait on it
+    job = job_queue.submit(app_name, lambda progress: deployer.deploy(app_name, ecr_uri, progress, batch_size),
+                           count=0, reason='deploy')
+    return jsonify(success=True, job_id=job['id'], status=job['status']), 202
+
+@app.route('/jobs')
+def list_jobs():
+    return jsonify(jobs=job_queue.list(request.args.get('app_name')))
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify(error="Job not found"), 404
+    return jsonify(job)
 
 @app.route('/cleanup')
 def cleanup():
@@ -82,27 +310,180 @@ def cleanup():
 
 @app.route('/delete_instance/<app_name>/<instance_id>')
 def delete_instance(app_name, instance_id):
-    if state_manager.remove_instance(app_name, instance_id):
-        terminate_instance(instance_id)
-        return jsonify(success=True, terminated_instance_id=instance_id)
-    else:
+    _, instance = state_manager.find_instance(instance_id)
+    if not instance:
         return jsonify(error="Instance not found"), 404
+    # lower the target before the instance goes, as Drainer.claim does, so the reconciler never
+    # sees the gap and launches a replacement
+    state_manager.adjust_target_replicas(app_name, -1)
+    if not state_manager.remove_instance(app_name, instance_id):
+        state_manager.adjust_target_replicas(app_name, 1)
+        return jsonify(error="Instance not found"), 404
+    retire_instance(instance)
+    return jsonify(success=True, terminated_instance_id=instance_id)
 
 @app.route('/instances/<app_name>')
 def get_instances(app_name):
     return jsonify(instances=state_manager.get_instances(app_name))
 
+@app.route('/instance_stats')
+def all_instance_stats():
+    return jsonify(stats=stats_fetcher.fetch_many(state_manager.get_all_instances()))
+
 @app.route('/instance_stats/<instance_id>')
 def instance_stats(instance_id):
-    for app in state_manager.get_apps().values():
-        instance = next((inst for inst in app['instances'] if inst['id'] == instance_id), None)
-        if instance:
-            try:
-                response = requests.get(f"http://{instance['ip']}:3928/stats", timeout=5)
-                return jsonify(response.json())
-            except requests.RequestException as e:
-                return jsonify({"error": str(e)}), 500
-    return jsonify({"error": "Instance not found"}), 404
+    _, instance = state_manager.find_instance(instance_id)
+    if not instance:
+        return jsonify({"error": "Instance not found"}), 404
+    stats = stats_fetcher.fetch(instance)
+    if 'error' in stats:
+        return jsonify(stats), 500
+    return jsonify(stats)
+
+@app.route('/metrics/<instance_id>')
+def instance_metrics(instance_id):
+    since = request.args.get('since', time.time() - 3600, type=float)
+    step = request.args.get('step', 0, type=float)
+    metrics = request.args.getlist('metric')
+    series = metrics_collector.store.query(instance_id, since, step, metrics)
+    if series is None:
+        return jsonify(error="No metrics for instance"), 404
+    return jsonify(instance_id=instance_id, since=since, step=step, series=series)
+
+@app.route('/metrics')
+def control_plane_metrics():
+    return Response(telemetry.registry.render(), content_type=telemetry.CONTENT_TYPE)
+
+@app.route('/costs')
+@app.route('/costs/<app_name>')
+def costs(app_name=None):
+    # spend so far, the current $/hour and the spend over the last `days`, from the cost ledger
+    if app_name and not state_manager.get_app(app_name):
+        return jsonify(error="App not found"), 404
+    days = request.args.get('days', 7, type=float)
+    until = time.time()
+    since = until - days * 86400
+
+    if app_name:
+        result = state_manager.get_cost_summary(app_name, since, until)
+        if request.args.get('hourly'):
+            result['hourly'] = [{'hour': hour, 'cost': cost}
+                                for hour, cost in state_manager.get_hourly_costs(app_name, since, until)]
+        return jsonify(app_name=app_name, since=since, until=until, **result)
+    return jsonify(since=since, until=until, total=state_manager.get_cost_summary(None, since, until),
+                   apps={name: state_manager.get_cost_summary(name, since, until) for name in state_manager.get_apps()})
+
+@app.route('/provisioning_stats')
+def provisioning_stats():
+    app_name = request.args.get('app_name')
+    boot_mode = request.args.get('boot_mode')
+    traces = [
+        instance['trace']
+        for name, app in state_manager.get_apps().items() if not app_name or name == app_name
+        for instance in app['instances']
+        if 'trace' in instance and (not boot_mode or instance.get('boot_mode') == boot_mode)
+    ]
+    return jsonify(instances=len(traces), phases=summarize(traces))
+
+@app.route('/launch_spec/<app_name>', methods=['GET', 'POST'])
+def launch_spec(app_name):
+    try:
+        if request.method == 'POST':
+            spec = request.json or {}
+            regions = list(spec.get('regions') or [])
+            unknown = [region for region in regions if region not in enabled_regions()]
+            if unknown:
+                return jsonify(error=f"Regions not enabled: {', '.join(unknown)}"), 400
+            state_manager.set_launch_spec(app_name, list(spec.get('instance_types') or []), list(spec.get('subnet_ids') or []),
+                                          regions)
+        return jsonify(launch_spec=state_manager.get_launch_spec(app_name),
+                       defaults={**default_launch_spec(), 'regions': [home_region()]}, enabled_regions=enabled_regions())
+    except ValueError as e:
+        return jsonify(error=str(e)), 404
+
+@app.route('/regions')
+def regions():
+    # enabled regions, best first, with the cheapest pool, observed fulfillment and spot quota headroom of each
+    instance_types = [t for t in request.args.get('instance_types', '').split(',') if t] or None
+    return jsonify(regions=pool_selector.regions(instance_types))
+
+PROXY_METHODS = ['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS']
+
+@app.route('/proxy/<app_name>/', defaults={'path': ''}, methods=PROXY_METHODS)
+@app.route('/proxy/<app_name>/<path:path>', methods=PROXY_METHODS)
+def proxy(app_name, path):
+    try:
+        upstream, release = load_balancer.forward(app_name, request.method, f"/{path}", request.query_string,
+                                                  request.headers, request.get_data(), request.remote_addr)
+    except NoHealthyBackend as e:
+        return jsonify(error=str(e)), 503
+    except UpstreamError as e:
+        return jsonify(error=str(e)), 502
+    # relay the body as-is (still compressed, if it was) without buffering it
+    headers = [(k, v) for k, v in upstream.raw.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS]
+    response = Response(upstream.raw.stream(64 * 1024, decode_content=False), status=upstream.status_code, headers=headers)
+    response.call_on_close(release)
+    return response
+
+@app.route('/proxy_stats')
+def proxy_stats():
+    return jsonify(apps=load_balancer.snapshot())
+
+@app.route('/autoscaling/<app_name>', methods=['GET', 'POST'])
+def autoscaling(app_name):
+    if not state_manager.get_app(app_name):
+        return jsonify(error="App not found"), 404
+    if request.method == 'POST':
+        try:
+            policy = make_policy({**(state_manager.get_autoscaling(app_name) or {}), **(request.get_json(silent=True) or {})})
+        except (TypeError, ValueError) as e:
+            return jsonify(error=str(e)), 400
+        state_manager.set_autoscaling(app_name, policy)
+    return jsonify(policy=make_policy(state_manager.get_autoscaling(app_name)),
+                   last_decision=autoscaler.last_decisions.get(app_name))
+
+@app.route('/warm_pool')
+def warm_pool_stats():
+    return jsonify(apps=warm_pool.snapshot())
+
+@app.route('/warm_pool/<app_name>', methods=['POST'])
+def set_warm_pool_size(app_name):
+    body = request.get_json(silent=True) or {}
+    size = body.get('size', request.args.get('size', 0, type=int))
+    if not isinstance(size, int) or size < 0:
+        return jsonify(error="size must be a non-negative integer"), 400
+    try:
+        state_manager.set_warm_pool_size(app_name, size)
+    except ValueError as e:
+        return jsonify(error=str(e)), 404
+    warm_pool.refill(app_name)
+    return jsonify(success=True, warm_pool=warm_pool.snapshot().get(app_name))
+
+@app.route('/placement/<app_name>', methods=['GET', 'POST'])
+def set_placement(app_name):
+    app_state = state_manager.get_app(app_name)
+    if not app_state:
+        return jsonify(error="App not found"), 404
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        mode = body.get('mode', 'dedicated')
+        if mode not in ('dedicated', 'packed'):
+            return jsonify(error="mode must be 'dedicated' or 'packed'"), 400
+        resources = {**DEFAULT_RESOURCES, **app_state.get('resources', {}), **body.get('resources', {})}
+        if not all(isinstance(resources[k], (int, float)) and resources[k] > 0 for k in DEFAULT_RESOURCES):
+            return jsonify(error="resources.cpu and resources.memory must be positive numbers"), 400
+        state_manager.set_placement(app_name, mode, {k: resources[k] for k in DEFAULT_RESOURCES})
+        app_state = state_manager.get_app(app_name)
+    return jsonify(mode=app_state.get('placement', 'dedicated'),
+                   resources={**DEFAULT_RESOURCES, **app_state.get('resources', {})})
+
+@app.route('/hosts')
+def hosts():
+    return jsonify(hosts=list(state_manager.get_hosts().values()))
+
+@app.route('/pools')
+def pools():
+    return jsonify(pools=pool_selector.snapshot())
 
 @app.route('/get_env_vars/<app_name>')
 def get_env_vars(app_name):
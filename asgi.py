@@ -0,0 +1,270 @@
+import asyncio
+import io
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+import httpx
+import app as control
+import ec2_spot_async
+import telemetry
+from aws_clients import close_async_clients
+from aws_utils import cleanup_spot_requests
+from instance_stats import MONITOR_PORT
+from jobs import JOB_FULFILLED
+from logging_config import logger
+
+# Async serving mode: scale-ups and stats probes run natively on the event loop
+# (aiobotocore, httpx), every other route is the Flask app run on a thread pool,
+# so the route surface and JSON shapes are the same as `python app.py`.
+#
+#   python asgi.py            or            uvicorn asgi:application --port 8090
+
+state_manager = control.state_manager
+stats_fetcher = control.stats_fetcher
+wsgi_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('SPOTTY_ASGI_THREADS', 64)),
+                                   thread_name_prefix='wsgi')
+http_client: Optional[httpx.AsyncClient] = None
+stats_inflight: Dict[str, asyncio.Task] = {}
+
+Handler = Callable[..., Awaitable[Tuple[int, Any]]]
+routes: List[Tuple[str, str, 're.Pattern', Handler]] = []
+
+def route(rule: str, method: str = 'GET'):
+    pattern = re.compile('^' + re.sub(r'<(\w+)>', r'(?P<\1>[^/]+)', rule) + '$')
+    def register(handler: Handler) -> Handler:
+        routes.append((method, rule, pattern, handler))
+        return handler
+    return register
+
+def query_int(query: Dict[str, List[str]], name: str, default: int) -> int:
+    # same as request.args.get(name, default, type=int)
+    try:
+        return int(query[name][0])
+    except (KeyError, ValueError):
+        return default
+
+def submit_scale_up(app_name: str, count: int, reason: str = 'scale_up') -> Dict[str, Any]:
+    # app.submit_scale_up, with the cold launch awaited on the event loop instead of a worker thread
+    app = state_manager.get_app(app_name)
+    instance_names = state_manager.reserve_instance_names(app_name, count)
+    env_vars = state_manager.get_env_vars(app_name)
+    ecr_image_uri = app['ecr_image_uri']
+    launch_spec = state_manager.get_launch_spec(app_name)
+
+    async def provision(progress):
+        if app.get('placement') == 'packed':
+            instances = await asyncio.to_thread(control.placement.place, app_name, instance_names, env_vars, progress)
+            if instances:
+                progress(JOB_FULFILLED, instance_ids=[instance['id'] for instance in instances], packed=True)
+        else:
+            instances = await asyncio.to_thread(control.warm_pool.assign, app_name, instance_names, env_vars)
+            if instances:
+                progress(JOB_FULFILLED, instance_ids=[instance['id'] for instance in instances], warm=True)
+            if len(instances) < count:
+                instances += await ec2_spot_async.create_instances(ecr_image_uri, instance_names[len(instances):], env_vars,
+                                                                   on_progress=progress, app_name=app_name, launch_spec=launch_spec)
+        return await asyncio.to_thread(control.record_provisioned, app_name, count, reason, instances, progress)
+
+    job = control.job_queue.submit_async(app_name, provision, count=count, reason=reason)
+    return {**job, 'instance_names': instance_names}
+
+@route('/scale_up/<app_name>')
+async def scale_up(query, app_name):
+    if not state_manager.get_app(app_name):
+        return 404, {'error': "App not found"}
+    count = query_int(query, 'count', 1)
+    rejection = await asyncio.to_thread(control.check_scale_up, count, state_manager.get_launch_spec(app_name).get('regions'))
+    if rejection:
+        return rejection[1], {'error': rejection[0]}
+    await asyncio.to_thread(state_manager.adjust_target_replicas, app_name, count)
+    job = submit_scale_up(app_name, count)
+    return 202, {'success': True, 'job_id': job['id'], 'status': job['status'], 'instance_names': job['instance_names']}
+
+async def scrape(instance: Dict[str, Any]) -> Dict[str, Any]:
+    url = f"http://{instance['ip']}:{instance.get('stats_port') or MONITOR_PORT}/stats"
+    try:
+        response = await http_client.get(url, timeout=stats_fetcher.timeout)
+        stats = response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        stats = {'error': str(e)}
+    # shares StatsFetcher's cache, so the metrics collector and both servers see the same scrapes
+    stats_fetcher.store(instance['id'], stats)
+    return stats
+
+async def fetch_stats(instance: Dict[str, Any]) -> Dict[str, Any]:
+    cached = stats_fetcher.cached(instance['id'])
+    if cached is not None:
+        return cached
+    task = stats_inflight.get(instance['id'])
+    if task is None:
+        task = asyncio.ensure_future(scrape(instance))
+        stats_inflight[instance['id']] = task
+        task.add_done_callback(lambda _, instance_id=instance['id']: stats_inflight.pop(instance_id, None))
+    return await task
+
+@route('/instance_stats')
+async def all_instance_stats(query):
+    instances = [instance for instance in state_manager.get_all_instances() if instance.get('ip')]
+    stats = await asyncio.gather(*[fetch_stats(instance) for instance in instances])
+    return 200, {'stats': {instance['id']: s for instance, s in zip(instances, stats)}}
+
+@route('/instance_stats/<instance_id>')
+async def instance_stats(query, instance_id):
+    _, instance = state_manager.find_instance(instance_id)
+    if not instance:
+        return 404, {"error": "Instance not found"}
+    stats = await fetch_stats(instance)
+    return (500 if 'error' in stats else 200), stats
+
+def wsgi_environ(scope: Dict[str, Any], body: bytes) -> Dict[str, Any]:
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+async def call_wsgi(scope, receive, send):
+    # runs the Flask app on a worker thread and relays its (possibly streamed) response
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=16)
+    disconnected = asyncio.Event()
+
+    def put(item):
+        # blocks the worker while the client is slow, so streams don't pile up in memory
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def start_response(status, headers, exc_info=None):
+        put(('start', status, headers))
+
+    def run():
+        try:
+            result = control.app(wsgi_environ(scope, body), start_response)
+            try:
+                for chunk in result:
+                    if disconnected.is_set():
+                        break
+                    if chunk:
+                        put(('body', chunk))
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception as e:
+            logger.exception(f"Error serving {scope['path']}: {str(e)}")
+            put(('error', e))
+        put(('end',))
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    worker = loop.run_in_executor(wsgi_executor, run)
+    started = False
+    try:
+        while True:
+            item = await queue.get()
+            if item[0] == 'start':
+                status, headers = item[1], item[2]
+                await send({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]})
+                started = True
+            elif item[0] == 'body':
+                await send({'type': 'http.response.body', 'body': item[1], 'more_body': True})
+            elif item[0] == 'error' and not started:
+                await send({'type': 'http.response.start', 'status': 500, 'headers': []})
+                started = True
+            elif item[0] == 'end':
+                await send({'type': 'http.response.body', 'body': b''})
+                break
+    finally:
+        disconnected.set()
+        watcher.cancel()
+        if not worker.done():
+            # keep taking whatever the worker still puts so it can notice the disconnect and exit
+            asyncio.ensure_future(drain(queue, worker))
+
+async def drain(queue: asyncio.Queue, worker: asyncio.Future):
+    while not worker.done():
+        try:
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            await asyncio.sleep(0.05)
+
+async def respond_json(scope, send, rule: str, status: int, data: Any, started: float):
+    body = (control.app.json.dumps(data, separators=(',', ':')) + '\n').encode()  # as jsonify outside debug
+    headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    if any(name == b'origin' for name, _ in scope['headers']):
+        headers.append((b'access-control-allow-origin', b'*'))  # what flask_cors adds by default
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+    telemetry.http_request_seconds.labels(scope['method'], rule, status).observe(time.perf_counter() - started)
+
+async def lifespan(receive, send):
+    global http_client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=int(os.environ.get('SPOTTY_STATS_WORKERS', 16)) * 8))
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # the sync server does this from its SIGINT handler, which the ASGI server replaces
+            logger.info("Cleaning up spot requests before exiting...")
+            await asyncio.to_thread(cleanup_spot_requests)
+            await http_client.aclose()
+            await close_async_clients()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    started = time.perf_counter()
+    for method, rule, pattern, handler in routes:
+        match = pattern.match(scope['path'])
+        if match and scope['method'] == method:
+            status, data = await handler(parse_qs(scope['query_string'].decode()), **match.groupdict())
+            return await respond_json(scope, send, rule, status, data, started)
+    await call_wsgi(scope, receive, send)
+
+if __name__ == '__main__':
+    import uvicorn
+    if os.getenv('TF_INSTANCE_PROFILE_NAME'):
+        uvicorn.run(application, host='0.0.0.0', port=8090, lifespan='on')
+    else:
+        logger.warning("TF_INSTANCE_PROFILE_NAME environment variable is not set. The application may not function correctly.")
@@ -0,0 +1,171 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from logging_config import logger
+from state_manager import StateManager
+from timeseries import MetricsStore
+
+DEFAULT_POLICY = {
+    'enabled': False,
+    'min_replicas': 1,
+    'max_replicas': 10,
+    # per-instance average each metric should settle at
+    'targets': {'cpu_usage_percentage': 60.0},
+    # load within this fraction of the target is left alone
+    'tolerance': 0.1,
+    'scale_up_cooldown': 120,
+    'scale_down_cooldown': 300,
+    # scale down only to the highest recommendation seen over this window
+    'scale_down_window': 300,
+    'max_scale_up_step': 4,
+    # how much recent metric history each decision averages over
+    'metric_window': 120
+}
+
+def make_policy(overrides: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    unknown = set(overrides or {}) - set(DEFAULT_POLICY)
+    if unknown:
+        raise ValueError(f"Unknown autoscaling settings: {', '.join(sorted(unknown))}")
+    policy = {**DEFAULT_POLICY, **(overrides or {})}
+    if policy['min_replicas'] < 0 or policy['max_replicas'] < policy['min_replicas']:
+        raise ValueError("min_replicas must be between 0 and max_replicas")
+    targets = policy['targets']
+    if not isinstance(targets, dict) or not targets or any(
+            isinstance(target, bool) or not isinstance(target, (int, float)) or target <= 0 for target in targets.values()):
+        raise ValueError("targets must map metrics to positive values")
+    return policy
+
+def recommend(policy: Dict[str, Any], loads: Dict[str, List[float]], current: int) -> int:
+    # proportional rule: replicas needed so the average load of each metric lands on its target
+    desired = None
+    for metric, target in policy['targets'].items():
+        values = loads.get(metric)
+        if not values:
+            continue
+        ratio = (sum(values) / len(values)) / target
+        if abs(ratio - 1) <= policy['tolerance']:
+            candidate = current
+        else:
+            candidate = math.ceil(max(current, 1) * ratio)
+        desired = candidate if desired is None else max(desired, candidate)
+    if desired is None:
+        desired = current  # no samples yet, nothing to act on
+    return max(policy['min_replicas'], min(policy['max_replicas'], desired))
+
+class ScalingDecider:
+    # pure decision logic: no clocks, no AWS, so it can be replayed over recorded metric traces
+    def __init__(self, policy: Dict[str, Any]):
+        self.policy = policy
+        self.recommendations: deque = deque()  # (time, recommended replicas)
+        self.last_scale_up = float('-inf')
+        self.last_scale_down = float('-inf')
+
+    def decide(self, loads: Dict[str, List[float]], current: int, now: float) -> int:
+        policy = self.policy
+        recommended = recommend(policy, loads, current)
+        self.recommendations.append((now, recommended))
+        while self.recommendations and self.recommendations[0][0] < now - policy['scale_down_window']:
+            self.recommendations.popleft()
+
+        if current < policy['min_replicas'] or current > policy['max_replicas']:
+            desired = max(policy['min_replicas'], min(policy['max_replicas'], current))
+        elif recommended > current:
+            if now - self.last_scale_up < policy['scale_up_cooldown']:
+                return current
+            desired = min(recommended, current + policy['max_scale_up_step'])
+        elif recommended < current:
+            if now - max(self.last_scale_down, self.last_scale_up) < policy['scale_down_cooldown']:
+                return current
+            # hysteresis: a brief dip doesn't shed capacity a recent peak still needed
+            desired = min(current, max(r for _, r in self.recommendations))
+        else:
+            return current
+
+        if desired > current:
+            self.last_scale_up = now
+        elif desired < current:
+            self.last_scale_down = now
+        return desired
+
+def replay(policy: Dict[str, Any], trace: Iterable[Tuple[float, Dict[str, float]]], replicas: int) -> List[Tuple[float, int]]:
+    # trace is (time, total load per metric); the load is spread evenly over the replicas at each step
+    decider = ScalingDecider(make_policy(policy))
+    decisions = []
+    for t, totals in trace:
+        loads = {metric: [total / max(replicas, 1)] * max(replicas, 1) for metric, total in totals.items()}
+        replicas = decider.decide(loads, replicas, t)
+        decisions.append((t, replicas))
+    return decisions
+
+class Autoscaler:
+    def __init__(self, state_manager: StateManager, store: MetricsStore,
+                 scale_up: Callable[[str, int], Any], scale_down: Callable[[str, int], Any],
+                 interval: Optional[float] = None):
+        self.state_manager = state_manager
+        self.store = store
+        self.scale_up = scale_up
+        self.scale_down = scale_down
+        self.interval = interval if interval is not None else float(os.environ.get('SPOTTY_AUTOSCALE_INTERVAL', 30))
+        self.deciders: Dict[str, ScalingDecider] = {}
+        self.last_decisions: Dict[str, Dict[str, Any]] = {}
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='autoscaler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.evaluate()
+            except Exception as e:
+                logger.exception(f"Error autoscaling apps: {str(e)}")
+
+    def decider(self, app_name: str, policy: Dict[str, Any]) -> ScalingDecider:
+        decider = self.deciders.get(app_name)
+        if decider is None:
+            decider = self.deciders[app_name] = ScalingDecider(policy)
+        decider.policy = policy
+        return decider
+
+    def loads(self, instances: List[Dict[str, Any]], metrics: List[str], since: float) -> Dict[str, List[float]]:
+        # per-instance mean of each metric over the window; instances still booting have no samples yet
+        loads: Dict[str, List[float]] = {metric: [] for metric in metrics}
+        for instance in instances:
+            series = self.store.query(instance['id'], since, metrics=metrics) or {}
+            for metric, points in series.items():
+                if points:
+                    loads[metric].append(sum(value for _, value in points) / len(points))
+        return loads
+
+    def evaluate(self):
+        now = time.time()
+        for app_name, app in self.state_manager.get_apps().items():
+            policy = app.get('autoscaling')
+            if not policy or not policy.get('enabled'):
+                self.deciders.pop(app_name, None)
+                continue
+            policy = make_policy(policy)
+            instances = [instance for instance in app['instances'] if not instance.get('interrupted')]
+            loads = self.loads(instances, list(policy['targets']), now - policy['metric_window'])
+            current = self.state_manager.get_target_replicas(app_name)
+            desired = self.decider(app_name, policy).decide(loads, current, now)
+            self.last_decisions[app_name] = {
+                'time': now, 'current': current, 'desired': desired,
+                'loads': {metric: (sum(values) / len(values) if values else None) for metric, values in loads.items()}
+            }
+            if desired > current:
+                logger.info(f"Autoscaling {app_name} up from {current} to {desired} replicas")
+                self.scale_up(app_name, desired - current)
+            elif desired < current:
+                logger.info(f"Autoscaling {app_name} down from {current} to {desired} replicas")
+                self.scale_down(app_name, current - desired)
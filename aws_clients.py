@@ -0,0 +1,106 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import AsyncExitStack
+from typing import Any, Dict, Optional, Tuple
+import boto3
+from botocore.config import Config
+from telemetry import aws_call_seconds
+
+_clients: Dict[Tuple[str, Optional[str]], Any] = {}
+_lock = threading.Lock()
+_session = None
+# aiobotocore clients for the async server; they live on its event loop and are closed with it
+_async_clients: Dict[Tuple[str, Optional[str]], Any] = {}
+_async_lock: Optional[asyncio.Lock] = None
+_async_session = None
+_async_stack: Optional[AsyncExitStack] = None
+
+def get_client_config() -> Config:
+    return Config(
+        max_pool_connections=int(os.environ.get('SPOTTY_AWS_MAX_POOL_CONNECTIONS', 20)),
+        retries={
+            'mode': os.environ.get('SPOTTY_AWS_RETRY_MODE', 'adaptive'),
+            'max_attempts': int(os.environ.get('SPOTTY_AWS_MAX_ATTEMPTS', 5))
+        }
+    )
+
+def _call_started(context, **kwargs):
+    context['spotty_started'] = time.perf_counter()
+
+def _call_finished(event_name, context, parsed=None, exception=None, **kwargs):
+    # after-call fires once per API call, after botocore's own retries; after-call-error when it never got a response
+    started = context.get('spotty_started')
+    if started is None:
+        return
+    _, service, operation = event_name.split('.', 2)
+    if exception is not None:
+        outcome = type(exception).__name__
+    else:
+        outcome = (parsed or {}).get('Error', {}).get('Code') or 'success'
+    aws_call_seconds.labels(service, operation, outcome).observe(time.perf_counter() - started)
+
+def instrument(client):
+    client.meta.events.register('before-parameter-build', _call_started)
+    client.meta.events.register('after-call', _call_finished)
+    client.meta.events.register('after-call-error', _call_finished)
+    return client
+
+def get_client(service_name: str, region_name: Optional[str] = None):
+    global _session
+    region_name = region_name or os.environ.get('AWS_REGION')
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        # clients are thread-safe once built, but sessions are not, so only build under the lock
+        client = _clients.get(key)
+        if client is None:
+            if _session is None:
+                _session = boto3.session.Session()
+            client = instrument(_session.client(service_name, region_name=region_name, config=get_client_config()))
+            _clients[key] = client
+        return client
+
+def clear_clients():
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
+
+async def get_async_client(service_name: str, region_name: Optional[str] = None):
+    global _async_lock, _async_session, _async_stack
+    region_name = region_name or os.environ.get('AWS_REGION')
+    key = (service_name, region_name)
+    client = _async_clients.get(key)
+    if client is not None:
+        return client
+    if _async_lock is None:
+        _async_lock = asyncio.Lock()
+    async with _async_lock:
+        client = _async_clients.get(key)
+        if client is None:
+            # only the async server needs aiobotocore
+            from aiobotocore.config import AioConfig
+            from aiobotocore.session import get_session
+            if _async_session is None:
+                _async_session = get_session()
+                _async_stack = AsyncExitStack()
+            # one event loop can have hundreds of calls in flight, far more than a thread pool
+            config = AioConfig(
+                max_pool_connections=int(os.environ.get('SPOTTY_AWS_ASYNC_MAX_POOL_CONNECTIONS', 200)),
+                retries=get_client_config().retries
+            )
+            client = await _async_stack.enter_async_context(
+                _async_session.create_client(service_name, region_name=region_name, config=config))
+            _async_clients[key] = instrument(client)
+        return client
+
+async def close_async_clients():
+    global _async_lock, _async_session, _async_stack
+    if _async_stack is not None:
+        await _async_stack.aclose()
+    _async_clients.clear()
+    _async_lock, _async_session, _async_stack = None, None, None
@@ -0,0 +1,157 @@
+# Control plane latency while many scale-ups are in flight, for the threaded
+# Flask server (python app.py) and the asyncio server (python asgi.py), both
+# against the EC2 stand-in in fake_aws.py. Reports /get_state latency under
+# that load and how long the whole burst of scale-ups takes to finish.
+#
+#   python benchmarks/asgi_load_bench.py [--scale-ups 50] [--delay 1] [--api-latency 0.05]
+#       [--mode sync|async]
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+for name, value in {'TF_AMI_ID': 'ami-bench', 'TF_SECURITY_GROUP_ID': 'sg-bench',
+                    'TF_INSTANCE_PROFILE_NAME': 'bench-profile', 'TF_INSTANCE_TYPES': 't3.micro,t3a.micro',
+                    'TF_SUBNET_IDS': 'subnet-a,subnet-b', 'SPOTTY_MAX_SCALE_UP_COUNT': '100',
+                    'SPOTTY_ASYNC_POLL_INTERVAL': '0.05'}.items():
+    os.environ.setdefault(name, value)
+for name in ('SPOTTY_RECONCILE_INTERVAL', 'SPOTTY_METRICS_INTERVAL', 'SPOTTY_BOOT_TRACKER_INTERVAL',
+             'SPOTTY_WARM_POOL_INTERVAL', 'SPOTTY_LB_HEALTH_INTERVAL', 'SPOTTY_AUTOSCALE_INTERVAL',
+             'SPOTTY_PLACEMENT_INTERVAL', 'SPOTTY_COST_INTERVAL'):
+    os.environ[name] = '0'
+
+import requests
+
+from bidding import percentile
+from fake_aws import FakeEC2, install, install_async
+from logging_config import logger
+
+APP_NAME = 'load'
+IMAGE = 'example.dkr.ecr.us-east-1.amazonaws.com/bench'
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def serve_sync(port):
+    from werkzeug.serving import make_server
+    import app as spotty
+    server = make_server('127.0.0.1', port, spotty.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown
+
+def serve_async(port):
+    import uvicorn
+    import asgi
+    server = uvicorn.Server(uvicorn.Config(asgi.application, host='127.0.0.1', port=port,
+                                           lifespan='on', log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return stop
+
+def run_mode(args):
+    ec2 = FakeEC2(delay=args.delay, api_latency=args.api_latency)
+    install(ec2)
+    install_async(ec2)
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # the app keeps its state file in the working directory
+        with contextlib.redirect_stdout(io.StringIO()):
+            stop = serve_sync(port) if args.mode == 'sync' else serve_async(port)
+        session = requests.Session()
+        session.post(f"{base}/add_app", data={'app_name': APP_NAME, 'ecr_uri': IMAGE}).raise_for_status()
+
+        latencies, done = [], threading.Event()
+
+        def poll_state():
+            with requests.Session() as s:
+                while not done.is_set():
+                    start = time.perf_counter()
+                    s.get(f"{base}/get_state").raise_for_status()
+                    latencies.append(time.perf_counter() - start)
+
+        pollers = [threading.Thread(target=poll_state) for _ in range(args.pollers)]
+        for poller in pollers:
+            poller.start()
+
+        local = threading.local()
+
+        def scale_up(_):
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            return local.session.get(f"{base}/scale_up/{APP_NAME}?count=1").json()['job_id']
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            job_ids = list(executor.map(scale_up, range(args.scale_ups)))
+        accepted = time.perf_counter() - start
+        failed = 0
+        for job_id in job_ids:
+            while True:
+                job = session.get(f"{base}/jobs/{job_id}").json()
+                if job['done']:
+                    failed += job['status'] == 'failed'
+                    break
+                time.sleep(0.02)
+        completed = time.perf_counter() - start
+        done.set()
+        for poller in pollers:
+            poller.join()
+        stop()
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    return {'accept_s': accepted, 'complete_s': completed, 'scale_ups_per_s': args.scale_ups / completed,
+            'failed': failed, 'get_state_p50_ms': percentile(latencies, 50) * 1000,
+            'get_state_p95_ms': percentile(latencies, 95) * 1000, 'get_state_requests': len(latencies)}
+
+def compare(args):
+    # each mode runs in its own process so they start from the same empty state
+    results = {}
+    for mode in ('sync', 'async'):
+        command = [sys.executable, os.path.abspath(__file__), '--mode', mode] + [
+            f"--{name.replace('_', '-')}={value}" for name, value in vars(args).items()
+            if name not in ('mode', 'verbose') and value is not None]
+        if args.verbose:
+            command.append('--verbose')
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+    print(f"{'metric':<22} {'sync':>12} {'async':>12}")
+    for name in results['sync']:
+        print(f"{name:<22} {results['sync'][name]:>12.3f} {results['async'][name]:>12.3f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=('sync', 'async'), help='run one server and print its results as JSON')
+    parser.add_argument('--scale-ups', type=int, default=50, help='scale-up requests fired at once')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--pollers', type=int, default=4, help='clients hammering /get_state meanwhile')
+    parser.add_argument('--delay', type=float, default=1.0, help='seconds from spot request to fulfillment')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='seconds added to every EC2 call')
+    parser.add_argument('--verbose', action='store_true', help='keep Spotty\'s own log output')
+    args = parser.parse_args()
+    logger.setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    if args.mode:
+        print(json.dumps(run_mode(args)))
+    else:
+        compare(args)
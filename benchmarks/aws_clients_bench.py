@@ -0,0 +1,45 @@
+# Per-call latency of a fresh boto3 client versus the shared aws_clients registry.
+# Runs offline: responses come from botocore's Stubber, so no AWS account is needed.
+#
+#   python benchmarks/aws_clients_bench.py [iterations]
+
+import os
+import sys
+import time
+import boto3
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+from aws_clients import clear_clients, get_client
+
+RESPONSE = {'SpotInstanceRequests': []}
+
+def call(client):
+    with Stubber(client) as stubber:
+        stubber.add_response('describe_spot_instance_requests', RESPONSE)
+        client.describe_spot_instance_requests()
+
+def bench_fresh(iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call(boto3.client('ec2', region_name=os.environ['AWS_REGION']))
+    return (time.perf_counter() - start) / iterations
+
+def bench_shared(iterations):
+    clear_clients()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call(get_client('ec2'))
+    return (time.perf_counter() - start) / iterations
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    fresh = bench_fresh(iterations)
+    shared = bench_shared(iterations)
+    print(f"fresh client per call:  {fresh * 1000:.3f} ms/call")
+    print(f"shared client registry: {shared * 1000:.3f} ms/call")
+    print(f"speedup: {fresh / shared:.1f}x over {iterations} calls")
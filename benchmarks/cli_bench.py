@@ -0,0 +1,83 @@
+# Cold start of `spotty status`: wall time of fresh processes against a state of
+# --instances instances, and a -X importtime breakdown of what the command loads.
+# Fails (exit 1) when the median run is over --budget-ms, or when a read command
+# pulls in one of the heavy modules that only the server and AWS commands need.
+#
+#   python benchmarks/cli_bench.py [--instances 200] [--runs 20] [--budget-ms 100]
+
+import argparse
+import compileall
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+HEAVY_MODULES = ('boto3', 'botocore', 'aiobotocore', 'flask', 'werkzeug', 'requests', 'httpx', 'dotenv', 'asyncio')
+
+def make_state(directory, instances):
+    from state_manager import StateManager
+    state_manager = StateManager(filename=os.path.join(directory, 'instance_state.json'))
+    apps = max(1, instances // 50)
+    for a in range(apps):
+        app_name = f"bench-{a}"
+        state_manager.add_app(app_name, 'example.dkr.ecr.us-east-1.amazonaws.com/bench')
+        state_manager.add_instances(app_name, [
+            {'id': f"i-{a:04x}{n:013x}", 'ip': '10.0.0.1', 'name': f"{app_name}-{n}", 'instance_type': 't3.micro',
+             'az': 'us-east-1a', 'spot_price': 0.005, 'time_now': time.time() - n * 60}
+            for n in range(instances // apps)])
+
+def timed(command, directory=None):
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=directory, capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, result.stderr
+
+def run(directory, *flags):
+    return timed([sys.executable, *flags, os.path.join(ROOT, 'spotty'), 'status'], directory)
+
+def import_times(stderr):
+    # `import time: self [us] | cumulative | imported package` lines, top-level modules only
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative)
+    return times
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=200)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--budget-ms', type=float, default=100)
+    args = parser.parse_args()
+
+    # a deployed tree has its bytecode cached; don't time compiling it (PYTHONDONTWRITEBYTECODE would)
+    compileall.compile_dir(ROOT, maxlevels=0, quiet=1)
+    with tempfile.TemporaryDirectory() as tmp:
+        make_state(tmp, args.instances)
+        run(tmp)  # warm the OS file cache so every run starts from the same place
+        timings = sorted(run(tmp)[0] for _ in range(args.runs))
+        interpreter = sorted(timed([sys.executable, '-c', 'pass'])[0] for _ in range(args.runs))
+        _, stderr = run(tmp, '-X', 'importtime')
+    times = import_times(stderr)
+
+    median = timings[len(timings) // 2] * 1000
+    print(f"spotty status, {args.instances} instances, {args.runs} cold runs")
+    print(f"  median {median:.1f} ms, min {timings[0] * 1000:.1f} ms, max {timings[-1] * 1000:.1f} ms")
+    print(f"  bare interpreter start {interpreter[len(interpreter) // 2] * 1000:.1f} ms")
+    print("slowest imports (cumulative):")
+    for name, us in sorted(times.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {us / 1000:7.1f} ms  {name}")
+
+    failures = []
+    heavy = sorted({name.split('.')[0] for name in times} & set(HEAVY_MODULES))
+    if heavy:
+        failures.append(f"status imported {', '.join(heavy)}")
+    if median > args.budget_ms:
+        failures.append(f"median {median:.1f} ms is over the {args.budget_ms:g} ms budget")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,308 @@
+# In-process stand-in for the EC2 and Service Quotas calls Spotty makes, so the
+# orchestration code can be exercised without an AWS account. Spot requests are
+# fulfilled after a configurable delay, can fail for lack of capacity, and are
+# refused when the bid is under a (noisy) market price.
+#
+#   from fake_aws import FakeEC2, install
+#   ec2 = install(FakeEC2(delay=0.05, capacity_error_rate=0.1))
+#   install_async(ec2)  # the same fake behind aws_clients.get_async_client
+#   install(FakeEC2(region='us-west-2'), region='us-west-2', clear=False)  # a second region
+
+import asyncio
+import functools
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from botocore.exceptions import ClientError, WaiterError
+
+import aws_clients
+
+DEFAULT_PRICES = {'t3.micro': 0.0031, 't3a.micro': 0.0029, 't2.micro': 0.0035, 'm5.large': 0.035}
+INSTANCE_TYPES = {'t3.micro': (2, 1024), 't3a.micro': (2, 1024), 't2.micro': (1, 1024),
+                  'm5.large': (2, 8192), 't3.large': (2, 8192)}
+
+# shared by every fake so instance and request ids stay unique across regions
+_ids = itertools.count(1)
+
+def client_error(code: str, message: str, operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+def matches(filters: Optional[List[Dict[str, Any]]], values: Dict[str, Any]) -> bool:
+    return all(values.get(f['Name']) in f['Values'] for f in filters or [])
+
+class FakePaginator:
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        yield self.method(**kwargs)
+
+class FakeWaiter:
+    def __init__(self, ec2: 'FakeEC2'):
+        self.ec2 = ec2
+
+    def wait(self, SpotInstanceRequestIds: List[str], WaiterConfig: Optional[Dict[str, Any]] = None):
+        # gives up after waiter_timeout, the simulated stand-in for Delay * MaxAttempts
+        deadline = time.time() + self.ec2.waiter_timeout
+        while True:
+            with self.ec2.lock:
+                requests = [self.ec2.spot_requests[request_id] for request_id in SpotInstanceRequestIds]
+            pending = [r for r in requests if r['fulfill_at'] is None or r['fulfill_at'] > time.time()]
+            if not pending:
+                return
+            if any(r['fulfill_at'] is None for r in pending) or min(r['fulfill_at'] for r in pending) > deadline:
+                time.sleep(max(0.0, deadline - time.time()))
+                raise WaiterError('SpotInstanceRequestFulfilled', 'Max attempts exceeded', {})
+            time.sleep(max(0.0, max(r['fulfill_at'] for r in pending) - time.time()))
+
+class FakeEC2:
+    def __init__(self, delay: float = 0.05, capacity_error_rate: float = 0.0, price_volatility: float = 0.1,
+                 prices: Optional[Dict[str, float]] = None, api_latency: float = 0.0,
+                 waiter_timeout: Optional[float] = None, seed: int = 0, region: str = 'us-east-1'):
+        self.region = region
+        self.delay = delay  # request -> fulfilled
+        self.capacity_error_rate = capacity_error_rate
+        self.price_volatility = price_volatility  # market price swings by up to this fraction around the base
+        self.prices = {**DEFAULT_PRICES, **(prices or {})}
+        self.api_latency = api_latency  # added to every call, a stand-in for the round trip to AWS
+        self.waiter_timeout = waiter_timeout if waiter_timeout is not None else max(4 * delay, 0.1)
+        self.random = random.Random(seed)
+        self.spot_requests: Dict[str, Dict[str, Any]] = {}
+        self.instances: Dict[str, Dict[str, Any]] = {}
+        self.templates: Dict[str, Dict[str, Any]] = {}
+        self.calls: Counter = Counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()  # AsyncFakeEC2 does its waiting on the event loop instead
+
+    def _sleep(self, seconds: float):
+        if seconds and not getattr(self.local, 'nonblocking', False):
+            time.sleep(seconds)
+
+    def _call(self, operation: str):
+        self.calls[operation] += 1
+        self._sleep(self.api_latency)
+
+    def _id(self, prefix: str) -> str:
+        return f"{prefix}-{next(_ids):017x}"
+
+    def market_price(self, instance_type: str) -> float:
+        base = self.prices.get(instance_type, 0.01)
+        return base * (1 + self.price_volatility * (2 * self.random.random() - 1))
+
+    def _launch(self, instance_type: str, subnet_id: Optional[str], price: float) -> str:
+        instance_id = self._id('i')
+        n = len(self.instances) + 1
+        self.instances[instance_id] = {
+            'InstanceId': instance_id,
+            'InstanceType': instance_type,
+            'SubnetId': subnet_id,
+            'State': {'Name': 'running'},
+            'PublicIpAddress': f"10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}",
+            'SpotPrice': price
+        }
+        return instance_id
+
+    # spot requests
+
+    def request_spot_instances(self, SpotPrice: str, InstanceCount: int, LaunchSpecification: Dict[str, Any], **kwargs):
+        self._call('request_spot_instances')
+        now = time.time()
+        instance_type = LaunchSpecification.get('InstanceType') or 't3.micro'
+        created = []
+        with self.lock:
+            for _ in range(InstanceCount):
+                request_id = self._id('sir')
+                if self.random.random() < self.capacity_error_rate:
+                    code, fulfill_at = 'capacity-not-available', None
+                elif float(SpotPrice) < self.market_price(instance_type):
+                    code, fulfill_at = 'price-too-low', None
+                else:
+                    code, fulfill_at = 'pending-fulfillment', now + self.delay
+                self.spot_requests[request_id] = {
+                    'SpotInstanceRequestId': request_id,
+                    'SpotPrice': SpotPrice,
+                    'InstanceType': instance_type,
+                    'SubnetId': LaunchSpecification.get('SubnetId'),
+                    'code': code,
+                    'fulfill_at': fulfill_at,
+                    'state': 'open',
+                    'InstanceId': None
+                }
+                created.append({'SpotInstanceRequestId': request_id, 'State': 'open'})
+        return {'SpotInstanceRequests': created}
+
+    def _advance(self, request: Dict[str, Any]):
+        # lazily fulfil requests whose delay has passed
+        if request['state'] == 'open' and request['fulfill_at'] is not None and request['fulfill_at'] <= time.time():
+            request['InstanceId'] = self._launch(request['InstanceType'], request['SubnetId'], float(request['SpotPrice']))
+            request['state'], request['code'] = 'active', 'fulfilled'
+
+    def describe_spot_instance_requests(self, SpotInstanceRequestIds: Optional[List[str]] = None,
+                                        Filters: Optional[List[Dict[str, Any]]] = None, **kwargs):
+        self._call('describe_spot_instance_requests')
+        with self.lock:
+            requests = [self.spot_requests[r] for r in SpotInstanceRequestIds] if SpotInstanceRequestIds else list(self.spot_requests.values())
+            result = []
+            for request in requests:
+                self._advance(request)
+                if not matches(Filters, {'state': request['state'], 'instance-id': request['InstanceId']}):
+                    continue
+                entry = {'SpotInstanceRequestId': request['SpotInstanceRequestId'], 'State': request['state'],
+                         'Status': {'Code': request['code']}, 'LaunchSpecification': {'InstanceType': request['InstanceType']}}
+                if request['InstanceId']:
+                    entry['InstanceId'] = request['InstanceId']
+                result.append(entry)
+        return {'SpotInstanceRequests': result}
+
+    def cancel_spot_instance_requests(self, SpotInstanceRequestIds: List[str]):
+        self._call('cancel_spot_instance_requests')
+        with self.lock:
+            for request_id in SpotInstanceRequestIds:
+                request = self.spot_requests[request_id]
+                self._advance(request)
+                if request['state'] == 'open':
+                    request['state'], request['code'] = 'cancelled', 'canceled-before-fulfillment'
+        return {'CancelledSpotInstanceRequests': [{'SpotInstanceRequestId': r} for r in SpotInstanceRequestIds]}
+
+    def get_waiter(self, name: str) -> FakeWaiter:
+        if name != 'spot_instance_request_fulfilled':
+            raise NotImplementedError(name)
+        return FakeWaiter(self)
+
+    # run_instances with spot market options, used by the launch template path
+
+    def run_instances(self, InstanceType: str, MaxCount: int, InstanceMarketOptions: Dict[str, Any],
+                      SubnetId: Optional[str] = None, **kwargs):
+        self._call('run_instances')
+        max_price = float(InstanceMarketOptions['SpotOptions']['MaxPrice'])
+        self._sleep(self.delay)
+        with self.lock:
+            if self.random.random() < self.capacity_error_rate:
+                raise client_error('InsufficientInstanceCapacity', f"No capacity for {InstanceType}", 'RunInstances')
+            if max_price < self.market_price(InstanceType):
+                raise client_error('SpotMaxPriceTooLow', f"Max price {max_price} is below the spot price", 'RunInstances')
+            instance_ids = [self._launch(InstanceType, SubnetId, max_price) for _ in range(MaxCount)]
+            return {'Instances': [{'InstanceId': instance_id} for instance_id in instance_ids]}
+
+    def describe_launch_templates(self, LaunchTemplateNames: List[str]):
+        self._call('describe_launch_templates')
+        template = self.templates.get(LaunchTemplateNames[0])
+        if template is None:
+            raise client_error('InvalidLaunchTemplateName.NotFoundException', 'not found', 'DescribeLaunchTemplates')
+        return {'LaunchTemplates': [{'LaunchTemplateId': template['id']}]}
+
+    def create_launch_template(self, LaunchTemplateName: str, VersionDescription: str, LaunchTemplateData: Dict[str, Any]):
+        self._call('create_launch_template')
+        with self.lock:
+            template = {'id': self._id('lt'), 'name': LaunchTemplateName, 'versions': [VersionDescription]}
+            self.templates[LaunchTemplateName] = template
+        return {'LaunchTemplate': {'LaunchTemplateId': template['id'], 'LatestVersionNumber': 1}}
+
+    def _template(self, template_id: str) -> Dict[str, Any]:
+        return next(t for t in self.templates.values() if t['id'] == template_id)
+
+    def describe_launch_template_versions(self, LaunchTemplateId: str, Versions: List[str]):
+        self._call('describe_launch_template_versions')
+        versions = self._template(LaunchTemplateId)['versions']
+        return {'LaunchTemplateVersions': [{'VersionNumber': len(versions), 'VersionDescription': versions[-1]}]}
+
+    def create_launch_template_version(self, LaunchTemplateId: str, VersionDescription: str, **kwargs):
+        self._call('create_launch_template_version')
+        versions = self._template(LaunchTemplateId)['versions']
+        versions.append(VersionDescription)
+        return {'LaunchTemplateVersion': {'VersionNumber': len(versions)}}
+
+    def modify_launch_template(self, **kwargs):
+        self._call('modify_launch_template')
+        return {}
+
+    # instances
+
+    def describe_instances(self, InstanceIds: Optional[List[str]] = None,
+                           Filters: Optional[List[Dict[str, Any]]] = None, **kwargs):
+        self._call('describe_instances')
+        with self.lock:
+            instances = [self.instances[i] for i in InstanceIds if i in self.instances] if InstanceIds else list(self.instances.values())
+            instances = [dict(i) for i in instances if matches(Filters, {'instance-id': i['InstanceId']})]
+        return {'Reservations': [{'Instances': instances}] if instances else []}
+
+    def terminate_instances(self, InstanceIds: List[str]):
+        self._call('terminate_instances')
+        with self.lock:
+            for instance_id in InstanceIds:
+                if instance_id in self.instances:
+                    self.instances[instance_id]['State'] = {'Name': 'terminated'}
+        return {'TerminatingInstances': [{'InstanceId': i} for i in InstanceIds]}
+
+    def create_tags(self, Resources: List[str], Tags: List[Dict[str, str]]):
+        self._call('create_tags')
+        return {}
+
+    # catalog
+
+    def describe_spot_price_history(self, InstanceTypes: List[str], **kwargs):
+        self._call('describe_spot_price_history')
+        now = datetime.now(timezone.utc)
+        history = [{'AvailabilityZone': az, 'SpotPrice': f"{self.market_price(instance_type):.6f}",
+                    'Timestamp': now - timedelta(minutes=10 * n)}
+                   for instance_type in InstanceTypes for az in (f"{self.region}a", f"{self.region}b") for n in range(24)]
+        return {'SpotPriceHistory': history}
+
+    def describe_subnets(self, SubnetIds: List[str]):
+        self._call('describe_subnets')
+        return {'Subnets': [{'SubnetId': subnet_id, 'AvailabilityZone': f"{self.region}{'ab'[n % 2]}"}
+                            for n, subnet_id in enumerate(SubnetIds)]}
+
+    def describe_instance_types(self, InstanceTypes: List[str]):
+        self._call('describe_instance_types')
+        vcpus, memory = INSTANCE_TYPES.get(InstanceTypes[0], (2, 1024))
+        return {'InstanceTypes': [{'InstanceType': InstanceTypes[0], 'VCpuInfo': {'DefaultVCpus': vcpus},
+                                   'MemoryInfo': {'SizeInMiB': memory}}]}
+
+    def get_paginator(self, name: str) -> FakePaginator:
+        return FakePaginator(getattr(self, name))
+
+class FakeServiceQuotas:
+    def __init__(self, vcpus: float = 100000):
+        self.vcpus = vcpus
+
+    def get_service_quota(self, ServiceCode: str, QuotaCode: str):
+        return {'Quota': {'Value': self.vcpus}}
+
+class AsyncFakeEC2:
+    # aiobotocore-shaped view of a FakeEC2: the simulated latency is awaited, then the call runs inline
+    def __init__(self, ec2: FakeEC2):
+        self.ec2 = ec2
+
+    def __getattr__(self, name: str):
+        method = getattr(self.ec2, name)
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            await asyncio.sleep(self.ec2.api_latency + (self.ec2.delay if name == 'run_instances' else 0))
+            self.ec2.local.nonblocking = True
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.ec2.local.nonblocking = False
+        return call
+
+def install(ec2: FakeEC2, quotas: Optional[FakeServiceQuotas] = None, region: str = 'us-east-1',
+            clear: bool = True) -> FakeEC2:
+    # the shared client registry hands these out to every module that calls get_client;
+    # clear=False adds another region next to the ones already installed
+    if clear:
+        aws_clients.clear_clients()
+    aws_clients._clients[('ec2', region)] = ec2
+    aws_clients._clients[('service-quotas', region)] = quotas or FakeServiceQuotas()
+    return ec2
+
+def install_async(ec2: FakeEC2, region: str = 'us-east-1') -> AsyncFakeEC2:
+    client = AsyncFakeEC2(ec2)
+    aws_clients._async_clients[('ec2', region)] = client
+    return client
@@ -0,0 +1,219 @@
+# End-to-end orchestration benchmark: drives the Flask app against the in-process
+# EC2 stand-in in fake_aws.py, so it needs no AWS account. Measures scale-up
+# latency, concurrent scale/delete throughput, /get_state latency as the instance
+# count grows and StateManager write cost, and can compare a run with a saved one.
+#
+#   python benchmarks/orchestration_bench.py [--delay 0.05] [--capacity-error-rate 0.1]
+#       [--price-volatility 0.1] [--api-latency 0] [--launch-templates]
+#       [--verbose] [--json report.json] [--baseline previous.json] [--threshold 0.2]
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+for name, value in {'TF_AMI_ID': 'ami-bench', 'TF_SECURITY_GROUP_ID': 'sg-bench',
+                    'TF_INSTANCE_PROFILE_NAME': 'bench-profile', 'TF_INSTANCE_TYPES': 't3.micro,t3a.micro',
+                    'TF_SUBNET_IDS': 'subnet-a,subnet-b', 'SPOTTY_MAX_SCALE_UP_COUNT': '100'}.items():
+    os.environ.setdefault(name, value)
+# the background loops would otherwise race the measurements
+for name in ('SPOTTY_RECONCILE_INTERVAL', 'SPOTTY_METRICS_INTERVAL', 'SPOTTY_BOOT_TRACKER_INTERVAL',
+             'SPOTTY_WARM_POOL_INTERVAL', 'SPOTTY_LB_HEALTH_INTERVAL', 'SPOTTY_AUTOSCALE_INTERVAL',
+             'SPOTTY_PLACEMENT_INTERVAL', 'SPOTTY_COST_INTERVAL'):
+    os.environ[name] = '0'
+
+from bidding import percentile
+from fake_aws import FakeEC2, install
+from logging_config import logger
+from state_backends import JsonStateBackend, SqliteStateBackend
+from state_backends_bench import bench as bench_writes
+
+SCALE_UP_COUNTS = [1, 5, 10]
+STATE_SIZES = [100, 1000, 10000]
+WRITE_SIZES = [100, 1000]
+IMAGE = 'example.dkr.ecr.us-east-1.amazonaws.com/bench'
+
+def wait_for(client, job_id, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = client.get(f"/jobs/{job_id}").get_json()
+        if job['done']:
+            return job
+        time.sleep(0.005)
+    raise TimeoutError(f"job {job_id} did not finish in {timeout}s")
+
+def add_app(client, name):
+    client.post('/add_app', data={'app_name': name, 'ecr_uri': IMAGE})
+
+def bench_scale_up(client, ec2, repeats):
+    results = {}
+    for count in SCALE_UP_COUNTS:
+        app_name = f"scale-{count}"
+        add_app(client, app_name)
+        latencies, calls_before = [], sum(ec2.calls.values())
+        for _ in range(repeats):
+            start = time.perf_counter()
+            job_id = client.get(f"/scale_up/{app_name}?count={count}").get_json()['job_id']
+            wait_for(client, job_id)
+            latencies.append(time.perf_counter() - start)
+        results[count] = {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                          'calls': (sum(ec2.calls.values()) - calls_before) / repeats}
+    return results
+
+def bench_concurrent(client, state_manager, operations, concurrency):
+    # half the operations scale up by one, the other half delete one of the seeded instances
+    app_name = 'churn'
+    add_app(client, app_name)
+    seeded = [{'id': f"i-seed{n:012x}", 'ip': '10.0.0.1', 'name': f"{app_name}-{n}", 'spot_price': 0.003,
+               'time_now': time.time()} for n in range(operations // 2)]
+    state_manager.add_instances(app_name, seeded)
+    state_manager.adjust_target_replicas(app_name, len(seeded))
+    victims = iter(seeded)
+    victims_lock = threading.Lock()
+
+    def one(n):
+        if n % 2:
+            with victims_lock:
+                victim = next(victims)
+            return client.get(f"/delete_instance/{app_name}/{victim['id']}").status_code, None
+        response = client.get(f"/scale_up/{app_name}?count=1")
+        return response.status_code, response.get_json().get('job_id')
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        responses = list(executor.map(one, range(operations)))
+    accepted = time.perf_counter() - start
+    for _, job_id in responses:
+        if job_id:
+            wait_for(client, job_id)
+    completed = time.perf_counter() - start
+    errors = sum(1 for status, _ in responses if status >= 400)
+    return {'requests_per_s': operations / accepted, 'operations_per_s': operations / completed, 'errors': errors}
+
+def bench_get_state(client, state_manager, requests):
+    results = {}
+    app_name, size = 'bulk', 0
+    add_app(client, app_name)
+    for target in STATE_SIZES:
+        state_manager.add_instances(app_name, [
+            {'id': f"i-bulk{n:012x}", 'ip': '10.0.0.1', 'name': f"{app_name}-{n}", 'spot_price': 0.003,
+             'time_now': time.time()} for n in range(size, target)])
+        size = target
+        full, cached = [], []
+        for _ in range(requests):
+            start = time.perf_counter()
+            response = client.get('/get_state')
+            full.append(time.perf_counter() - start)
+            etag = response.headers['ETag']
+            start = time.perf_counter()
+            client.get('/get_state', headers={'If-None-Match': etag})
+            cached.append(time.perf_counter() - start)
+        results[target] = {'p50': percentile(full, 50), 'p95': percentile(full, 95), 'p50_304': percentile(cached, 50)}
+    return results
+
+def bench_state_writes(tmp, writes):
+    results = {}
+    for size in WRITE_SIZES:
+        results[size] = {
+            'json': bench_writes(JsonStateBackend(os.path.join(tmp, f"writes-{size}.json")), size, writes),
+            'sqlite': bench_writes(SqliteStateBackend(os.path.join(tmp, f"writes-{size}.db")), size, writes)
+        }
+    return results
+
+def run(args):
+    ec2 = install(FakeEC2(delay=args.delay, capacity_error_rate=args.capacity_error_rate,
+                          price_volatility=args.price_volatility, api_latency=args.api_latency))
+    metrics = {}  # name -> (value, unit); 'ms' is lower-is-better, '/s' higher-is-better
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # the app keeps its state file in the working directory
+        with contextlib.redirect_stdout(io.StringIO()):
+            import app as spotty
+            client = spotty.app.test_client()
+            scale_up = bench_scale_up(client, ec2, args.repeats)
+            concurrent = bench_concurrent(client, spotty.state_manager, args.operations, args.concurrency)
+            get_state = bench_get_state(client, spotty.state_manager, args.requests)
+            writes = bench_state_writes(tmp, args.writes)
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    for count, r in scale_up.items():
+        metrics[f"scale_up.{count}.p50"] = (r['p50'] * 1000, 'ms')
+        metrics[f"scale_up.{count}.p95"] = (r['p95'] * 1000, 'ms')
+        metrics[f"scale_up.{count}.aws_calls"] = (r['calls'], 'calls')
+    metrics['concurrent.requests'] = (concurrent['requests_per_s'], 'req/s')
+    metrics['concurrent.operations'] = (concurrent['operations_per_s'], 'ops/s')
+    metrics['concurrent.errors'] = (concurrent['errors'], 'errors')
+    for size, r in get_state.items():
+        metrics[f"get_state.{size}.p50"] = (r['p50'] * 1000, 'ms')
+        metrics[f"get_state.{size}.p95"] = (r['p95'] * 1000, 'ms')
+        metrics[f"get_state.{size}.p50_304"] = (r['p50_304'] * 1000, 'ms')
+    for size, r in writes.items():
+        metrics[f"state_write.{size}.json"] = (r['json'] * 1000, 'ms')
+        metrics[f"state_write.{size}.sqlite"] = (r['sqlite'] * 1000, 'ms')
+    return metrics
+
+def lower_is_better(unit):
+    return not unit.endswith('/s')
+
+def report(metrics, baseline=None, threshold=0.2):
+    # returns the metrics that got worse than the baseline by more than threshold
+    regressions = []
+    print(f"{'metric':<32} {'value':>12} {'unit':<8}" + (f" {'baseline':>12} {'change':>8}" if baseline else ''))
+    for name, (value, unit) in metrics.items():
+        line = f"{name:<32} {value:>12.3f} {unit:<8}"
+        if baseline and name in baseline:
+            before = baseline[name][0]
+            change = (value - before) / before if before else (float('inf') if value > before else 0.0)
+            worse = change > threshold if lower_is_better(unit) else change < -threshold
+            line += f" {before:>12.3f} {change:>+7.1%}" + (' REGRESSION' if worse else '')
+            if worse:
+                regressions.append(name)
+        print(line)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--delay', type=float, default=0.05, help='seconds from spot request to fulfillment')
+    parser.add_argument('--capacity-error-rate', type=float, default=0.0, help='share of requests refused for capacity')
+    parser.add_argument('--price-volatility', type=float, default=0.1, help='market price swing around the base price')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds added to every EC2 call')
+    parser.add_argument('--launch-templates', action='store_true', help='launch through run_instances and launch templates')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--operations', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--writes', type=int, default=20)
+    parser.add_argument('--verbose', action='store_true', help='keep Spotty\'s own log output')
+    parser.add_argument('--json', help='write the results here for a later --baseline')
+    parser.add_argument('--baseline', help='a previous --json report to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+    if args.launch_templates:
+        os.environ['SPOTTY_LAUNCH_TEMPLATES'] = '1'
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    json_path = os.path.abspath(args.json) if args.json else None
+    # capacity errors are expected here and would bury the report
+    logger.setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+
+    metrics = run(args)
+    baseline = None
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)['metrics']
+    regressions = report(metrics, baseline, args.threshold)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({'config': vars(args), 'metrics': metrics}, f, indent=2)
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,104 @@
+# Throughput and latency of the load-balancing proxy over local copies of
+# examples/simple_backend, one of which is slowed down to show how
+# least-outstanding-requests routes around it compared to random picking.
+#
+#   python benchmarks/proxy_bench.py [requests] [concurrency]
+
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+from bidding import percentile
+from load_balancer import LoadBalancer
+from state_backends import JsonStateBackend
+from state_manager import StateManager
+
+spec = importlib.util.spec_from_file_location('simple_backend', os.path.join(ROOT, 'examples', 'simple_backend', 'app.py'))
+simple_backend = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(simple_backend)
+SimpleHTTPRequestHandler = simple_backend.SimpleHTTPRequestHandler
+
+BACKENDS = 4
+SLOW_DELAY = 0.05
+
+class SlowHandler(SimpleHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(SLOW_DELAY)
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def start_backends():
+    servers = []
+    for n in range(BACKENDS):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler if n == 0 else QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+def make_balancer(servers, tmp):
+    state_manager = StateManager(backend=JsonStateBackend(os.path.join(tmp, 'state.json')))
+    state_manager.add_app('bench', 'example.dkr.ecr.us-east-1.amazonaws.com/bench')
+    state_manager.add_instances('bench', [
+        {'id': f"i-{n}", 'ip': f"127.0.0.1:{server.server_address[1]}", 'name': f"bench-{n}",
+         'spot_price': 0.005, 'time_now': time.time()}
+        for n, server in enumerate(servers)
+    ])
+    return LoadBalancer(state_manager, interval=0)
+
+def run(balancer, total, concurrency):
+    def one(_):
+        start = time.perf_counter()
+        upstream, release = balancer.forward('bench', 'GET', '/', b'', {}, b'')
+        upstream.raw.read()
+        release()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(one, range(total)))
+    return total / (time.perf_counter() - start), latencies
+
+def random_pick(balancer):
+    # baseline: same proxy, but ignore how busy each instance is
+    def pick(app_name, exclude=None):
+        with balancer.lock:
+            backend = random.choice([b for b in balancer.backends[app_name].values() if b.healthy])
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+    balancer.pick = pick
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    servers = start_backends()
+    print(f"{BACKENDS} simple_backend instances, one delayed by {SLOW_DELAY * 1000:.0f}ms; "
+          f"{total} requests at concurrency {concurrency}")
+    print(f"{'policy':>20} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'slow share':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ('random', 'least-outstanding'):
+            balancer = make_balancer(servers, tmp)
+            balancer.check(balancer.sync())
+            if name == 'random':
+                random_pick(balancer)
+            throughput, latencies = run(balancer, total, concurrency)
+            slow_share = balancer.backends['bench']['i-0'].requests / total
+            print(f"{name:>20} {throughput:>8.0f} {percentile(latencies, 50) * 1000:>8.2f} "
+                  f"{percentile(latencies, 99) * 1000:>8.2f} {slow_share:>10.1%}")
+    for server in servers:
+        server.shutdown()
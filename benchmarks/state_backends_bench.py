@@ -0,0 +1,38 @@
+# Write latency of StateManager mutations on the JSON and SQLite backends
+# as the number of tracked instances grows.
+#
+#   python benchmarks/state_backends_bench.py [writes]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from state_backends import JsonStateBackend, SqliteStateBackend
+from state_manager import StateManager
+
+SIZES = [10, 1000, 10000]
+
+def make_instance(n):
+    return {'id': f"i-{n:017x}", 'ip': '10.0.0.1', 'name': f"bench-{n}", 'spot_price': 0.005, 'time_now': time.time()}
+
+def bench(backend, size, writes):
+    state_manager = StateManager(backend=backend)
+    state_manager.add_app('bench', 'example.dkr.ecr.us-east-1.amazonaws.com/bench')
+    state_manager.add_instances('bench', [make_instance(n) for n in range(size)])
+    start = time.perf_counter()
+    for n in range(size, size + writes):
+        state_manager.add_instance('bench', make_instance(n))
+        state_manager.save_env_vars('bench', {'WRITE': str(n)})
+    return (time.perf_counter() - start) / (writes * 2)
+
+if __name__ == '__main__':
+    writes = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print(f"{'instances':>10} {'json ms/write':>14} {'sqlite ms/write':>16}")
+    for size in SIZES:
+        with tempfile.TemporaryDirectory() as tmp:
+            json_latency = bench(JsonStateBackend(os.path.join(tmp, 'state.json')), size, writes)
+            sqlite_latency = bench(SqliteStateBackend(os.path.join(tmp, 'state.db')), size, writes)
+        print(f"{size:>10} {json_latency * 1000:>14.3f} {sqlite_latency * 1000:>16.3f}")
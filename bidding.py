@@ -0,0 +1,128 @@
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from aws_clients import get_client
+from logging_config import logger
+from regions import home_region
+
+DEFAULT_BID = 0.005  # used when there is no price history to go on
+MIN_BID_INCREMENT = 0.001
+
+def percentile(values: List[float], pct: float) -> float:
+    # nearest-rank percentile, good enough for a few hundred price points
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+def compute_bid(prices: List[float], pct: float = 90, margin: float = 0.1, max_bid: Optional[float] = None) -> float:
+    if not prices:
+        bid = DEFAULT_BID
+    else:
+        bid = percentile(prices, pct) * (1 + margin)
+    if max_bid is not None:
+        bid = min(bid, max_bid)
+    return round(bid, 4)
+
+def escalate_bid(bid: float, prices: List[float], step: float = 0.2, max_bid: Optional[float] = None) -> float:
+    # jump straight past the highest recent price rather than creeping up by a tenth of a cent
+    next_bid = max(bid * (1 + step), bid + MIN_BID_INCREMENT)
+    if prices:
+        next_bid = max(next_bid, max(prices) * (1 + step))
+    if max_bid is not None:
+        next_bid = min(next_bid, max_bid)
+    return round(next_bid, 4)
+
+class SpotPriceHistory:
+    def __init__(self, ttl: Optional[float] = None, lookback_hours: Optional[float] = None):
+        self.ttl = ttl if ttl is not None else float(os.environ.get('SPOTTY_PRICE_HISTORY_TTL', 300))
+        self.lookback_hours = lookback_hours if lookback_hours is not None else float(os.environ.get('SPOTTY_PRICE_LOOKBACK_HOURS', 6))
+        # (region, instance type) -> (fetched at, history)
+        self.cache: Dict[Tuple[str, str], Tuple[float, List[Dict[str, Any]]]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, instance_type: str, ec2_client=None, region: Optional[str] = None) -> List[Dict[str, Any]]:
+        key = (region or home_region(), instance_type)
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached and time.time() - cached[0] < self.ttl:
+                return cached[1]
+        try:
+            history = self.fetch(instance_type, ec2_client, region)
+        except Exception as e:
+            logger.exception(f"Error fetching spot price history for {instance_type} in {key[0]}: {str(e)}")
+            # a stale history still beats bidding blind
+            return cached[1] if cached else []
+        self.set(instance_type, history, region)
+        return history
+
+    def set(self, instance_type: str, history: List[Dict[str, Any]], region: Optional[str] = None):
+        with self.lock:
+            self.cache[(region or home_region(), instance_type)] = (time.time(), history)
+
+    def fetch(self, instance_type: str, ec2_client=None, region: Optional[str] = None) -> List[Dict[str, Any]]:
+        ec2_client = ec2_client or get_client('ec2', region)
+        paginator = ec2_client.get_paginator('describe_spot_price_history')
+        start_time = datetime.now(timezone.utc) - timedelta(hours=self.lookback_hours)
+        history = []
+        for page in paginator.paginate(InstanceTypes=[instance_type],
+                                       ProductDescriptions=['Linux/UNIX'],
+                                       StartTime=start_time):
+            for entry in page['SpotPriceHistory']:
+                history.append({
+                    'az': entry['AvailabilityZone'],
+                    'price': float(entry['SpotPrice']),
+                    'timestamp': entry['Timestamp'].timestamp()
+                })
+        logger.info(f"Fetched {len(history)} spot price points for {instance_type} in {region or home_region()}")
+        return history
+
+    def latest(self, instance_type: str, az: Optional[str] = None, region: Optional[str] = None) -> Optional[float]:
+        # current market price from the cache only, so it is safe to call under the state lock;
+        # without an az it is the mean of each zone's latest price
+        with self.lock:
+            cached = self.cache.get((region or home_region(), instance_type))
+        if not cached:
+            return None
+        latest: Dict[str, Tuple[float, float]] = {}
+        for entry in cached[1]:
+            if (az is None or entry['az'] == az) and entry['timestamp'] >= latest.get(entry['az'], (0, 0))[0]:
+                latest[entry['az']] = (entry['timestamp'], entry['price'])
+        if not latest:
+            return None
+        return sum(price for _, price in latest.values()) / len(latest)
+
+    def prices(self, instance_type: str, az: Optional[str] = None, ec2_client=None,
+               region: Optional[str] = None) -> List[float]:
+        return [entry['price'] for entry in self.get(instance_type, ec2_client, region) if az is None or entry['az'] == az]
+
+    def prices_by_az(self, instance_type: str, ec2_client=None, region: Optional[str] = None) -> Dict[str, List[float]]:
+        by_az: Dict[str, List[float]] = {}
+        for entry in self.get(instance_type, ec2_client, region):
+            by_az.setdefault(entry['az'], []).append(entry['price'])
+        return by_az
+
+class BidPlanner:
+    def __init__(self, price_history: SpotPriceHistory):
+        self.price_history = price_history
+        self.pct = float(os.environ.get('SPOTTY_BID_PERCENTILE', 90))
+        self.margin = float(os.environ.get('SPOTTY_BID_MARGIN', 0.1))
+        self.step = float(os.environ.get('SPOTTY_BID_STEP', 0.2))
+        max_bid = os.environ.get('SPOTTY_MAX_BID')
+        self.max_bid = float(max_bid) if max_bid else None
+
+    def opening_bid(self, instance_type: str, az: Optional[str] = None, ec2_client=None,
+                    region: Optional[str] = None) -> float:
+        prices = self.price_history.prices(instance_type, az, ec2_client, region)
+        bid = compute_bid(prices, self.pct, self.margin, self.max_bid)
+        logger.info(f"Opening bid for {instance_type}: ${bid:.4f} (p{self.pct:g} of {len(prices)} recent prices + {self.margin:.0%})")
+        return bid
+
+    def next_bid(self, bid: float, instance_type: str, az: Optional[str] = None, ec2_client=None,
+                 region: Optional[str] = None) -> float:
+        return escalate_bid(bid, self.price_history.prices(instance_type, az, ec2_client, region), self.step, self.max_bid)
+
+price_history = SpotPriceHistory()
+bid_planner = BidPlanner(price_history)
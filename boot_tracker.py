@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+import requests
+from aws_clients import get_client
+from logging_config import logger
+from regions import group_by_region
+from state_manager import StateManager
+from tracing import observe_boot
+
+PHASE_TAG_PREFIX = 'spotty:phase:'
+FILTER_BATCH_SIZE = 200
+
+class BootTracker:
+    def __init__(self, state_manager: StateManager, interval: Optional[float] = None,
+                 timeout: float = 2, give_up_after: float = 1800):
+        self.state_manager = state_manager
+        self.interval = interval if interval is not None else float(os.environ.get('SPOTTY_BOOT_TRACKER_INTERVAL', 10))
+        self.timeout = timeout
+        self.give_up_after = give_up_after
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='boot-tracker')
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='boot-tracker', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.collect()
+            except Exception as e:
+                logger.exception(f"Error collecting boot timings: {str(e)}")
+
+    def is_healthy(self, ip: str) -> bool:
+        # any answer from the app container counts as serving
+        try:
+            return self.session.get(f"http://{ip}/", timeout=self.timeout).status_code < 500
+        except requests.RequestException:
+            return False
+
+    def boot_phases(self, instance_ids: List[str], region: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        ec2_client = get_client('ec2', region)
+        phases = {}
+        for i in range(0, len(instance_ids), FILTER_BATCH_SIZE):
+            paginator = ec2_client.get_paginator('describe_instances')
+            for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': instance_ids[i:i + FILTER_BATCH_SIZE]}]):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        boot = {
+                            tag['Key'][len(PHASE_TAG_PREFIX):]: float(tag['Value'])
+                            for tag in instance.get('Tags', [])
+                            if tag['Key'].startswith(PHASE_TAG_PREFIX)
+                        }
+                        phases[instance['InstanceId']] = {'launched': instance['LaunchTime'].timestamp(), 'boot': boot}
+        return phases
+
+    def collect(self):
+        now = time.time()
+        pending: List[Tuple[str, Dict[str, Any]]] = [
+            (app_name, instance)
+            for app_name, app in self.state_manager.get_apps().items()
+            for instance in app['instances']
+            if instance.get('ip') and 'trace' in instance and not instance['trace'].get('boot')
+            and now - instance['time_now'] < self.give_up_after
+        ]
+        if not pending:
+            return
+
+        unhealthy = [(app_name, instance) for app_name, instance in pending if not instance['trace'].get('healthy_at')]
+        for (app_name, instance), healthy in zip(unhealthy, self.executor.map(lambda p: self.is_healthy(p[1]['ip']), unhealthy)):
+            if healthy:
+                self.state_manager.update_instance(app_name, instance['id'], trace={**instance['trace'], 'healthy_at': now})
+
+        # the instance tags its boot phases once its containers are up
+        ready = [(app_name, instance) for app_name, instance in pending if instance['trace'].get('healthy_at')]
+        if not ready:
+            return
+        phases = {}
+        for region, instances in group_by_region(instance for _, instance in ready).items():
+            phases.update(self.boot_phases([instance['id'] for instance in instances], region))
+        for app_name, instance in ready:
+            observed = phases.get(instance['id'])
+            if observed and observed['boot']:
+                trace = {**instance['trace'], **observed}
+                self.state_manager.update_instance(app_name, instance['id'], trace=trace)
+                observe_boot(trace)
@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+# `spotty` command line. Reads (apps, status, costs) come straight from the state store through
+# the shared StateManager; scaling goes through the running server, which owns provisioning and
+# is the only process that writes the state. Heavy modules (boto3, Flask, requests) are imported
+# inside the commands that need them, so read commands start fast.
+#
+#   ./spotty status [app]        ./spotty scale-up my-app --count 2 --wait
+
+SERVER_URL = os.environ.get('SPOTTY_URL', 'http://localhost:8090')
+
+def state():
+    # costs of instances without a price segment yet are worked out in memory, never written back
+    from state_manager import shared_state_manager
+    return shared_state_manager(read_only=True)
+
+def api(path: str, data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+    body = urlencode(data).encode() if data is not None else None
+    try:
+        with urlopen(f"{SERVER_URL}{path}", data=body, timeout=30) as response:
+            return json.load(response)
+    except HTTPError as e:
+        try:
+            error = json.load(e).get('error')
+        except ValueError:
+            error = None
+        raise SystemExit(f"spotty: {error or e}")
+    except URLError as e:
+        raise SystemExit(f"spotty: can't reach the Spotty server at {SERVER_URL} ({e.reason}); is it running?")
+
+def wait_for(job: Dict[str, Any]) -> int:
+    # follows a job until it is done, printing each status it moves through
+    from jobs import JOB_FAILED
+    status = None
+    while True:
+        if job['status'] != status:
+            status = job['status']
+            print(f"{job['id']}: {status}" + (f" ({job['error']})" if job.get('error') else ''))
+        if job['done']:
+            return 1 if job.get('error') or job['status'] == JOB_FAILED else 0
+        time.sleep(1)
+        job = api(f"/jobs/{job['id']}")
+
+def dollars(amount: float) -> str:
+    return f"${amount:.4f}" if amount < 1 else f"${amount:,.2f}"
+
+def age(since: float) -> str:
+    seconds = int(time.time() - since)
+    if seconds < 3600:
+        return f"{seconds // 60}m"
+    if seconds < 86400:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 86400}d{seconds % 86400 // 3600:02d}h"
+
+def table(rows: List[List[str]]):
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+def cmd_apps(args) -> int:
+    state_manager = state()
+    apps = state_manager.get_apps()
+    if args.json:
+        print(json.dumps({name: {'instances': len(app['instances']), 'target_replicas': state_manager.get_target_replicas(name),
+                                 'placement': app.get('placement', 'dedicated'), 'ecr_image_uri': app['ecr_image_uri']}
+                          for name, app in apps.items()}, indent=2))
+        return 0
+    if not apps:
+        print("No apps")
+        return 0
+    rows = [['APP', 'INSTANCES', 'TARGET', 'PLACEMENT', 'IMAGE']]
+    for name, app in sorted(apps.items()):
+        rows.append([name, str(len(app['instances'])), str(state_manager.get_target_replicas(name)),
+                     app.get('placement', 'dedicated'), app['ecr_image_uri']])
+    table(rows)
+    return 0
+
+def cmd_status(args) -> int:
+    state_manager = state()
+    apps = state_manager.get_apps()
+    if args.app and args.app not in apps:
+        raise SystemExit(f"spotty: app '{args.app}' not found")
+    names = [args.app] if args.app else sorted(apps)
+    if args.json:
+        print(json.dumps({name: apps[name]['instances'] for name in names}, indent=2, default=str))
+        return 0
+    for name in names:
+        app = apps[name]
+        print(f"{name}: {len(app['instances'])}/{state_manager.get_target_replicas(name)} instances, "
+              f"{dollars(state_manager.get_cost_rate(name))}/h")
+        if app['instances']:
+            rows = [['  ID', 'NAME', 'TYPE', 'AZ', 'IP', 'PRICE/H', 'AGE', 'FLAGS']]
+            for instance in sorted(app['instances'], key=lambda i: i['time_now']):
+                flags = ['interrupted'] if instance.get('interrupted') else []
+                if instance.get('host_id'):
+                    flags.append(f"on {instance['host_id']}")
+                rows.append(['  ' + instance['id'], instance.get('name', ''), instance.get('instance_type') or '-',
+                             instance.get('az') or '-', instance.get('ip') or '-',
+                             dollars(instance.get('market_price', instance.get('spot_price', 0))),
+                             age(instance['time_now']), ', '.join(flags)])
+            table(rows)
+    print(f"total: {sum(len(apps[name]['instances']) for name in names)} instances, "
+          f"{dollars(state_manager.get_cost_rate(args.app))}/h, {dollars(state_manager.get_spend(args.app))} spent")
+    return 0
+
+def cmd_costs(args) -> int:
+    state_manager = state()
+    if args.app and not state_manager.get_app(args.app):
+        raise SystemExit(f"spotty: app '{args.app}' not found")
+    until = time.time()
+    since = until - args.days * 86400
+    names = [args.app] if args.app else sorted(state_manager.get_apps())
+    summaries = {name: state_manager.get_cost_summary(name, since, until) for name in names}
+    total = state_manager.get_cost_summary(args.app, since, until)
+    hourly = state_manager.get_hourly_costs(args.app, since, until) if args.hourly else []
+    if args.json:
+        print(json.dumps({'since': since, 'until': until, 'apps': summaries, 'total': total,
+                          **({'hourly': [{'hour': hour, 'cost': cost} for hour, cost in hourly]} if args.hourly else {})},
+                         indent=2))
+        return 0
+    rows = [['APP', 'PER HOUR', f'LAST {args.days:g}D', 'ALL TIME']]
+    for name, summary in summaries.items():
+        rows.append([name, dollars(summary['cost_per_hour']), dollars(summary['window_spend']), dollars(summary['spend'])])
+    if not args.app:
+        rows.append(['total', dollars(total['cost_per_hour']), dollars(total['window_spend']), dollars(total['spend'])])
+    table(rows)
+    if hourly:
+        print()
+        table([['HOUR', 'COST']] + [[time.strftime('%Y-%m-%d %H:%M', time.localtime(hour)), dollars(cost)]
+                                    for hour, cost in hourly if cost])
+    return 0
+
+def cmd_add_app(args) -> int:
+    api('/add_app', {'app_name': args.app, 'ecr_uri': args.ecr_uri})
+    print(f"Added {args.app}")
+    return 0
+
+def cmd_scale_up(args) -> int:
+    job = api(f"/scale_up/{args.app}?count={args.count}")
+    print(f"Scaling {args.app} up by {args.count}: job {job['job_id']} ({', '.join(job['instance_names'])})")
+    return wait_for(api(f"/jobs/{job['job_id']}")) if args.wait else 0
+
+def cmd_scale_down(args) -> int:
+    from urllib.parse import urlencode
+    query = {'count': args.count, **({'policy': args.policy} if args.policy else {}),
+             **({'grace': args.grace} if args.grace is not None else {})}
+    job = api(f"/scale_down/{args.app}?{urlencode(query)}")
+    print(f"Scaling {args.app} down: job {job['job_id']} ({', '.join(job['instance_ids'])})")
+    return wait_for(api(f"/jobs/{job['job_id']}")) if args.wait else 0
+
+def cmd_cleanup(args) -> int:
+    import dotenv
+    dotenv.load_dotenv('.env')
+    from aws_utils import check_spot_quotas, cleanup_spot_requests
+    cleanup_spot_requests()
+    usage, quota = check_spot_quotas()
+    print(f"Spot vCPU usage: {usage}, quota: {quota}")
+    return 0
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='spotty', description='Manage apps running on Spotty spot instances.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    apps = commands.add_parser('apps', help='list apps')
+    apps.add_argument('--json', action='store_true')
+    apps.set_defaults(run=cmd_apps)
+
+    status = commands.add_parser('status', help='instances and running cost, for one app or all of them')
+    status.add_argument('app', nargs='?')
+    status.add_argument('--json', action='store_true')
+    status.set_defaults(run=cmd_status)
+
+    costs = commands.add_parser('costs', help='spend per app from the cost ledger')
+    costs.add_argument('app', nargs='?')
+    costs.add_argument('--days', type=float, default=7, help='window to report spend over (default 7)')
+    costs.add_argument('--hourly', action='store_true', help='break the window down by hour')
+    costs.add_argument('--json', action='store_true')
+    costs.set_defaults(run=cmd_costs)
+
+    add_app = commands.add_parser('add-app', help='register an app (through the server)')
+    add_app.add_argument('app')
+    add_app.add_argument('ecr_uri')
+    add_app.set_defaults(run=cmd_add_app)
+
+    scale_up = commands.add_parser('scale-up', help='launch instances for an app (through the server)')
+    scale_up.add_argument('app')
+    scale_up.add_argument('--count', type=int, default=1)
+    scale_up.add_argument('--wait', action='store_true', help='follow the job until it is done')
+    scale_up.set_defaults(run=cmd_scale_up)
+
+    scale_down = commands.add_parser('scale-down', help='drain and terminate instances of an app (through the server)')
+    scale_down.add_argument('app')
+    scale_down.add_argument('--count', default='1', help="number of instances, or 'all'")
+    scale_down.add_argument('--policy', help='newest, expensive or unhealthiest')
+    scale_down.add_argument('--grace', type=float, help='seconds to let in-flight requests finish')
+    scale_down.add_argument('--wait', action='store_true', help='follow the job until it is done')
+    scale_down.set_defaults(run=cmd_scale_down)
+
+    cleanup = commands.add_parser('cleanup', help='cancel open spot requests and show quota usage')
+    cleanup.set_defaults(run=cmd_cleanup)
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parser().parse_args(argv)
+    return args.run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
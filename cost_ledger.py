@@ -0,0 +1,161 @@
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+HOUR = 3600
+TOTAL = '*'  # the account every charge also lands in
+
+def hour_of(ts: float) -> int:
+    return int(ts // HOUR * HOUR)
+
+def new_account(at: float) -> Dict[str, Any]:
+    return {'settled': 0.0, 'settled_at': at, 'rate': 0.0, 'hours': {}}
+
+def bucket_of(hour: int, bucket: Any) -> List[float]:
+    # [cost, billed_from, billed_to]; buckets stored before they kept their billed span cover the whole hour
+    if isinstance(bucket, (int, float)):
+        return [float(bucket), float(hour), float(hour + HOUR)]
+    cost, billed_from, billed_to = bucket
+    return [cost, hour if billed_from is None else billed_from, hour + HOUR if billed_to is None else billed_to]
+
+class CostLedger:
+    # Running spend per app plus a TOTAL account. An account holds the dollars settled up to
+    # settled_at and the summed $/hour of everything billing since, so reading spend is O(1).
+    # Settling spreads the dollars over hourly buckets, which answer time-window queries. A bucket
+    # keeps the part of its hour that was billed, so a window cutting it shares the cost over that part only.
+    # Instances carry their own open price segment: market_price since priced_at, with
+    # accrued_cost holding what their earlier segments came to.
+    def __init__(self, costs: Dict[str, Any], retention_hours: Optional[int] = None):
+        self.accounts: Dict[str, Dict[str, Any]] = costs.setdefault('accounts', {})
+        for account in self.accounts.values():
+            account['hours'] = {int(hour): bucket_of(int(hour), bucket) for hour, bucket in account.get('hours', {}).items()}
+            account['rate'] = 0.0  # rebuilt from the open instances by resume()
+        self.retention = retention_hours or int(float(os.environ.get('SPOTTY_COST_RETENTION_DAYS', 90)) * 24)
+        self.touched: set = set()  # (account, hour) buckets changed since the last flush()
+
+    def account(self, key: str, at: float) -> Dict[str, Any]:
+        account = self.accounts.get(key)
+        if account is None:
+            account = self.accounts[key] = new_account(at)
+        return account
+
+    def book(self, key: str, cost: float, start: float, end: float):
+        # adds cost billed over [start, end), all within one hour, to that hour's bucket
+        hour = hour_of(start)
+        bucket = self.account(key, start)['hours'].get(hour)
+        if bucket is None:
+            self.accounts[key]['hours'][hour] = [cost, start, end]
+        else:
+            bucket[0] += cost
+            bucket[1], bucket[2] = min(bucket[1], start), max(bucket[2], end)
+        self.touched.add((key, hour))
+
+    def spread(self, key: str, rate: float, start: float, end: float):
+        # books rate $/hour over [start, end) into the account's hourly buckets
+        account = self.account(key, start)
+        t = start
+        while t < end:
+            edge = min(end, hour_of(t) + HOUR)
+            self.book(key, rate * (edge - t) / HOUR, t, edge)
+            t = edge
+        account['settled'] += rate * max(0.0, end - start) / HOUR
+
+    def settle(self, key: str, at: float):
+        account = self.account(key, at)
+        if at <= account['settled_at']:
+            return
+        if account['rate']:
+            self.spread(key, account['rate'], account['settled_at'], at)
+        account['settled_at'] = at
+        if len(account['hours']) > self.retention + 24:
+            cutoff = self.cutoff(at)
+            for hour in [hour for hour in account['hours'] if hour < cutoff]:
+                del account['hours'][hour]
+
+    def adjust(self, app_name: str, delta: float, at: float):
+        for key in (app_name, TOTAL):
+            self.settle(key, at)
+            account = self.accounts[key]
+            account['rate'] = max(0.0, account['rate'] + delta)  # don't let float drift go negative
+
+    def resume(self, app_name: str, instance: Dict[str, Any]):
+        # an instance that was already billing when the state was loaded
+        for key in (app_name, TOTAL):
+            self.account(key, instance['priced_at'])['rate'] += instance['market_price']
+
+    def open(self, app_name: str, instance: Dict[str, Any], price: float, at: float):
+        # starts billing an instance; the time since its launch is charged at the same price
+        launched = min(instance.get('time_now', at), at)
+        for key in (app_name, TOTAL):
+            self.spread(key, price, launched, at)
+        instance.update(market_price=price, priced_at=at, accrued_cost=price * (at - launched) / HOUR)
+        self.adjust(app_name, price, at)
+
+    def reprice(self, app_name: str, instance: Dict[str, Any], price: float, at: float):
+        old = instance['market_price']
+        instance['accrued_cost'] += old * max(0.0, at - instance['priced_at']) / HOUR
+        instance['market_price'], instance['priced_at'] = price, at
+        self.adjust(app_name, price - old, at)
+
+    def close(self, app_name: str, instance: Dict[str, Any], at: float) -> float:
+        # stops billing an instance and returns what it cost over its whole life
+        if 'priced_at' not in instance:
+            self.open(app_name, instance, instance['spot_price'], at)
+        cost = instance['accrued_cost'] + instance['market_price'] * max(0.0, at - instance['priced_at']) / HOUR
+        self.adjust(app_name, -instance['market_price'], at)
+        return cost
+
+    def charge(self, app_name: Optional[str], cost: float, at: float):
+        # a lump sum, such as the part of a host no replica paid for
+        for key in filter(None, (app_name, TOTAL)):
+            self.book(key, cost, at, at)
+            self.accounts[key]['settled'] += cost
+
+    def spend(self, key: str = TOTAL, at: Optional[float] = None) -> float:
+        account = self.accounts.get(key)
+        if account is None:
+            return 0.0
+        at = at or time.time()
+        return account['settled'] + account['rate'] * max(0.0, at - account['settled_at']) / HOUR
+
+    def rate(self, key: str = TOTAL) -> float:
+        account = self.accounts.get(key)
+        return account['rate'] if account else 0.0
+
+    def window(self, key: str, start: float, end: float, at: Optional[float] = None) -> float:
+        # spend in [start, end): whole buckets plus a pro rata share of the ones cut by the window
+        account = self.accounts.get(key)
+        if account is None:
+            return 0.0
+        at = at or time.time()
+        settled_at, hours = account['settled_at'], account['hours']
+        total = 0.0
+        first = hour_of(start)
+        # walk the window hour by hour, or the buckets themselves when there are fewer of them
+        candidates = range(first, int(end), HOUR) if (end - first) / HOUR <= len(hours) else \
+            [hour for hour in hours if first <= hour < end]
+        for hour in candidates:
+            bucket = hours.get(hour)
+            if bucket:
+                # the cost is shared over the part of the hour that was billed, not the whole hour
+                cost, billed_from, billed_to = bucket
+                if billed_to > billed_from:
+                    overlap = min(end, billed_to) - max(start, billed_from)
+                    if overlap > 0:
+                        total += cost * overlap / (billed_to - billed_from)
+                elif start <= billed_from < end:
+                    total += cost  # a lump sum
+        unsettled = min(end, at) - max(start, settled_at)
+        if unsettled > 0:
+            total += account['rate'] * unsettled / HOUR
+        return total
+
+    def hourly(self, key: str, start: float, end: float, at: Optional[float] = None) -> List[Tuple[int, float]]:
+        return [(hour, self.window(key, hour, hour + HOUR, at)) for hour in range(hour_of(start), int(end), HOUR)]
+
+    def cutoff(self, at: float) -> int:
+        return hour_of(at) - self.retention * HOUR
+
+    def flush(self) -> List[Tuple[str, int]]:
+        touched, self.touched = sorted(self.touched), set()
+        return touched
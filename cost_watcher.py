@@ -0,0 +1,44 @@
+import os
+import threading
+from typing import Optional
+from logging_config import logger
+from regions import region_of
+
+class CostWatcher:
+    # keeps the price cache warm for the instance types in use and moves running instances
+    # onto the current market price; a price change is picked up within one interval
+    def __init__(self, state_manager, price_history, interval: Optional[float] = None):
+        self.state_manager = state_manager
+        self.price_history = price_history
+        self.interval = interval if interval is not None else float(os.environ.get('SPOTTY_COST_INTERVAL', 300))
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='cost-watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.exception(f"Error repricing instances: {str(e)}")
+
+    def refresh(self):
+        # prices are regional, so the cache is warmed per (instance type, region); warm pool
+        # standbys are billed too, so their types count as in use alongside the replicas
+        in_use = {(instance['instance_type'], region_of(instance)) for app in self.state_manager.get_apps().values()
+                  for instance in app['instances'] + app.get('standby', []) if instance.get('instance_type')}
+        in_use |= {(host['instance_type'], region_of(host)) for host in self.state_manager.get_hosts().values()
+                   if host.get('instance_type')}
+        for instance_type, region in in_use:
+            self.price_history.get(instance_type, region=region)  # fetched outside the state lock, cached for reprice()
+        repriced = self.state_manager.reprice()
+        if repriced:
+            logger.info(f"Moved {repriced} instance(s) to a new spot market price")
@@ -0,0 +1,101 @@
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+import requests
+from ec2_spot import start_containers_script
+from jobs import JOB_FAILED
+from logging_config import logger
+from regions import group_by_region
+from ssm_commands import run_commands
+from state_manager import StateManager
+
+JOB_DEPLOYING = 'deploying'
+JOB_ROLLING_BACK = 'rolling-back'
+
+class DeployError(Exception):
+    pass
+
+class RollingDeployer:
+    def __init__(self, state_manager: StateManager, batch_size: Optional[int] = None,
+                 health_timeout: Optional[float] = None):
+        self.state_manager = state_manager
+        self.batch_size = batch_size or int(os.environ.get('SPOTTY_DEPLOY_BATCH_SIZE', 1))
+        self.health_timeout = health_timeout if health_timeout is not None else float(os.environ.get('SPOTTY_DEPLOY_HEALTH_TIMEOUT', 60))
+        self.command_timeout = float(os.environ.get('SPOTTY_DEPLOY_COMMAND_TIMEOUT', 300))
+        self.drain = float(os.environ.get('SPOTTY_DEPLOY_DRAIN_SECONDS', 5))
+        self.session = requests.Session()
+
+    def wait_healthy(self, ip: str) -> bool:
+        deadline = time.time() + self.health_timeout
+        while time.time() < deadline:
+            try:
+                if self.session.get(f"http://{ip}/", timeout=2).status_code < 500:
+                    return True
+            except requests.RequestException:
+                pass
+            time.sleep(2)
+        return False
+
+    def swap(self, app_name: str, instances: List[Dict[str, Any]], ecr_image_uri: str,
+             env_vars: Dict[str, str]) -> List[Dict[str, Any]]:
+        # swaps the containers on a batch in place; returns the instances that came back healthy
+        for instance in instances:
+            self.state_manager.update_instance(app_name, instance['id'], deploying=True)
+        try:
+            # give the proxy a health-check round to stop routing to the batch
+            time.sleep(self.drain)
+            # SSM is regional, so a batch spread over regions takes one command per region
+            statuses = {}
+            for region, regional in group_by_region(instances).items():
+                try:
+                    statuses.update(run_commands([instance['id'] for instance in regional],
+                                                 start_containers_script(ecr_image_uri, env_vars, pull=True, replace=True),
+                                                 timeout=self.command_timeout, comment=f"spotty deploy {app_name}",
+                                                 region=region))
+                except Exception as e:
+                    logger.error(f"Error running deploy commands on {app_name} in {region}: {str(e)}")
+            healthy = [instance for instance in instances
+                       if statuses.get(instance['id']) == 'Success' and self.wait_healthy(instance['ip'])]
+        finally:
+            for instance in instances:
+                self.state_manager.update_instance(app_name, instance['id'], deploying=False)
+        for instance in healthy:
+            self.state_manager.update_instance(app_name, instance['id'], ecr_image_uri=ecr_image_uri, deployed_at=time.time())
+        return healthy
+
+    def deploy(self, app_name: str, ecr_image_uri: str, progress: Callable[..., None],
+               batch_size: Optional[int] = None) -> Dict[str, Any]:
+        batch_size = batch_size or self.batch_size
+        previous_uri = self.state_manager.get_ecr_image_uri(app_name)
+        env_vars = self.state_manager.get_env_vars(app_name)
+        # new launches (including replacements during the rollout) already use the new image;
+        # packed replicas are not swapped in place and pick it up as they are replaced
+        self.state_manager.update_ecr_uri(app_name, ecr_image_uri)
+        instances = [instance for instance in self.state_manager.get_instances(app_name)
+                     if instance.get('ip') and not instance.get('host_id') and instance.get('ecr_image_uri') != ecr_image_uri]
+        updated: List[Dict[str, Any]] = []
+        for i in range(0, len(instances), batch_size):
+            batch = instances[i:i + batch_size]
+            progress(JOB_DEPLOYING, instance_ids=[instance['id'] for instance in batch], completed=len(updated), total=len(instances))
+            healthy = self.swap(app_name, batch, ecr_image_uri, env_vars)
+            updated.extend(healthy)
+            if len(healthy) < len(batch):
+                healthy_ids = {instance['id'] for instance in healthy}
+                failed = [instance for instance in batch if instance['id'] not in healthy_ids]
+                failed_ids = [instance['id'] for instance in failed]
+                logger.error(f"Deploy of {ecr_image_uri} to {app_name} failed on {failed_ids}, rolling back")
+                self.rollback(app_name, updated + failed, previous_uri, env_vars, progress)
+                raise DeployError(f"Instances {failed_ids} did not come back healthy on {ecr_image_uri}; rolled back to {previous_uri}")
+        logger.info(f"Deployed {ecr_image_uri} to {len(updated)} instance(s) of {app_name}")
+        return {'ecr_image_uri': ecr_image_uri, 'previous_ecr_image_uri': previous_uri,
+                'instance_ids': [instance['id'] for instance in updated]}
+
+    def rollback(self, app_name: str, instances: List[Dict[str, Any]], previous_uri: str,
+                 env_vars: Dict[str, str], progress: Callable[..., None]):
+        progress(JOB_ROLLING_BACK, instance_ids=[instance['id'] for instance in instances])
+        self.state_manager.update_ecr_uri(app_name, previous_uri)
+        restored = self.swap(app_name, instances, previous_uri, env_vars) if instances else []
+        if len(restored) < len(instances):
+            restored_ids = {instance['id'] for instance in restored}
+            lost = [instance['id'] for instance in instances if instance['id'] not in restored_ids]
+            progress(JOB_FAILED, error=f"Rollback left {lost} unhealthy")
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from ec2_spot import cancel_spot_requests, terminate_instances
+from instance_stats import StatsFetcher
+from jobs import JOB_FAILED
+from load_balancer import LoadBalancer
+from logging_config import logger
+from placement import PlacementEngine
+from regions import group_by_region
+from state_manager import StateManager
+
+JOB_DRAINING = 'draining'
+JOB_TERMINATING = 'terminating'
+JOB_TERMINATED = 'terminated'
+
+def health_rank(instance: Dict[str, Any], backends: Dict[str, Dict[str, Any]]):
+    backend = backends.get(instance['id'], {})
+    return (not backend.get('healthy', False), backend.get('failures', 0), instance['time_now'])
+
+# each key sorts the instances to give up first to the end; interrupted instances always go first
+VICTIM_POLICIES: Dict[str, Callable[[Dict[str, Any], Dict[str, Dict[str, Any]]], Any]] = {
+    'newest': lambda instance, backends: instance['time_now'],
+    'expensive': lambda instance, backends: (instance.get('spot_price', 0), instance['time_now']),
+    'unhealthiest': health_rank
+}
+
+def choose_victims(instances: List[Dict[str, Any]], count: int, policy: str,
+                   backends: Optional[Dict[str, Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    key = VICTIM_POLICIES[policy]
+    ranked = sorted(instances, key=lambda i: (bool(i.get('interrupted')), key(i, backends or {})), reverse=True)
+    return ranked[:count]
+
+class Drainer:
+    def __init__(self, state_manager: StateManager, load_balancer: LoadBalancer, placement: PlacementEngine,
+                 stats_fetcher: StatsFetcher, grace: Optional[float] = None):
+        self.state_manager = state_manager
+        self.load_balancer = load_balancer
+        self.placement = placement
+        self.stats_fetcher = stats_fetcher
+        self.grace = grace if grace is not None else float(os.environ.get('SPOTTY_DRAIN_GRACE', 30))
+        self.default_policy = os.environ.get('SPOTTY_SCALE_DOWN_POLICY', 'newest')
+        self.draining: Dict[str, float] = {}  # instance id -> when its drain started
+        self.lock = threading.Lock()
+
+    def claim(self, app_name: str, count: int, policy: Optional[str] = None) -> List[Dict[str, Any]]:
+        # picks the victims and lowers the target right away, so neither the reconciler nor
+        # the autoscaler acts on them while they drain
+        backends = {b['instance_id']: b for b in self.load_balancer.snapshot().get(app_name, [])}
+        with self.lock:
+            candidates = [i for i in self.state_manager.get_instances(app_name) if i['id'] not in self.draining]
+            victims = choose_victims(candidates, count, policy or self.default_policy, backends)
+            now = time.time()
+            for instance in victims:
+                self.draining[instance['id']] = now
+        if victims:
+            self.state_manager.adjust_target_replicas(app_name, -len(victims))
+        return victims
+
+    def retire(self, app_name: str, victims: List[Dict[str, Any]], grace: Optional[float] = None,
+               progress: Optional[Callable[..., None]] = None) -> Dict[str, Any]:
+        instance_ids = [instance['id'] for instance in victims]
+        grace = self.grace if grace is None else grace
+        retired: List[str] = []
+        try:
+            if progress:
+                progress(JOB_DRAINING, instance_ids=instance_ids, grace=grace)
+            outstanding = self.load_balancer.drain(app_name, instance_ids, grace) if grace > 0 else 0
+            if outstanding:
+                logger.info(f"{outstanding} request(s) still in flight on {app_name} after {grace:.0f}s, retiring anyway")
+            if progress:
+                progress(JOB_TERMINATING, instance_ids=instance_ids)
+
+            # packed replicas only stop their containers; the host stays up for its other tenants
+            for replica in [instance for instance in victims if instance.get('host_id')]:
+                self.placement.stop_replica(replica)
+            ec2_victims = [instance for instance in victims if not instance.get('host_id')]
+            ec2_ids = [instance['id'] for instance in ec2_victims]
+            # one terminate and one cancel call per region the victims run in
+            terminated, cancelled = [], []
+            for region, instances in group_by_region(ec2_victims).items():
+                region_terminated = terminate_instances([instance['id'] for instance in instances], region)
+                terminated += region_terminated
+                try:
+                    cancelled += cancel_spot_requests(region_terminated, region)
+                except Exception as e:
+                    logger.error(f"Error cancelling spot requests for {app_name} in {region}: {str(e)}")
+
+            # instances EC2 refused to terminate stay tracked so the reconciler keeps an eye on them
+            retired = [i for i in instance_ids if i in terminated or i not in ec2_ids]
+            removed = self.state_manager.remove_instances(app_name, retired)
+            for instance_id in retired:
+                self.stats_fetcher.forget(instance_id)
+            self.load_balancer.sync(app_name)
+            failed = [i for i in instance_ids if i not in retired]
+            logger.info(f"Scaled {app_name} down by {len(removed)} instance(s), cancelled {len(cancelled)} spot request(s)")
+            if progress:
+                if failed:
+                    progress(JOB_FAILED, error=f"EC2 did not terminate {', '.join(failed)}")
+                else:
+                    progress(JOB_TERMINATED, instance_ids=[instance['id'] for instance in removed])
+            return {'terminated_instance_ids': [instance['id'] for instance in removed],
+                    'cancelled_spot_request_ids': cancelled, 'failed_instance_ids': failed}
+        finally:
+            # victims that are still running, whether EC2 refused them or retiring failed part way,
+            # go back into rotation and count towards the target again
+            kept = [i for i in instance_ids if i not in retired]
+            if kept:
+                self.load_balancer.undrain(app_name, kept)
+                self.state_manager.adjust_target_replicas(app_name, len(kept))
+            with self.lock:
+                for instance_id in instance_ids:
+                    self.draining.pop(instance_id, None)
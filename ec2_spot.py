@@ -1,33 +1,92 @@
 # ec2_spot.py
 
 import time
-from typing import Dict
-import boto3
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import os
 import base64
 import dotenv
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, WaiterError
+from aws_clients import get_client
 from logging_config import logger
+from launch_templates import launch_template_manager, launch_templates_enabled
+from pool_selector import CAPACITY_CODES, Pool, PoolCursor, pool_selector
+from quota_tracker import quota_for
+from regions import home_region, region_config
+from telemetry import bid_attempts
+from tracing import Trace, span
 
 dotenv.load_dotenv('.env')
 
-def get_user_data(ecr_image_uri, env_vars):
+MONITOR_IMAGE = 'omkaark/spotty-monitoring:latest'
+
+def golden_ami_id(region: Optional[str] = None) -> Optional[str]:
+    # AMIs are regional and the golden one is baked in the home region; elsewhere boots are standard
+    if region and region != home_region():
+        return None
+    return os.environ.get('SPOTTY_GOLDEN_AMI_ID') or None
+
+def run_containers_script(env_vars, name: str = 'main-container', port: int = 80, stats_port: int = 3928,
+                          limits: str = '') -> str:
+    # expects $ECR_URI to hold the app image
     env_vars_str = ' '.join([f'-e {k}="{v}"' for k, v in env_vars.items()])
-    user_data_script = f"""#!/bin/bash
-    exec > >(tee /var/log/user-data.log|logger -t user-data -s 2>/dev/console) 2>&1
-    set -e
+    monitor_name = 'monitor-container' if name == 'main-container' else f"{name}-monitor"
+    return f"""docker run -d --name {name} -p {port}:80 -p {stats_port}:3928 {limits}{env_vars_str} $ECR_URI
+    echo "Main container started"
+
+    docker run -d --name {monitor_name} \
+        --network container:{name} \
+        -v /var/run/docker.sock:/var/run/docker.sock \
+        {MONITOR_IMAGE}
+    echo "Monitoring container started"
+"""
 
-    echo "Step 1: Starting user data script execution"
+def start_containers_script(ecr_image_uri, env_vars, pull: bool = False, replace: bool = False,
+                            preamble: bool = True, **container) -> List[str]:
+    # SSM commands that (re)start the app on a booted instance; pull when the image isn't on it yet,
+    # replace to swap out containers that are already running. Without the preamble (set -e and
+    # $ECR_URI) the commands can follow another call's in the same script
+    pull_steps = f"""$(aws ecr get-login --no-include-email --region {os.environ.get('AWS_REGION')})
+    docker pull --platform linux/amd64 $ECR_URI
+""" if pull else ""
+    name = container.get('name', 'main-container')
+    monitor_name = 'monitor-container' if name == 'main-container' else f"{name}-monitor"
+    remove_steps = f"docker rm -f {monitor_name} {name} || true" if replace else ""
+    preamble_steps = f"""set -e
+    ECR_URI=$(echo {ecr_image_uri} | sed 's|^https://||')
+""" if preamble else ""
+    script = f"""{preamble_steps}
+    {pull_steps}
+    {remove_steps}
+    {run_containers_script(env_vars, **container)}"""
+    return [line.strip() for line in script.splitlines() if line.strip()]
 
+def stop_containers_script(name: str) -> List[str]:
+    return [f"docker rm -f {name}-monitor {name} || true"]
+
+def get_user_data(ecr_image_uri, env_vars, golden: bool = False, standby: bool = False, region: Optional[str] = None):
+    # a golden AMI already has Docker running and the monitor image pulled
+    install_steps = "" if golden else """
     echo "Step 2: Installing Docker"
     amazon-linux-extras install docker -y > /dev/null 2>&1 # silencing the terminal spam
     systemctl start docker
     systemctl enable docker
     usermod -a -G docker ec2-user
     echo "Docker installation completed"
+    phase docker_installed
+"""
+    monitor_pull = "" if golden else f"docker pull --platform linux/amd64 {MONITOR_IMAGE}"
+    user_data_script = f"""#!/bin/bash
+    exec > >(tee /var/log/user-data.log|logger -t user-data -s 2>/dev/console) 2>&1
+    set -e
+
+    # phase timestamps, so boot time can be broken down per step
+    phase() {{ echo "$1 $(date +%s.%N)" >> /var/log/spotty-phases.log; }}
+    phase user_data_started
 
+    echo "Step 1: Starting user data script execution ({'golden AMI' if golden else 'standard'} boot)"
+    {install_steps}
     echo "Step 3: Configuring AWS CLI"
-    aws configure set region {os.environ.get('AWS_REGION')}
+    aws configure set region {region or os.environ.get('AWS_REGION')}
     echo "AWS CLI configuration completed"
 
     ECR_URI=$(echo {ecr_image_uri} | sed 's|^https://||')
@@ -35,140 +94,434 @@ def get_user_data(ecr_image_uri, env_vars):
     echo "Step 4: ECR login"
     $(aws ecr get-login --no-include-email --region {os.environ.get('AWS_REGION')})
     echo "ECR login completed"
+    phase ecr_login
 
     echo "Step 5: Pulling Docker image"
     docker pull --platform linux/amd64 $ECR_URI
-    docker pull --platform linux/amd64 omkaark/spotty-monitoring:latest
+    {monitor_pull}
     echo "Docker image pull completed"
+    phase image_pulled
 
-    docker run -d --name main-container -p 80:80 -p 3928:3928 {env_vars_str} $ECR_URI
-    echo "Main container started"
+    {'echo "Standby instance ready"' if standby else run_containers_script(env_vars)}
+    phase {'standby_ready' if standby else 'containers_started'}
 
-    docker run -d --name monitor-container \
-        --network container:main-container \
-        -v /var/run/docker.sock:/var/run/docker.sock \
-        omkaark/spotty-monitoring:latest
-    echo "Monitoring container started"
+    # hand the phase timestamps back to Spotty as instance tags
+    TOKEN=$(curl -s -X PUT http://169.254.169.254/latest/api/token -H "X-aws-ec2-metadata-token-ttl-seconds: 60")
+    INSTANCE_ID=$(curl -s -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/instance-id)
+    aws ec2 create-tags --resources $INSTANCE_ID \
+        --tags $(awk '{{printf "Key=spotty:phase:%s,Value=%s ", $1, $2}}' /var/log/spotty-phases.log) || true
 
     echo "User data script completed successfully"
     """
     return base64.b64encode(user_data_script.encode()).decode()
 
-def request_spot_instance(ecr_image_uri, instance_name, env_vars):
-    required_vars = ['TF_AMI_ID', 'TF_INSTANCE_TYPE', 'TF_SECURITY_GROUP_ID', 
-                     'TF_SUBNET_ID', 'TF_INSTANCE_PROFILE_NAME', 'AWS_REGION']
+def get_launch_specification(ecr_image_uri, env_vars, pool: Optional[Pool] = None, standby: bool = False,
+                             region: Optional[str] = None):
+    required_vars = ['TF_AMI_ID', 'TF_SECURITY_GROUP_ID', 'TF_INSTANCE_PROFILE_NAME', 'AWS_REGION']
     
     for var in required_vars:
         if not os.environ.get(var):
             raise EnvironmentError(f"Environment variable {var} is not set")
-    
-    ami_id = os.environ['TF_AMI_ID']
-    instance_type = os.environ['TF_INSTANCE_TYPE']
-    security_group_id = os.environ['TF_SECURITY_GROUP_ID']
-    subnet_id = os.environ['TF_SUBNET_ID']
-    instance_profile_name = os.environ['TF_INSTANCE_PROFILE_NAME']
 
-    ec2_client = boto3.client('ec2', region_name=os.environ['AWS_REGION'])
-    
-    spot_price = 0.005  # starting bid price
+    # the instance profile is global, the AMI and security group belong to the pool's region
+    region = pool.region if pool else region
+    config = region_config(region)
+    return {
+        'ImageId': golden_ami_id(region) or config['ami_id'],
+        'InstanceType': pool.instance_type if pool else os.environ.get('TF_INSTANCE_TYPE'),
+        'SecurityGroupIds': [config['security_group_id']],
+        'SubnetId': pool.subnet_id if pool else os.environ.get('TF_SUBNET_ID'),
+        'IamInstanceProfile': {'Name': os.environ['TF_INSTANCE_PROFILE_NAME']},
+        'UserData': get_user_data(ecr_image_uri, env_vars, golden=bool(golden_ami_id(region)), standby=standby, region=region)
+    }
+
+LIMIT_CODES = {'MaxSpotInstanceCountExceeded', 'InstanceLimitExceeded'}
+
+Fulfilled = Tuple[str, float, float, Pool]  # (instance_id, spot_price, time fulfilled, pool)
+
+class SpotLaunch:
+    # One launch's attempts, what they fulfilled and where the next one goes. The sync and async
+    # launch paths share it and only make the EC2 calls and do the waiting themselves
     max_attempts = 10
-    spot_price_increment = 0.001 # bid increase delta
-    attempt = 0
 
-    while attempt < max_attempts:
+    def __init__(self, instance_names: List[str], cursor: PoolCursor,
+                 on_progress: Optional[Callable[..., None]] = None):
+        self.instance_names = instance_names
+        self.cursor = cursor
+        self.on_progress = on_progress
+        self.fulfilled: List[Fulfilled] = []
+        self.requests_made = 0
+
+    def next_attempt(self) -> Optional[Tuple[Pool, float, int]]:
+        # pool, bid and instance count for the next request; None once done or out of attempts
+        if self.requests_made >= self.max_attempts or len(self.fulfilled) >= len(self.instance_names):
+            return None
+        self.requests_made += 1
+        return self.cursor.pool, self.cursor.price, len(self.instance_names) - len(self.fulfilled)
+
+    def progress(self, status: str, **details):
+        if self.on_progress:
+            self.on_progress(status, **details)
+
+    def record_fulfilled(self, instance_ids: List[str], spot_price: float, pool: Pool, requested_at: float):
+        now = time.time()
+        self.fulfilled.extend((instance_id, spot_price, now, pool) for instance_id in instance_ids)
+        for instance_id in instance_ids:
+            quota_for(pool.region).record_launch(instance_id, pool.instance_type)
+        if instance_ids:
+            pool_selector.record_success(pool, now - requested_at)
+            self.progress('fulfilled', instance_ids=instance_ids)
+
+    def unfulfilled(self, requests: List[Dict[str, Any]]) -> Callable[[], None]:
+        # the cursor move for the next attempt; out of capacity means another pool, not a higher bid
+        codes = {r.get('Status', {}).get('Code') for r in requests}
+        logger.info(f"{len(requests)} request(s) unfulfilled ({', '.join(sorted(filter(None, codes)))})")
+        return self.cursor.fail_over if codes & CAPACITY_CODES else self.cursor.escalate
+
+    def client_error(self, e: ClientError, pool: Pool) -> Optional[Callable[[], None]]:
+        # the cursor move for the next attempt, or None when no attempt can succeed
+        error_code = e.response['Error']['Code']
+        logger.error(f"ClientError: {error_code} - {e.response['Error']['Message']}")
+        if error_code in LIMIT_CODES:
+            logger.error("Spot Instance limit reached. Please check your AWS quotas.")
+            return None
+        if error_code in CAPACITY_CODES:
+            logger.error(f"Insufficient capacity for {pool.instance_type} in {pool.az or pool.subnet_id}.")
+            return self.cursor.fail_over
+        return self.cursor.escalate
+
+    def result(self) -> Tuple[List[Fulfilled], int]:
+        if len(self.fulfilled) < len(self.instance_names):
+            logger.error(f"Only {len(self.fulfilled)} of {len(self.instance_names)} Spot Instances were fulfilled")
+        return self.fulfilled, self.requests_made
+
+def split_requests(requests: List[Dict[str, Any]]) -> Tuple[List[str], List[Dict[str, Any]]]:
+    # instance ids of the fulfilled spot requests, and the requests still without one
+    return ([r['InstanceId'] for r in requests if r.get('InstanceId')],
+            [r for r in requests if not r.get('InstanceId')])
+
+def template_args(app_name: str, ecr_image_uri, env_vars, standby: bool,
+                  region: Optional[str]) -> Tuple[str, Dict[str, Any]]:
+    # instance type and subnet vary per pool, so they are passed to run_instances instead of the template
+    launch_specification = get_launch_specification(ecr_image_uri, env_vars, standby=standby, region=region)
+    template_data = {k: v for k, v in launch_specification.items() if k not in ('SubnetId', 'InstanceType')}
+    return f"{app_name}-standby" if standby else app_name, template_data
+
+def run_instances_params(template_id: str, version: int, pool: Pool, spot_price: float, count: int) -> Dict[str, Any]:
+    # run_instances with spot options is fulfilled (or refused) synchronously, no waiter needed
+    return {
+        'LaunchTemplate': {'LaunchTemplateId': template_id, 'Version': str(version)},
+        'InstanceType': pool.instance_type,
+        'SubnetId': pool.subnet_id,
+        'MinCount': 1,
+        'MaxCount': count,
+        'InstanceMarketOptions': {
+            'MarketType': 'spot',
+            'SpotOptions': {'MaxPrice': str(spot_price), 'SpotInstanceType': 'one-time'}
+        }
+    }
+
+def spot_request_params(ecr_image_uri, env_vars, pool: Pool, spot_price: float, count: int,
+                        standby: bool) -> Dict[str, Any]:
+    # a single request covers every instance still missing
+    return {
+        'SpotPrice': str(spot_price),
+        'InstanceCount': count,
+        'Type': 'one-time',
+        'LaunchSpecification': get_launch_specification(ecr_image_uri, env_vars, pool, standby)
+    }
+
+def ids_by_region(fulfilled: List[Fulfilled]) -> Dict[Optional[str], List[str]]:
+    by_region: Dict[Optional[str], List[str]] = {}
+    for instance_id, *_, pool in fulfilled:
+        by_region.setdefault(pool.region, []).append(instance_id)
+    return by_region
+
+def record_outcome(fulfilled: List[Fulfilled], instance_names: List[str], attempts: int):
+    outcome = 'fulfilled' if len(fulfilled) == len(instance_names) else 'partial' if fulfilled else 'failed'
+    bid_attempts.labels(outcome).observe(attempts)
+    if not fulfilled:
+        logger.error(f"Failed to create Spot Instances for {instance_names}")
+
+def public_ips_found(by_region: Dict[Optional[str], List[str]], found: List[Any]) -> Dict[str, str]:
+    # merges the per-region ip lookups; a region whose lookup failed leaves its instances
+    # without an ip rather than losing them
+    public_ips: Dict[str, str] = {}
+    for (region, instance_ids), ips in zip(by_region.items(), found):
+        if isinstance(ips, Exception):
+            logger.error(f"Failed to get public IPs for {', '.join(instance_ids)}: {str(ips)}")
+        else:
+            public_ips.update(ips)
+    return public_ips
+
+def abandon_instances(fulfilled: List[Fulfilled]):
+    # a launch that fails after EC2 fulfilled it terminates what it got, which would otherwise
+    # keep running and billing with nothing tracking it
+    for region, instance_ids in ids_by_region(fulfilled).items():
         try:
-            response = ec2_client.request_spot_instances(
-                SpotPrice=str(spot_price),
-                InstanceCount=1,
-                Type='one-time',
-                LaunchSpecification={
-                    'ImageId': ami_id,
-                    'InstanceType': instance_type,
-                    'SecurityGroupIds': [security_group_id],
-                    'SubnetId': subnet_id,
-                    'IamInstanceProfile': {'Name': instance_profile_name},
-                    'UserData': get_user_data(ecr_image_uri, env_vars)                }
-            )
-            
-            spot_request_id = response['SpotInstanceRequests'][0]['SpotInstanceRequestId']
-            logger.info(f"Spot instance request ID: {spot_request_id}")
-            
-            # waiter stops program exec and checks every 15 seconds if need is fulfilled twice
-            logger.info(f"Waiting for spot instance to be fulfilled (Attempt {attempt + 1}, Price: ${spot_price:.4f})...")
-            waiter = ec2_client.get_waiter('spot_instance_request_fulfilled')
-            waiter.wait(SpotInstanceRequestIds=[spot_request_id], WaiterConfig={'Delay': 15, 'MaxAttempts': 2})
-            
-            response = ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=[spot_request_id])
-            instance_id = response['SpotInstanceRequests'][0]['InstanceId']
-            logger.info(f"Spot instance fulfilled. Instance ID: {instance_id}")
+            terminated = terminate_instances(instance_ids, region)
+            logger.error(f"Terminated {len(terminated)} of {len(instance_ids)} instance(s) of a failed launch")
+        except Exception as e:
+            logger.exception(f"Error terminating the instances of a failed launch {instance_ids}: {str(e)}")
+
+def build_instances(ecr_image_uri: str, instance_names: List[str], fulfilled: List[Fulfilled], attempts: int,
+                    public_ips: Dict[str, str], trace: Trace,
+                    on_progress: Optional[Callable[..., None]] = None) -> List[Dict[str, Any]]:
+    # the instance dicts both create_instances return
+    if public_ips and on_progress:
+        on_progress('ip-assigned', ips=public_ips)
+    provisioning = {'attempts': attempts, 'seconds': round(time.time() - trace.started, 2)}
+    logger.info(f"Provisioned {len(fulfilled)} instance(s) in {provisioning['seconds']}s over {attempts} bid attempt(s)")
+    return [
+        {
+            "id": instance_id,
+            "ip": public_ips.get(instance_id),
+            "name": instance_name,
+            "ecr_image_uri": ecr_image_uri,
+            "spot_price": spot_price,
+            "time_now": time_now,
+            "instance_type": pool.instance_type,
+            "subnet_id": pool.subnet_id,
+            "az": pool.az,
+            "region": pool.region or home_region(),
+            "provisioning": provisioning,
+            "boot_mode": 'golden' if golden_ami_id(pool.region) else 'standard',
+            "trace": trace.to_dict()
+        }
+        for (instance_id, spot_price, time_now, pool), instance_name in zip(fulfilled, instance_names)
+    ]
+
+def log_tag_error(instance_id: str, e: Exception):
+    # an instance that couldn't be named still runs, so it is kept and tracked all the same
+    logger.error(f"Error naming {instance_id}: {str(e)}")
 
-            # give the instance a name on aws
-            ec2_client.create_tags(
+def name_instances(fulfilled: List[Fulfilled], instance_names: List[str]):
+    # give the instances their names on aws; a Name value is per instance so
+    # EC2 cannot set them all in one create_tags call
+    for (instance_id, _, _, pool), instance_name in zip(fulfilled, instance_names):
+        try:
+            get_client('ec2', pool.region).create_tags(
                 Resources=[instance_id],
                 Tags=[{'Key': 'Name', 'Value': instance_name}]
             )
-            
-            return instance_id, spot_price, time.time()
+        except Exception as e:
+            log_tag_error(instance_id, e)
+
+def launch_from_template(app_name: str, ecr_image_uri, instance_names: List[str], env_vars,
+                         on_progress: Optional[Callable[..., None]] = None,
+                         trace: Optional[Trace] = None,
+                         launch_spec: Optional[Dict[str, List[str]]] = None,
+                         standby: bool = False) -> Tuple[List[Fulfilled], int]:
+    # templates are regional, so there is one per region the launch gets to
+    templates: Dict[Optional[str], Tuple[str, int]] = {}
+
+    def template_for(region: Optional[str]) -> Tuple[str, int]:
+        if region not in templates:
+            with span(trace, 'launch_template'):
+                templates[region] = launch_template_manager.ensure(
+                    *template_args(app_name, ecr_image_uri, env_vars, standby, region), region)
+        return templates[region]
+
+    with span(trace, 'price_history'):
+        launch = SpotLaunch(instance_names, PoolCursor(pool_selector.rank(launch_spec)), on_progress)
+
+    while attempt := launch.next_attempt():
+        pool, spot_price, remaining = attempt
+        ec2_client = get_client('ec2', pool.region)
+        try:
+            template_id, version = template_for(pool.region)
+            launch.progress('requested', launch_template_id=template_id, version=version, spot_price=spot_price,
+                            instance_type=pool.instance_type, az=pool.az, attempt=launch.requests_made)
+            requested_at = time.time()
+            with span(trace, 'bid_attempt', spot_price=spot_price, instance_type=pool.instance_type, az=pool.az):
+                response = ec2_client.run_instances(**run_instances_params(template_id, version, pool, spot_price, remaining))
+            instance_ids = [instance['InstanceId'] for instance in response['Instances']]
+            logger.info(f"Spot instance(s) launched from template {template_id} v{version} in {pool.instance_type}/{pool.az}: {instance_ids}")
+            launch.record_fulfilled(instance_ids, spot_price, pool, requested_at)
 
         except ClientError as e:
-            error_code = e.response['Error']['Code']
-            error_message = e.response['Error']['Message']
-            logger.error(f"ClientError: {error_code} - {error_message}")
+            move = launch.client_error(e, pool)
+            if move is None:
+                break
+            move()
+
+    with span(trace, 'tag'):
+        name_instances(launch.fulfilled, instance_names)
+    return launch.result()
+
+def request_spot_instances(ecr_image_uri, instance_names: List[str], env_vars,
+                           on_progress: Optional[Callable[..., None]] = None,
+                           app_name: Optional[str] = None,
+                           trace: Optional[Trace] = None,
+                           launch_spec: Optional[Dict[str, List[str]]] = None,
+                           standby: bool = False) -> Tuple[List[Fulfilled], int]:
+    if launch_templates_enabled():
+        app_name = app_name or instance_names[0].rsplit('-', 1)[0]
+        return launch_from_template(app_name, ecr_image_uri, instance_names, env_vars, on_progress, trace, launch_spec, standby)
+
+    with span(trace, 'price_history'):
+        launch = SpotLaunch(instance_names, PoolCursor(pool_selector.rank(launch_spec)), on_progress)
+
+    while attempt := launch.next_attempt():
+        pool, spot_price, remaining = attempt
+        ec2_client = get_client('ec2', pool.region)
+        try:
+            requested_at = time.time()
+            with span(trace, 'bid_attempt', spot_price=spot_price, instance_type=pool.instance_type, az=pool.az):
+                response = ec2_client.request_spot_instances(
+                    **spot_request_params(ecr_image_uri, env_vars, pool, spot_price, remaining, standby))
+            
+            spot_request_ids = [r['SpotInstanceRequestId'] for r in response['SpotInstanceRequests']]
+            logger.info(f"Spot instance request IDs: {spot_request_ids}")
+            launch.progress('requested', spot_request_ids=spot_request_ids, spot_price=spot_price,
+                            instance_type=pool.instance_type, az=pool.az, attempt=launch.requests_made)
             
-            if error_code in ['MaxSpotInstanceCountExceeded', 'InstanceLimitExceeded']:
-                logger.error("Spot Instance limit reached. Please check your AWS quotas.")
-                return None, None, time.time()
-            elif error_code == 'InsufficientInstanceCapacity':
-                logger.error("Insufficient capacity for the requested instance type.")
-                return None, None, time.time()
-            else:
-                spot_price += spot_price_increment
-                logger.info(f"Increasing price to ${spot_price:.4f} and retrying...")
-                attempt += 1
+            # waiter stops program exec and checks every 15 seconds if need is fulfilled twice
+            logger.info(f"Waiting for {remaining} spot instance(s) in {pool.instance_type}/{pool.az} to be fulfilled (Attempt {launch.requests_made}, Price: ${spot_price:.4f})...")
+            waiter = ec2_client.get_waiter('spot_instance_request_fulfilled')
+            with span(trace, 'spot_wait'):
+                try:
+                    waiter.wait(SpotInstanceRequestIds=spot_request_ids, WaiterConfig={'Delay': 15, 'MaxAttempts': 2})
+                except WaiterError:
+                    logger.info("Not every spot request was fulfilled in time")
+                
+                response = ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=spot_request_ids)
+            instance_ids, unfulfilled = split_requests(response['SpotInstanceRequests'])
+            if unfulfilled:
+                # cancelling a request doesn't stop an instance it launched since the describe above,
+                # so look again once cancelled and keep any instance that slipped through
+                unfulfilled_ids = [r['SpotInstanceRequestId'] for r in unfulfilled]
+                ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=unfulfilled_ids)
+                response = ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=unfulfilled_ids)
+                late_ids, unfulfilled = split_requests(response['SpotInstanceRequests'])
+                instance_ids += late_ids
+            if instance_ids:
+                logger.info(f"Spot instance(s) fulfilled. Instance IDs: {instance_ids}")
+            launch.record_fulfilled(instance_ids, spot_price, pool, requested_at)
+            if unfulfilled:
+                launch.unfulfilled(unfulfilled)()
+
+        except ClientError as e:
+            move = launch.client_error(e, pool)
+            if move is None:
+                break
+            move()
 
         except Exception as e:
-            logger.exception(f"Unexpected error in request_spot_instance: {str(e)}")
-            return None, None, time.time()
+            logger.exception(f"Unexpected error in request_spot_instances: {str(e)}")
+            break
 
-    logger.error("Failed to create Spot Instance after maximum attempts")
-    return None, None, time.time()
+    with span(trace, 'tag'):
+        name_instances(launch.fulfilled, instance_names)
+    return launch.result()
 
-def get_instance_public_ip(ec2_client, instance_id, max_retries=10, delay=10):
+def request_spot_instance(ecr_image_uri, instance_name, env_vars, on_progress: Optional[Callable[..., None]] = None):
+    fulfilled, _ = request_spot_instances(ecr_image_uri, [instance_name], env_vars, on_progress)
+    if not fulfilled:
+        return None, None, time.time()
+    return fulfilled[0][:3]
+
+def ips_described(instance_info: Dict[str, Any]) -> Dict[str, str]:
+    return {instance['InstanceId']: instance['PublicIpAddress']
+            for reservation in instance_info['Reservations'] for instance in reservation['Instances']
+            if 'PublicIpAddress' in instance}
+
+def log_describe_error(e: ClientError):
+    # new instances can be missing from describe_instances for a while (InvalidInstanceID.NotFound)
+    logger.info(f"Instances not described yet ({e.response['Error']['Code']}), trying again")
+
+def get_instance_public_ips(ec2_client, instance_ids: List[str], max_retries=10, delay=10) -> Dict[str, str]:
+    # one describe_instances call per poll covers the whole batch
+    public_ips = {}
     for _ in range(max_retries):
-        instance_info = ec2_client.describe_instances(InstanceIds=[instance_id])
-        if 'PublicIpAddress' in instance_info['Reservations'][0]['Instances'][0]:
-            return instance_info['Reservations'][0]['Instances'][0]['PublicIpAddress']
-        logger.info(f"Public IP not yet available. Waiting {delay} seconds...")
+        pending = [instance_id for instance_id in instance_ids if instance_id not in public_ips]
+        try:
+            public_ips.update(ips_described(ec2_client.describe_instances(InstanceIds=pending)))
+        except ClientError as e:
+            log_describe_error(e)
+        if len(public_ips) == len(instance_ids):
+            return public_ips
+        logger.info(f"Public IP not yet available for {len(instance_ids) - len(public_ips)} instance(s). Waiting {delay} seconds...")
         time.sleep(delay)
-    raise Exception("Failed to get public IP address after multiple retries")
+    logger.error(f"Failed to get public IP address for {len(instance_ids) - len(public_ips)} instance(s) after multiple retries")
+    return public_ips
+
+def get_instance_public_ip(ec2_client, instance_id, max_retries=10, delay=10):
+    public_ips = get_instance_public_ips(ec2_client, [instance_id], max_retries, delay)
+    if instance_id not in public_ips:
+        raise Exception("Failed to get public IP address after multiple retries")
+    return public_ips[instance_id]
 
-def terminate_instance(instance_id: str):
-    ec2_client = boto3.client('ec2', region_name=os.environ.get('AWS_REGION'))
-    ec2_client.terminate_instances(InstanceIds=[instance_id])
+def terminate_instance(instance_id: str, region: Optional[str] = None):
+    terminate_instances([instance_id], region)
 
-def create_instance(ecr_image_uri: str, instance_name: str, env_vars: Dict[str, str]):
+def terminate_instances(instance_ids: List[str], region: Optional[str] = None) -> List[str]:
+    # one call for the whole batch, all in one region; returns the ids EC2 accepted
+    if not instance_ids:
+        return []
+    ec2_client = get_client('ec2', region)
     try:
-        instance_id, spot_price, time_now = request_spot_instance(ecr_image_uri, instance_name, env_vars)
-        
-        if not instance_id:
-            logger.error(f"Failed to create Spot Instance for {instance_name}")
-            return None
+        ec2_client.terminate_instances(InstanceIds=instance_ids)
+        terminated = list(instance_ids)
+    except ClientError as e:
+        if len(instance_ids) == 1:
+            logger.error(f"Error terminating {instance_ids[0]}: {e.response['Error']['Message']}")
+            return []
+        # a single stale id fails the whole call, so fall back to one call each
+        logger.error(f"Batched termination failed ({e.response['Error']['Code']}), terminating one by one")
+        terminated = []
+        for instance_id in instance_ids:
+            try:
+                ec2_client.terminate_instances(InstanceIds=[instance_id])
+                terminated.append(instance_id)
+            except ClientError as e:
+                logger.error(f"Error terminating {instance_id}: {e.response['Error']['Message']}")
+    for instance_id in terminated:
+        quota_for(region).record_termination(instance_id)
+    return terminated
 
-        ec2_client = boto3.client('ec2', region_name=os.environ.get('AWS_REGION'))
-        
-        try:
-            public_ip = get_instance_public_ip(ec2_client, instance_id)
-        except Exception as e:
-            logger.error(f"Failed to get public IP for instance {instance_id}: {str(e)}")
-            public_ip = None
+def cancel_spot_requests(instance_ids: List[str], region: Optional[str] = None) -> List[str]:
+    # closes the spot requests behind the given instances so persistent ones don't relaunch
+    if not instance_ids:
+        return []
+    ec2_client = get_client('ec2', region)
+    response = ec2_client.describe_spot_instance_requests(
+        Filters=[{'Name': 'instance-id', 'Values': instance_ids},
+                 {'Name': 'state', 'Values': ['open', 'active']}])
+    request_ids = [r['SpotInstanceRequestId'] for r in response['SpotInstanceRequests']]
+    if request_ids:
+        ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=request_ids)
+    return request_ids
 
-        return {
-            "id": instance_id,
-            "ip": public_ip,
-            "name": instance_name,
-            "spot_price": spot_price,
-            "time_now": time_now
-        }
+def create_instances(ecr_image_uri: str, instance_names: List[str], env_vars: Dict[str, str],
+                     on_progress: Optional[Callable[..., None]] = None,
+                     app_name: Optional[str] = None,
+                     launch_spec: Optional[Dict[str, List[str]]] = None,
+                     standby: bool = False) -> List[Dict[str, Any]]:
+    fulfilled: List[Fulfilled] = []
+    try:
+        trace = Trace()
+        fulfilled, attempts = request_spot_instances(ecr_image_uri, instance_names, env_vars, on_progress, app_name, trace, launch_spec, standby)
+        record_outcome(fulfilled, instance_names, attempts)
+        if not fulfilled:
+            return []
+
+        by_region = ids_by_region(fulfilled)
+        found: List[Any] = []
+        with span(trace, 'ip_wait'):
+            for region, instance_ids in by_region.items():
+                try:
+                    found.append(get_instance_public_ips(get_client('ec2', region), instance_ids))
+                except Exception as e:
+                    found.append(e)
+        return build_instances(ecr_image_uri, instance_names, fulfilled, attempts,
+                               public_ips_found(by_region, found), trace, on_progress)
     except Exception as e:
-        logger.exception(f"Error in create_instance: {str(e)}")
-        return None
+        logger.exception(f"Error in create_instances: {str(e)}")
+        abandon_instances(fulfilled)
+        return []
+
+def create_instance(ecr_image_uri: str, instance_name: str, env_vars: Dict[str, str],
+                    on_progress: Optional[Callable[..., None]] = None):
+    instances = create_instances(ecr_image_uri, [instance_name], env_vars, on_progress)
+    return instances[0] if instances else None
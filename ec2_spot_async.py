@@ -0,0 +1,187 @@
+import asyncio
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from botocore.exceptions import ClientError
+from aws_clients import get_async_client
+from ec2_spot import (Fulfilled, SpotLaunch, abandon_instances, build_instances, ids_by_region, ips_described,
+                      log_describe_error, log_tag_error, public_ips_found, record_outcome, run_instances_params,
+                      split_requests, spot_request_params, template_args)
+from launch_templates import launch_template_manager, launch_templates_enabled
+from logging_config import logger
+from pool_selector import PoolCursor, pool_selector
+from tracing import Trace, span
+
+# Asyncio versions of the ec2_spot launch path for the ASGI server. The spot and
+# IP waits are asyncio sleeps between describe calls rather than blocked threads,
+# so one process can have hundreds of launches waiting on AWS at once.
+
+def poll_interval() -> float:
+    return float(os.environ.get('SPOTTY_ASYNC_POLL_INTERVAL', 5))
+
+async def rank_pools(launch_spec: Optional[Dict[str, List[str]]]) -> PoolCursor:
+    # ranking reads cached price history and subnet AZs, but can hit AWS on a cold cache
+    return await asyncio.to_thread(lambda: PoolCursor(pool_selector.rank(launch_spec)))
+
+async def name_instances(fulfilled: List[Fulfilled], instance_names: List[str]):
+    clients = {region: await get_async_client('ec2', region) for region in {pool.region for *_, pool in fulfilled}}
+    results = await asyncio.gather(*[
+        clients[pool.region].create_tags(Resources=[instance_id], Tags=[{'Key': 'Name', 'Value': instance_name}])
+        for (instance_id, _, _, pool), instance_name in zip(fulfilled, instance_names)
+    ], return_exceptions=True)
+    for (instance_id, *_), result in zip(fulfilled, results):
+        if isinstance(result, Exception):
+            log_tag_error(instance_id, result)
+        elif isinstance(result, BaseException):
+            raise result
+
+async def wait_fulfilled(ec2_client, spot_request_ids: List[str], timeout: float = 30) -> Dict[str, Any]:
+    # the same 30s budget as the sync waiter (2 x 15s), polled without holding a thread
+    deadline = time.time() + timeout
+    while True:
+        response = await ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=spot_request_ids)
+        if all(r.get('InstanceId') for r in response['SpotInstanceRequests']) or time.time() >= deadline:
+            return response
+        await asyncio.sleep(min(poll_interval(), max(0.0, deadline - time.time())))
+
+async def launch_from_template(app_name: str, ecr_image_uri, instance_names: List[str], env_vars,
+                               on_progress: Optional[Callable[..., None]] = None,
+                               trace: Optional[Trace] = None,
+                               launch_spec: Optional[Dict[str, List[str]]] = None,
+                               standby: bool = False) -> Tuple[List[Fulfilled], int]:
+    # one template per region the launch gets to, as in ec2_spot.launch_from_template
+    templates: Dict[Optional[str], Tuple[str, int]] = {}
+
+    async def template_for(region: Optional[str]) -> Tuple[str, int]:
+        if region not in templates:
+            with span(trace, 'launch_template'):
+                templates[region] = await asyncio.to_thread(
+                    launch_template_manager.ensure, *template_args(app_name, ecr_image_uri, env_vars, standby, region), region)
+        return templates[region]
+
+    with span(trace, 'price_history'):
+        launch = SpotLaunch(instance_names, await rank_pools(launch_spec), on_progress)
+
+    while attempt := launch.next_attempt():
+        pool, spot_price, remaining = attempt
+        ec2_client = await get_async_client('ec2', pool.region)
+        try:
+            template_id, version = await template_for(pool.region)
+            launch.progress('requested', launch_template_id=template_id, version=version, spot_price=spot_price,
+                            instance_type=pool.instance_type, az=pool.az, attempt=launch.requests_made)
+            requested_at = time.time()
+            with span(trace, 'bid_attempt', spot_price=spot_price, instance_type=pool.instance_type, az=pool.az):
+                response = await ec2_client.run_instances(**run_instances_params(template_id, version, pool, spot_price, remaining))
+            instance_ids = [instance['InstanceId'] for instance in response['Instances']]
+            logger.info(f"Spot instance(s) launched from template {template_id} v{version} in {pool.instance_type}/{pool.az}: {instance_ids}")
+            launch.record_fulfilled(instance_ids, spot_price, pool, requested_at)
+
+        except ClientError as e:
+            move = launch.client_error(e, pool)
+            if move is None:
+                break
+            await asyncio.to_thread(move)
+
+    with span(trace, 'tag'):
+        await name_instances(launch.fulfilled, instance_names)
+    return launch.result()
+
+async def request_spot_instances(ecr_image_uri, instance_names: List[str], env_vars,
+                                 on_progress: Optional[Callable[..., None]] = None,
+                                 app_name: Optional[str] = None,
+                                 trace: Optional[Trace] = None,
+                                 launch_spec: Optional[Dict[str, List[str]]] = None,
+                                 standby: bool = False) -> Tuple[List[Fulfilled], int]:
+    if launch_templates_enabled():
+        app_name = app_name or instance_names[0].rsplit('-', 1)[0]
+        return await launch_from_template(app_name, ecr_image_uri, instance_names, env_vars, on_progress, trace, launch_spec, standby)
+
+    with span(trace, 'price_history'):
+        launch = SpotLaunch(instance_names, await rank_pools(launch_spec), on_progress)
+
+    while attempt := launch.next_attempt():
+        pool, spot_price, remaining = attempt
+        ec2_client = await get_async_client('ec2', pool.region)
+        try:
+            requested_at = time.time()
+            with span(trace, 'bid_attempt', spot_price=spot_price, instance_type=pool.instance_type, az=pool.az):
+                response = await ec2_client.request_spot_instances(
+                    **spot_request_params(ecr_image_uri, env_vars, pool, spot_price, remaining, standby))
+
+            spot_request_ids = [r['SpotInstanceRequestId'] for r in response['SpotInstanceRequests']]
+            logger.info(f"Spot instance request IDs: {spot_request_ids}")
+            launch.progress('requested', spot_request_ids=spot_request_ids, spot_price=spot_price,
+                            instance_type=pool.instance_type, az=pool.az, attempt=launch.requests_made)
+
+            logger.info(f"Waiting for {remaining} spot instance(s) in {pool.instance_type}/{pool.az} to be fulfilled (Attempt {launch.requests_made}, Price: ${spot_price:.4f})...")
+            with span(trace, 'spot_wait'):
+                response = await wait_fulfilled(ec2_client, spot_request_ids)
+            instance_ids, unfulfilled = split_requests(response['SpotInstanceRequests'])
+            if unfulfilled:
+                # cancelling a request doesn't stop an instance it launched since the describe above,
+                # so look again once cancelled and keep any instance that slipped through
+                unfulfilled_ids = [r['SpotInstanceRequestId'] for r in unfulfilled]
+                await ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=unfulfilled_ids)
+                response = await ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=unfulfilled_ids)
+                late_ids, unfulfilled = split_requests(response['SpotInstanceRequests'])
+                instance_ids += late_ids
+            if instance_ids:
+                logger.info(f"Spot instance(s) fulfilled. Instance IDs: {instance_ids}")
+            launch.record_fulfilled(instance_ids, spot_price, pool, requested_at)
+            if unfulfilled:
+                await asyncio.to_thread(launch.unfulfilled(unfulfilled))
+
+        except ClientError as e:
+            move = launch.client_error(e, pool)
+            if move is None:
+                break
+            await asyncio.to_thread(move)
+
+        except Exception as e:
+            logger.exception(f"Unexpected error in request_spot_instances: {str(e)}")
+            break
+
+    with span(trace, 'tag'):
+        await name_instances(launch.fulfilled, instance_names)
+    return launch.result()
+
+async def get_instance_public_ips(ec2_client, instance_ids: List[str], max_retries=10, delay=10) -> Dict[str, str]:
+    public_ips = {}
+    for _ in range(max_retries):
+        pending = [instance_id for instance_id in instance_ids if instance_id not in public_ips]
+        try:
+            public_ips.update(ips_described(await ec2_client.describe_instances(InstanceIds=pending)))
+        except ClientError as e:
+            log_describe_error(e)
+        if len(public_ips) == len(instance_ids):
+            return public_ips
+        logger.info(f"Public IP not yet available for {len(instance_ids) - len(public_ips)} instance(s). Waiting {delay} seconds...")
+        await asyncio.sleep(delay)
+    logger.error(f"Failed to get public IP address for {len(instance_ids) - len(public_ips)} instance(s) after multiple retries")
+    return public_ips
+
+async def create_instances(ecr_image_uri: str, instance_names: List[str], env_vars: Dict[str, str],
+                           on_progress: Optional[Callable[..., None]] = None,
+                           app_name: Optional[str] = None,
+                           launch_spec: Optional[Dict[str, List[str]]] = None,
+                           standby: bool = False) -> List[Dict[str, Any]]:
+    # returns the same instance dicts as ec2_spot.create_instances
+    fulfilled: List[Fulfilled] = []
+    try:
+        trace = Trace()
+        fulfilled, attempts = await request_spot_instances(ecr_image_uri, instance_names, env_vars, on_progress, app_name, trace, launch_spec, standby)
+        record_outcome(fulfilled, instance_names, attempts)
+        if not fulfilled:
+            return []
+
+        by_region = ids_by_region(fulfilled)
+        with span(trace, 'ip_wait'):
+            found = await asyncio.gather(*[
+                get_instance_public_ips(await get_async_client('ec2', region), instance_ids, delay=poll_interval())
+                for region, instance_ids in by_region.items()], return_exceptions=True)
+        return build_instances(ecr_image_uri, instance_names, fulfilled, attempts,
+                               public_ips_found(by_region, found), trace, on_progress)
+    except Exception as e:
+        logger.exception(f"Error in create_instances: {str(e)}")
+        await asyncio.to_thread(abandon_instances, fulfilled)
+        return []
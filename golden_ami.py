@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+from aws_clients import get_client
+from ec2_spot import MONITOR_IMAGE
+from logging_config import logger
+
+BAKE_SCRIPT = f"""#!/bin/bash
+set -e
+amazon-linux-extras install docker -y
+systemctl enable docker
+systemctl start docker
+usermod -a -G docker ec2-user
+docker pull --platform linux/amd64 {MONITOR_IMAGE}
+shutdown -h now
+"""
+
+def bake_golden_ami(name: str = None) -> str:
+    # boots the base AMI once, installs Docker and the monitor image, and snapshots it
+    name = name or f"spotty-golden-{int(time.time())}"
+    ec2_client = get_client('ec2')
+    response = ec2_client.run_instances(
+        ImageId=os.environ['TF_AMI_ID'],
+        InstanceType=os.environ['TF_INSTANCE_TYPE'],
+        MinCount=1,
+        MaxCount=1,
+        SubnetId=os.environ['TF_SUBNET_ID'],
+        SecurityGroupIds=[os.environ['TF_SECURITY_GROUP_ID']],
+        IamInstanceProfile={'Name': os.environ['TF_INSTANCE_PROFILE_NAME']},
+        UserData=BAKE_SCRIPT,
+        InstanceInitiatedShutdownBehavior='stop',
+        TagSpecifications=[{'ResourceType': 'instance', 'Tags': [{'Key': 'Name', 'Value': f"{name}-builder"}]}]
+    )
+    instance_id = response['Instances'][0]['InstanceId']
+    logger.info(f"Baking {name} on builder instance {instance_id}...")
+    try:
+        ec2_client.get_waiter('instance_stopped').wait(InstanceIds=[instance_id], WaiterConfig={'Delay': 15, 'MaxAttempts': 80})
+        image_id = ec2_client.create_image(InstanceId=instance_id, Name=name)['ImageId']
+        logger.info(f"Waiting for {image_id} to become available...")
+        ec2_client.get_waiter('image_available').wait(ImageIds=[image_id], WaiterConfig={'Delay': 15, 'MaxAttempts': 80})
+    finally:
+        ec2_client.terminate_instances(InstanceIds=[instance_id])
+    return image_id
+
+if __name__ == '__main__':
+    image_id = bake_golden_ami(sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f"export SPOTTY_GOLDEN_AMI_ID={image_id}")
@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+
+MONITOR_PORT = 3928
+
+class StatsFetcher:
+    def __init__(self, ttl: Optional[float] = None, max_workers: Optional[int] = None, timeout: Optional[float] = None):
+        self.ttl = ttl if ttl is not None else float(os.environ.get('SPOTTY_STATS_CACHE_TTL', 5))
+        self.timeout = timeout if timeout is not None else float(os.environ.get('SPOTTY_STATS_TIMEOUT', 5))
+        max_workers = max_workers or int(os.environ.get('SPOTTY_STATS_WORKERS', 16))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='instance-stats')
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers))
+        self.cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self.inflight: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+
+    def scrape(self, ip: str, port: int = MONITOR_PORT) -> Dict[str, Any]:
+        try:
+            response = self.session.get(f"http://{ip}:{port}/stats", timeout=self.timeout)
+            return response.json()
+        except (requests.RequestException, ValueError) as e:
+            return {"error": str(e)}
+
+    def _scrape_and_cache(self, instance_id: str, ip: str, port: int = MONITOR_PORT) -> Dict[str, Any]:
+        # failures are cached too, so a dead instance costs one timeout per ttl rather than one per viewer
+        stats = self.scrape(ip, port)
+        self.store(instance_id, stats)
+        return stats
+
+    def cached(self, instance_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            cached = self.cache.get(instance_id)
+        if cached and time.time() - cached[0] < self.ttl:
+            return cached[1]
+        return None
+
+    def store(self, instance_id: str, stats: Dict[str, Any]):
+        with self.lock:
+            self.cache[instance_id] = (time.time(), stats)
+            self.inflight.pop(instance_id, None)
+
+    def submit(self, instance: Dict[str, Any]) -> Future:
+        instance_id = instance['id']
+        with self.lock:
+            cached = self.cache.get(instance_id)
+            if cached and time.time() - cached[0] < self.ttl:
+                future = Future()
+                future.set_result(cached[1])
+                return future
+            # share one scrape between concurrent callers
+            future = self.inflight.get(instance_id)
+            if future is None:
+                # packed replicas each run their own monitor on a host port next to the app's
+                future = self.executor.submit(self._scrape_and_cache, instance_id, instance['ip'],
+                                              instance.get('stats_port') or MONITOR_PORT)
+                self.inflight[instance_id] = future
+            return future
+
+    def fetch(self, instance: Dict[str, Any]) -> Dict[str, Any]:
+        return self.submit(instance).result()
+
+    def fetch_many(self, instances: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        futures = {instance['id']: self.submit(instance) for instance in instances if instance.get('ip')}
+        return {instance_id: future.result() for instance_id, future in futures.items()}
+
+    def forget(self, instance_id: str):
+        with self.lock:
+            self.cache.pop(instance_id, None)
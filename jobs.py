@@ -0,0 +1,137 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional
+from logging_config import logger
+
+JOB_QUEUED = 'queued'
+JOB_REQUESTED = 'requested'
+JOB_FULFILLED = 'fulfilled'
+JOB_IP_ASSIGNED = 'ip-assigned'
+JOB_FAILED = 'failed'
+JOB_SUCCEEDED = 'succeeded'
+
+class JobQueue:
+    def __init__(self, max_workers: Optional[int] = None, max_jobs: int = 500):
+        max_workers = max_workers or int(os.environ.get('SPOTTY_SCALE_UP_WORKERS', 4))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scale-up')
+        self.max_jobs = max_jobs
+        self.jobs: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self.lock = threading.Lock()
+        self.tasks = set()  # strong references to running async jobs
+
+    def submit(self, app_name: str, fn: Callable[[Callable[..., None]], Any], count: int = 1,
+               reason: str = 'scale_up') -> Dict[str, Any]:
+        # fn receives a progress(status, **details) callback and returns the job result
+        job_id = self.create(app_name, count, reason)
+        self.executor.submit(self._run, job_id, fn)
+        return self.get(job_id)
+
+    def submit_async(self, app_name: str, fn: Callable[[Callable[..., None]], Awaitable[Any]], count: int = 1,
+                     reason: str = 'scale_up') -> Dict[str, Any]:
+        # same as submit, but fn is a coroutine function run as a task on the caller's event loop
+        job_id = self.create(app_name, count, reason)
+        task = asyncio.get_running_loop().create_task(self._run_async(job_id, fn))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return self.get(job_id)
+
+    def create(self, app_name: str, count: int, reason: str) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        job = {
+            'id': job_id,
+            'app_name': app_name,
+            'count': count,
+            'reason': reason,
+            'status': JOB_QUEUED,
+            'done': False,
+            'error': None,
+            'result': None,
+            'created_at': now,
+            'updated_at': now,
+            'history': [{'status': JOB_QUEUED, 'time': now}]
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+            self._prune()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return {**job, 'history': list(job['history'])}
+
+    def list(self, app_name: Optional[str] = None):
+        with self.lock:
+            job_ids = [job_id for job_id, job in self.jobs.items() if app_name is None or job['app_name'] == app_name]
+        return [self.get(job_id) for job_id in job_ids]
+
+    def pending_count(self, app_name: str) -> int:
+        # instances that running jobs are still bringing up for an app
+        with self.lock:
+            return sum(job['count'] for job in self.jobs.values() if job['app_name'] == app_name and not job['done'])
+
+    def last_failure(self, app_name: str, reason: Optional[str] = None) -> Optional[float]:
+        with self.lock:
+            failures = [job['updated_at'] for job in self.jobs.values()
+                        if job['app_name'] == app_name and job['status'] == JOB_FAILED
+                        and (reason is None or job['reason'] == reason)]
+        return max(failures) if failures else None
+
+    def update(self, job_id: str, status: str, **details):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            now = time.time()
+            job['status'] = status
+            job['updated_at'] = now
+            if details.get('error'):
+                job['error'] = details['error']
+            job['history'].append({'status': status, 'time': now, **details})
+
+    def _run(self, job_id: str, fn: Callable[[Callable[..., None]], Any]):
+        try:
+            self.finish(job_id, fn(self.progress(job_id)))
+        except Exception as e:
+            self.fail(job_id, e)
+
+    async def _run_async(self, job_id: str, fn: Callable[[Callable[..., None]], Awaitable[Any]]):
+        try:
+            self.finish(job_id, await fn(self.progress(job_id)))
+        except Exception as e:
+            self.fail(job_id, e)
+
+    def progress(self, job_id: str) -> Callable[..., None]:
+        def progress(status: str, **details):
+            self.update(job_id, status, **details)
+        return progress
+
+    def finish(self, job_id: str, result: Any):
+        # a job that reported a failure along the way (a partial scale-up, a rolled back deploy) stays failed
+        with self.lock:
+            job = self.jobs[job_id]
+            now = time.time()
+            if job['status'] != JOB_FAILED:
+                job['status'] = JOB_SUCCEEDED
+                job['history'].append({'status': JOB_SUCCEEDED, 'time': now})
+            job.update(done=True, result=result, updated_at=now)
+
+    def fail(self, job_id: str, e: Exception):
+        logger.exception(f"Job {job_id} failed: {str(e)}")
+        self.update(job_id, JOB_FAILED, error=str(e))
+        with self.lock:
+            self.jobs[job_id]['done'] = True
+
+    def _prune(self):
+        # drop the oldest finished jobs once we are over the retention limit
+        finished = [job_id for job_id, job in self.jobs.items() if job['done']]
+        while len(self.jobs) > self.max_jobs and finished:
+            del self.jobs[finished.pop(0)]
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+from botocore.exceptions import ClientError
+from aws_clients import get_client
+from logging_config import logger
+
+TEMPLATE_PREFIX = 'spotty-'
+
+def launch_templates_enabled() -> bool:
+    return os.environ.get('SPOTTY_LAUNCH_TEMPLATES', '').lower() in ('1', 'true', 'yes')
+
+def fingerprint(template_data: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(template_data, sort_keys=True).encode()).hexdigest()
+
+class LaunchTemplateManager:
+    def __init__(self):
+        # (region, app name) -> (fingerprint, template id, version); templates are regional
+        self.templates: Dict[Tuple[Optional[str], str], Tuple[str, str, int]] = {}
+        self.lock = threading.Lock()
+
+    def ensure(self, app_name: str, template_data: Dict[str, Any], region: Optional[str] = None) -> Tuple[str, int]:
+        # user data embeds the ECR URI and env vars, so any change to either yields a new version
+        digest = fingerprint(template_data)
+        with self.lock:
+            cached = self.templates.get((region, app_name))
+            if cached and cached[0] == digest:
+                return cached[1], cached[2]
+            template_id, version = self._sync(f"{TEMPLATE_PREFIX}{app_name}", digest, template_data, region)
+            self.templates[(region, app_name)] = (digest, template_id, version)
+            return template_id, version
+
+    def _sync(self, template_name: str, digest: str, template_data: Dict[str, Any],
+              region: Optional[str] = None) -> Tuple[str, int]:
+        ec2_client = get_client('ec2', region)
+        try:
+            response = ec2_client.describe_launch_templates(LaunchTemplateNames=[template_name])
+            template_id = response['LaunchTemplates'][0]['LaunchTemplateId']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidLaunchTemplateName.NotFoundException':
+                raise
+            response = ec2_client.create_launch_template(
+                LaunchTemplateName=template_name,
+                VersionDescription=digest,
+                LaunchTemplateData=template_data
+            )
+            template = response['LaunchTemplate']
+            logger.info(f"Created launch template {template_name} ({template['LaunchTemplateId']})")
+            return template['LaunchTemplateId'], template['LatestVersionNumber']
+
+        latest = ec2_client.describe_launch_template_versions(
+            LaunchTemplateId=template_id, Versions=['$Latest']
+        )['LaunchTemplateVersions'][0]
+        if latest.get('VersionDescription') == digest:
+            return template_id, latest['VersionNumber']
+
+        version = ec2_client.create_launch_template_version(
+            LaunchTemplateId=template_id,
+            VersionDescription=digest,
+            LaunchTemplateData=template_data
+        )['LaunchTemplateVersion']['VersionNumber']
+        ec2_client.modify_launch_template(LaunchTemplateId=template_id, DefaultVersion=str(version))
+        logger.info(f"Launch template {template_name} is now at version {version}")
+        return template_id, version
+
+launch_template_manager = LaunchTemplateManager()
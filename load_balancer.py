@@ -0,0 +1,205 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from logging_config import logger
+from state_manager import StateManager
+
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                      'te', 'trailers', 'transfer-encoding', 'upgrade', 'host'}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+class NoHealthyBackend(Exception):
+    pass
+
+class UpstreamError(Exception):
+    pass
+
+class Backend:
+    def __init__(self, instance_id: str, ip: str):
+        self.instance_id = instance_id
+        self.ip = ip
+        self.healthy = False
+        self.draining = False  # finishing its in-flight requests before it is retired
+        self.failures = 0
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'instance_id': self.instance_id, 'ip': self.ip, 'healthy': self.healthy, 'draining': self.draining,
+                'failures': self.failures, 'outstanding': self.outstanding, 'requests': self.requests,
+                'errors': self.errors}
+
+def forwarded_headers(headers) -> Dict[str, str]:
+    return {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+
+def address(instance: Dict[str, Any]) -> str:
+    # packed replicas share their host's ip and listen on a host port of their own
+    return f"{instance['ip']}:{instance['port']}" if instance.get('port') else instance['ip']
+
+class LoadBalancer:
+    def __init__(self, state_manager: StateManager, interval: Optional[float] = None,
+                 timeout: Optional[float] = None, pool_size: Optional[int] = None):
+        self.state_manager = state_manager
+        self.interval = interval if interval is not None else float(os.environ.get('SPOTTY_LB_HEALTH_INTERVAL', 5))
+        self.timeout = timeout if timeout is not None else float(os.environ.get('SPOTTY_LB_TIMEOUT', 30))
+        self.health_path = os.environ.get('SPOTTY_LB_HEALTH_PATH', '/')
+        self.unhealthy_after = 2  # consecutive failed checks before an instance stops getting traffic
+        pool_size = pool_size or int(os.environ.get('SPOTTY_LB_POOL_SIZE', 64))
+        # keep-alive connections to every instance are reused across proxied requests
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self.executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='lb-health')
+        self.backends: Dict[str, Dict[str, Backend]] = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='load-balancer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.sync()
+                self.check()
+            except Exception as e:
+                logger.exception(f"Error health checking instances: {str(e)}")
+
+    def sync(self, app_name: Optional[str] = None) -> List[Backend]:
+        # mirror the live instances in state; reclaimed, interrupted or redeploying ones stop getting traffic right away
+        apps = self.state_manager.get_apps()
+        added = []
+        with self.lock:
+            for name, app in apps.items():
+                if app_name and name != app_name:
+                    continue
+                live = {instance['id']: address(instance) for instance in app['instances']
+                        if instance.get('ip') and not instance.get('interrupted') and not instance.get('deploying')}
+                backends = self.backends.setdefault(name, {})
+                for instance_id in set(backends) - set(live):
+                    del backends[instance_id]
+                for instance_id, ip in live.items():
+                    if instance_id not in backends or backends[instance_id].ip != ip:
+                        backends[instance_id] = Backend(instance_id, ip)
+                        added.append(backends[instance_id])
+            for name in set(self.backends) - set(apps):
+                del self.backends[name]
+        return added
+
+    def probe(self, backend: Backend) -> bool:
+        try:
+            return self.session.get(f"http://{backend.ip}{self.health_path}", timeout=2).status_code < 500
+        except requests.RequestException:
+            return False
+
+    def check(self, backends: Optional[List[Backend]] = None):
+        if backends is None:
+            with self.lock:
+                backends = [backend for app_backends in self.backends.values() for backend in app_backends.values()]
+        for backend, healthy in zip(backends, self.executor.map(self.probe, backends)):
+            self.observe(backend, healthy)
+
+    def observe(self, backend: Backend, healthy: bool):
+        with self.lock:
+            if healthy:
+                if not backend.healthy:
+                    logger.info(f"Instance {backend.instance_id} is healthy, sending it traffic")
+                backend.healthy, backend.failures = True, 0
+            else:
+                backend.failures += 1
+                if backend.healthy and backend.failures >= self.unhealthy_after:
+                    logger.info(f"Instance {backend.instance_id} failed {backend.failures} health checks, taking it out")
+                    backend.healthy = False
+
+    def pick(self, app_name: str, exclude: Optional[set] = None) -> Backend:
+        if app_name not in self.backends:
+            # first request for an app: don't wait for the next health check round
+            self.check(self.sync(app_name))
+        with self.lock:
+            candidates = [backend for backend in self.backends.get(app_name, {}).values()
+                          if backend.healthy and not backend.draining and backend.instance_id not in (exclude or ())]
+            if not candidates:
+                raise NoHealthyBackend(f"No healthy instances for {app_name}")
+            # least outstanding requests, ties broken at random so idle instances share the load
+            fewest = min(backend.outstanding for backend in candidates)
+            backend = random.choice([b for b in candidates if b.outstanding == fewest])
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def forward(self, app_name: str, method: str, path: str, query_string: bytes, headers,
+                body: bytes, client_ip: Optional[str] = None) -> Tuple[requests.Response, Callable[[], None]]:
+        # returns the streamed upstream response and a release() to call once it has been relayed
+        headers = forwarded_headers(headers)
+        if client_ip:
+            headers['X-Forwarded-For'] = ', '.join(filter(None, [headers.get('X-Forwarded-For'), client_ip]))
+        headers['X-Forwarded-Prefix'] = f"/proxy/{app_name}"
+        url_suffix = f"{path}?{query_string.decode()}" if query_string else path
+        tried = set()
+        while True:
+            backend = self.pick(app_name, tried)
+            tried.add(backend.instance_id)
+            try:
+                upstream = self.session.request(method, f"http://{backend.ip}{url_suffix}", headers=headers, data=body,
+                                                stream=True, allow_redirects=False, timeout=self.timeout)
+            except requests.RequestException as e:
+                self.release(backend)
+                with self.lock:
+                    backend.errors += 1
+                self.observe(backend, False)
+                # a connect timeout never reached the app, so any request can go to the next instance
+                retryable = isinstance(e, requests.ConnectTimeout) or (
+                    isinstance(e, requests.ConnectionError) and method in IDEMPOTENT_METHODS)
+                if retryable and len(tried) < 3:
+                    continue
+                raise UpstreamError(f"{backend.instance_id}: {str(e)}")
+
+            def release(upstream=upstream, backend=backend):
+                upstream.close()
+                self.release(backend)
+            return upstream, release
+
+    def release(self, backend: Backend):
+        with self.lock:
+            backend.outstanding -= 1
+
+    def drain(self, app_name: str, instance_ids: List[str], grace: float) -> int:
+        # stops new requests to the instances and waits up to grace seconds for the ones in flight;
+        # returns how many were still outstanding when it gave up
+        self.sync(app_name)
+        with self.lock:
+            backends = [backend for instance_id, backend in self.backends.get(app_name, {}).items()
+                        if instance_id in instance_ids]
+            for backend in backends:
+                backend.draining = True
+        deadline = time.time() + grace
+        while True:
+            with self.lock:
+                outstanding = sum(backend.outstanding for backend in backends)
+            if outstanding == 0 or time.time() >= deadline:
+                return outstanding
+            time.sleep(0.1)
+
+    def undrain(self, app_name: str, instance_ids: List[str]):
+        # puts instances that were drained but then kept back into rotation
+        with self.lock:
+            for instance_id, backend in self.backends.get(app_name, {}).items():
+                if instance_id in instance_ids:
+                    backend.draining = False
+
+    def snapshot(self) -> Dict[str, List[Dict[str, Any]]]:
+        with self.lock:
+            return {app_name: [backend.to_dict() for backend in backends.values()]
+                    for app_name, backends in self.backends.items()}
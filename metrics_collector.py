@@ -0,0 +1,47 @@
+import os
+import threading
+import time
+from typing import Optional
+from instance_stats import StatsFetcher
+from logging_config import logger
+from state_manager import StateManager
+from timeseries import MetricsStore
+
+class MetricsCollector:
+    def __init__(self, state_manager: StateManager, stats_fetcher: StatsFetcher,
+                 store: Optional[MetricsStore] = None, interval: Optional[float] = None):
+        self.state_manager = state_manager
+        self.stats_fetcher = stats_fetcher
+        self.store = store or MetricsStore()
+        self.interval = interval if interval is not None else float(os.environ.get('SPOTTY_METRICS_INTERVAL', 10))
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='metrics-collector', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            started = time.time()
+            try:
+                self.collect()
+            except Exception as e:
+                logger.exception(f"Error collecting instance metrics: {str(e)}")
+            self.stop_event.wait(max(0, self.interval - (time.time() - started)))
+
+    def collect(self):
+        instances = self.state_manager.get_all_instances()
+        now = time.time()
+        for instance_id, stats in self.stats_fetcher.fetch_many(instances).items():
+            if 'error' not in stats:
+                self.store.record(instance_id, now, stats)
+        live_ids = {instance['id'] for instance in instances}
+        for instance_id in self.store.instance_ids():
+            if instance_id not in live_ids:
+                self.store.drop(instance_id)
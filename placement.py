@@ -0,0 +1,202 @@
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+from ec2_spot import create_instances, start_containers_script, stop_containers_script, terminate_instance
+from logging_config import logger
+from pool_selector import env_list
+from quota_tracker import quota_tracker
+from ssm_commands import run_commands
+from state_manager import StateManager
+
+DEFAULT_RESOURCES = {'cpu': 0.25, 'memory': 256}
+# host ports handed out to packed containers, in (app, stats) pairs
+HOST_PORT_RANGE = (8000, 8998)
+# left for the OS, Docker and the monitor containers
+RESERVED_MEMORY = 512
+
+def free_capacity(host: Dict[str, Any]) -> Dict[str, float]:
+    used_cpu = sum(allocation['cpu'] for allocation in host['allocations'].values())
+    used_memory = sum(allocation['memory'] for allocation in host['allocations'].values())
+    return {'cpu': host['capacity']['cpu'] - used_cpu, 'memory': host['capacity']['memory'] - used_memory}
+
+def choose_host(hosts: List[Dict[str, Any]], resources: Dict[str, float]) -> Optional[Dict[str, Any]]:
+    # best fit: the host that is left with the least spare room (by its scarcer resource) after placing
+    best, best_leftover = None, None
+    for host in hosts:
+        if host.get('draining'):
+            continue
+        free = free_capacity(host)
+        if free['cpu'] < resources['cpu'] or free['memory'] < resources['memory']:
+            continue
+        leftover = min((free['cpu'] - resources['cpu']) / host['capacity']['cpu'],
+                       (free['memory'] - resources['memory']) / host['capacity']['memory'])
+        if best_leftover is None or leftover < best_leftover:
+            best, best_leftover = host, leftover
+    return best
+
+def free_port(host: Dict[str, Any]) -> Optional[int]:
+    used = {allocation['port'] for allocation in host['allocations'].values()}
+    for port in range(HOST_PORT_RANGE[0], HOST_PORT_RANGE[1], 2):
+        if port not in used:
+            return port
+    return None
+
+def price_share(host: Dict[str, Any], resources: Dict[str, float]) -> float:
+    # a replica pays for the larger of its cpu and memory fractions of the host
+    share = max(resources['cpu'] / host['capacity']['cpu'], resources['memory'] / host['capacity']['memory'])
+    return host['spot_price'] * min(share, 1.0)
+
+class PlacementEngine:
+    def __init__(self, state_manager: StateManager, interval: Optional[float] = None):
+        self.state_manager = state_manager
+        self.interval = interval if interval is not None else float(os.environ.get('SPOTTY_PLACEMENT_INTERVAL', 60))
+        self.idle_timeout = float(os.environ.get('SPOTTY_HOST_IDLE_TIMEOUT', 600))
+        self.command_timeout = float(os.environ.get('SPOTTY_PLACEMENT_COMMAND_TIMEOUT', 300))
+        self.host_types = env_list('SPOTTY_HOST_INSTANCE_TYPES', 'SPOTTY_HOST_INSTANCE_TYPE') or ['t3.large', 't3a.large', 'm5.large']
+        self.lock = threading.Lock()
+        # only one host launch at a time; placements waiting on it re-check for room afterwards
+        self.launch_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='placement', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.retire_idle_hosts()
+            except Exception as e:
+                logger.exception(f"Error retiring idle hosts: {str(e)}")
+
+    def resources(self, app_name: str) -> Dict[str, float]:
+        return {**DEFAULT_RESOURCES, **self.state_manager.get_app(app_name).get('resources', {})}
+
+    def launch_host(self, ecr_image_uri: str) -> Optional[Dict[str, Any]]:
+        # hosts boot like warm-pool standbys: Docker ready and the first app's image pulled, nothing running
+        name = f"spotty-host-{uuid.uuid4().hex[:6]}"
+        instances = create_instances(ecr_image_uri, [name], {}, app_name='hosts',
+                                     launch_spec={'instance_types': self.host_types}, standby=True)
+        if not instances:
+            return None
+        instance = instances[0]
+        info = quota_tracker.describe_instance_type(instance['instance_type']) or {'vcpus': 2, 'memory': 4096}
+        host = {
+            **{k: v for k, v in instance.items() if k != 'trace'},
+            'capacity': {'cpu': float(info['vcpus']), 'memory': float(info['memory'] - RESERVED_MEMORY)},
+            'allocations': {},
+            'attributed_cost': 0.0,
+            'idle_since': time.time()
+        }
+        self.state_manager.add_host(host)
+        logger.info(f"Launched host {host['id']} ({host['instance_type']}) with {host['capacity']} to pack containers on")
+        return host
+
+    def _reserve(self, app_name: str, name: str, resources: Dict[str, float]) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            host = choose_host(list(self.state_manager.get_hosts().values()), resources)
+            if host is None:
+                return None
+            port = free_port(host)
+            if port is None:
+                return None
+            replica_id = f"{host['id']}:{port}"
+            self.state_manager.allocate(host['id'], replica_id, {'app_name': app_name, 'name': name, 'port': port, **resources})
+            return {
+                'id': replica_id,
+                'ip': host['ip'],
+                'port': port,
+                'stats_port': port + 1,
+                'host_id': host['id'],
+                'name': name,
+                'spot_price': price_share(host, resources),
+                'time_now': time.time(),
+                'instance_type': host.get('instance_type'),
+                'az': host.get('az'),
+                'resources': resources,
+                'boot_mode': 'packed'
+            }
+
+    def reserve(self, app_name: str, name: str, resources: Dict[str, float], ecr_image_uri: str) -> Optional[Dict[str, Any]]:
+        replica = self._reserve(app_name, name, resources)
+        if replica:
+            return replica
+        with self.launch_lock:
+            # another placement may have launched a host with room while we waited
+            replica = self._reserve(app_name, name, resources)
+            if replica is None and self.launch_host(ecr_image_uri):
+                replica = self._reserve(app_name, name, resources)
+            return replica
+
+    def place(self, app_name: str, instance_names: List[str], env_vars: Dict[str, str],
+              on_progress: Optional[Callable[..., None]] = None) -> List[Dict[str, Any]]:
+        started = time.time()
+        resources = self.resources(app_name)
+        ecr_image_uri = self.state_manager.get_ecr_image_uri(app_name)
+        reserved = []
+        for name in instance_names:
+            replica = self.reserve(app_name, name, resources, ecr_image_uri)
+            if replica is None:
+                logger.error(f"No room to place {name} ({resources}) and no host could be launched")
+                break
+            reserved.append(replica)
+        if on_progress and reserved:
+            on_progress('placed', replicas={replica['name']: replica['host_id'] for replica in reserved})
+
+        by_host: Dict[str, List[Dict[str, Any]]] = {}
+        for replica in reserved:
+            by_host.setdefault(replica['host_id'], []).append(replica)
+        placed = []
+        for host_id, replicas in by_host.items():
+            commands = start_containers_script(ecr_image_uri, env_vars, pull=True, replace=True, **self.container(replicas[0]))
+            for replica in replicas[1:]:
+                commands += start_containers_script(ecr_image_uri, env_vars, replace=True, preamble=False,
+                                                    **self.container(replica))
+            try:
+                ok = run_commands([host_id], commands, timeout=self.command_timeout,
+                                  comment=f"spotty place {app_name}")[host_id] == 'Success'
+            except Exception as e:
+                logger.error(f"Error starting containers for {app_name} on {host_id}: {str(e)}")
+                ok = False
+            for replica in replicas:
+                if ok:
+                    placed.append({**replica, 'ecr_image_uri': ecr_image_uri,
+                                   'provisioning': {'attempts': 0, 'seconds': round(time.time() - started, 2)}})
+                else:
+                    self.state_manager.release(host_id, replica['id'])
+        return placed
+
+    def container(self, replica: Dict[str, Any]) -> Dict[str, Any]:
+        resources = replica['resources']
+        return {'name': replica['name'], 'port': replica['port'], 'stats_port': replica['stats_port'],
+                'limits': f"--cpus {resources['cpu']} --memory {int(resources['memory'])}m "}
+
+    def stop_replica(self, replica: Dict[str, Any]):
+        # the allocation itself is released when the replica is removed from state
+        try:
+            run_commands([replica['host_id']], stop_containers_script(replica['name']), timeout=60,
+                         comment=f"spotty stop {replica['name']}")
+        except Exception as e:
+            logger.error(f"Error stopping {replica['name']} on {replica['host_id']}: {str(e)}")
+
+    def retire_idle_hosts(self):
+        now = time.time()
+        for host_id in list(self.state_manager.get_hosts()):
+            # checked again under the lock _reserve allocates under, so nothing lands on the host
+            # between the check and its removal; it is only terminated once nothing can
+            with self.lock:
+                host = self.state_manager.get_hosts().get(host_id)
+                if not host or host['allocations'] or now - host.get('idle_since', now) <= self.idle_timeout:
+                    continue
+                if not self.state_manager.remove_host(host_id):
+                    continue
+            logger.info(f"Host {host_id} has been empty for {self.idle_timeout:.0f}s, terminating it")
+            terminate_instance(host_id)
@@ -0,0 +1,179 @@
+import os
+import statistics
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+from aws_clients import get_client
+from bidding import DEFAULT_BID, bid_planner, price_history
+from logging_config import logger
+from quota_tracker import quota_for
+from regions import enabled_regions, home_region, region_config
+
+# spot request status codes that mean the pool itself is out of capacity
+CAPACITY_CODES = {'capacity-not-available', 'capacity-oversubscribed', 'InsufficientInstanceCapacity'}
+
+class Pool(NamedTuple):
+    instance_type: str
+    subnet_id: str
+    az: Optional[str]
+    region: Optional[str] = None  # None is the home region
+
+def env_list(name: str, fallback: str) -> List[str]:
+    value = os.environ.get(name) or os.environ.get(fallback, '')
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def default_launch_spec() -> Dict[str, List[str]]:
+    return {
+        'instance_types': env_list('TF_INSTANCE_TYPES', 'TF_INSTANCE_TYPE'),
+        'subnet_ids': env_list('TF_SUBNET_IDS', 'TF_SUBNET_ID')
+    }
+
+class PoolSelector:
+    def __init__(self):
+        self.stats: Dict[Pool, Dict[str, float]] = {}
+        self.subnet_azs: Dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.alpha = 0.3  # weight of the newest observation in the moving averages
+        self.failure_penalty = float(os.environ.get('SPOTTY_POOL_FAILURE_PENALTY', 2))
+        self.latency_scale = float(os.environ.get('SPOTTY_POOL_LATENCY_SCALE', 60))
+        self.cooldown = float(os.environ.get('SPOTTY_POOL_COOLDOWN', 300))
+
+    def resolve_azs(self, subnet_ids: List[str], region: Optional[str] = None) -> Dict[str, str]:
+        missing = [subnet_id for subnet_id in subnet_ids if subnet_id not in self.subnet_azs]
+        if missing:
+            try:
+                for subnet in get_client('ec2', region).describe_subnets(SubnetIds=missing)['Subnets']:
+                    self.subnet_azs[subnet['SubnetId']] = subnet['AvailabilityZone']
+            except Exception as e:
+                logger.error(f"Error describing subnets {missing}: {str(e)}")
+        return {subnet_id: self.subnet_azs.get(subnet_id) for subnet_id in subnet_ids}
+
+    def pools(self, launch_spec: Optional[Dict[str, List[str]]] = None) -> List[Pool]:
+        # the app's subnets in the home region, terraform's subnets in any other region it allows
+        spec = {**default_launch_spec(), **{k: v for k, v in (launch_spec or {}).items() if v}}
+        pools = []
+        for region in spec.get('regions') or [home_region()]:
+            try:
+                subnet_ids = region_config(region)['subnet_ids'] or spec['subnet_ids']
+            except ValueError as e:
+                logger.error(str(e))
+                continue
+            azs = self.resolve_azs(subnet_ids, region)
+            pools += [Pool(instance_type, subnet_id, azs[subnet_id], region)
+                      for instance_type in spec['instance_types'] for subnet_id in subnet_ids]
+        return pools
+
+    def price(self, pool: Pool) -> float:
+        prices = price_history.prices(pool.instance_type, pool.az, region=pool.region)
+        return statistics.median(prices) if prices else DEFAULT_BID
+
+    def score(self, pool: Pool) -> float:
+        # lower is better: recent price, inflated by how often and how slowly the pool has fulfilled
+        stats = self.stats.get(pool, {})
+        return (self.price(pool)
+                * (1 + self.failure_penalty * stats.get('failure_rate', 0))
+                * (1 + stats.get('latency', 0) / self.latency_scale))
+
+    def out_of_quota(self, pools: List[Pool]) -> set:
+        # pools in a region whose spot vCPU quota can't fit another instance of their type;
+        # only worth the quota lookups when there is another region to go to
+        if len({pool.region for pool in pools}) < 2:
+            return set()
+        headroom = {}
+        for region in {pool.region for pool in pools}:
+            try:
+                headroom[region] = quota_for(region).headroom()
+            except Exception as e:
+                logger.error(f"Error checking the spot quota in {region}: {str(e)}")
+                headroom[region] = None
+        return {pool for pool in pools if headroom[pool.region] is not None
+                and headroom[pool.region] < quota_for(pool.region).get_instance_vcpus(pool.instance_type)}
+
+    def rank(self, launch_spec: Optional[Dict[str, List[str]]] = None) -> List[Pool]:
+        # across every region the app allows: pools with room under the quota first, then recent
+        # price, failure rate and fulfillment latency decide
+        now = time.time()
+        with self.lock:
+            cooling = {pool for pool, stats in self.stats.items() if stats.get('cooldown_until', 0) > now}
+        pools = self.pools(launch_spec)
+        full = self.out_of_quota(pools)
+        ranked = sorted(pools, key=lambda pool: (pool in cooling, pool in full, self.score(pool)))
+        logger.info(f"Pool ranking: {[f'{p.instance_type}/{p.az or p.subnet_id}' for p in ranked]}")
+        return ranked
+
+    def regions(self, instance_types: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        # every enabled region with its cheapest pool, observed fulfillment and quota headroom, best first
+        spec = {'regions': enabled_regions(), 'instance_types': instance_types or []}
+        pools = self.pools(spec)
+        with self.lock:
+            stats = dict(self.stats)
+        summary = []
+        for region in spec['regions']:
+            regional = [pool for pool in pools if pool.region == region]
+            if not regional:
+                continue
+            best = min(regional, key=self.score)
+            tried = [stats[pool] for pool in regional if pool in stats]
+            usage, quota = quota_for(region).check()
+            summary.append({
+                'region': region,
+                'best_pool': best._asdict(),
+                'price': self.price(best),
+                'score': self.score(best),
+                'latency': statistics.mean(s['latency'] for s in tried) if tried else None,
+                'failure_rate': statistics.mean(s['failure_rate'] for s in tried) if tried else None,
+                'quota_usage': usage,
+                'quota': quota,
+                'out_of_quota': quota != "Unknown" and quota - usage < quota_for(region).get_instance_vcpus(best.instance_type)
+            })
+        return sorted(summary, key=lambda r: (r['out_of_quota'], r['score']))
+
+    def _observe(self, pool: Pool, failed: bool, latency: Optional[float] = None):
+        with self.lock:
+            stats = self.stats.setdefault(pool, {'failure_rate': 0.0, 'latency': 0.0, 'attempts': 0})
+            stats['failure_rate'] += self.alpha * (float(failed) - stats['failure_rate'])
+            if latency is not None:
+                stats['latency'] = latency if stats['attempts'] == 0 else stats['latency'] + self.alpha * (latency - stats['latency'])
+            stats['attempts'] += 1
+            if failed:
+                stats['cooldown_until'] = time.time() + self.cooldown
+
+    def record_success(self, pool: Pool, latency: float):
+        self._observe(pool, False, latency)
+
+    def record_failure(self, pool: Pool):
+        self._observe(pool, True)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            stats = dict(self.stats)
+        return [{**pool._asdict(), **s, 'price': self.price(pool), 'score': self.score(pool)} for pool, s in stats.items()]
+
+class PoolCursor:
+    def __init__(self, pools: List[Pool]):
+        if not pools:
+            raise EnvironmentError("No instance types or subnets configured to launch into")
+        self.pools = pools
+        self.index = 0
+        self.price = bid_planner.opening_bid(self.pool.instance_type, self.pool.az, region=self.pool.region)
+
+    @property
+    def pool(self) -> Pool:
+        return self.pools[self.index]
+
+    def escalate(self):
+        self.price = bid_planner.next_bid(self.price, self.pool.instance_type, self.pool.az, region=self.pool.region)
+        logger.info(f"Increasing price to ${self.price:.4f} and retrying...")
+
+    def fail_over(self) -> bool:
+        # move to the next pool; once every pool has been tried, keep bidding up in the last one
+        pool_selector.record_failure(self.pool)
+        if self.index + 1 >= len(self.pools):
+            self.escalate()
+            return False
+        self.index += 1
+        self.price = bid_planner.opening_bid(self.pool.instance_type, self.pool.az, region=self.pool.region)
+        logger.info(f"Failing over to {self.pool.instance_type} in {self.pool.az or self.pool.subnet_id}")
+        return True
+
+pool_selector = PoolSelector()
@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple, Union
+from aws_clients import get_client
+from logging_config import logger
+from regions import home_region
+from telemetry import quota_check_seconds
+
+SPOT_QUOTA_CODE = 'L-34B43A08'  # code for "All Standard (A, C, D, H, I, M, R, T, Z) Spot Instance Requests"
+
+# only consulted when describe_instance_types is unavailable
+FALLBACK_VCPUS = {
+    't2.micro': 1, 't2.small': 1, 't2.medium': 2, 't2.large': 2,
+    'm5.large': 2, 'm5.xlarge': 4, 'm5.2xlarge': 8,
+    'c5.large': 2, 'c5.xlarge': 4, 'c5.2xlarge': 8,
+    'r5.large': 2, 'r5.xlarge': 4, 'r5.2xlarge': 8
+}
+
+class QuotaTracker:
+    # spot vCPU quotas and usage are per region; region None is the home region
+    def __init__(self, quota_ttl: Optional[float] = None, reconcile_interval: Optional[float] = None,
+                 region: Optional[str] = None):
+        self.region = region
+        self.quota_ttl = quota_ttl if quota_ttl is not None else float(os.environ.get('SPOTTY_QUOTA_TTL', 3600))
+        self.reconcile_interval = reconcile_interval if reconcile_interval is not None else float(os.environ.get('SPOTTY_QUOTA_RECONCILE_INTERVAL', 300))
+        self.lock = threading.Lock()
+        self.quota_value: Union[float, str, None] = None
+        self.quota_fetched_at = 0.0
+        self.usage: Dict[str, int] = {}  # instance id (or open request id) -> vCPUs
+        self.vcpu_usage = 0
+        self.reconciled_at = 0.0
+        self.reconciling = False
+        self.instance_types: Dict[str, Dict[str, int]] = {}
+
+    def describe_instance_type(self, instance_type: str) -> Optional[Dict[str, int]]:
+        # vCPUs and memory (MiB) of an instance type, cached for the life of the process
+        info = self.instance_types.get(instance_type)
+        if info is not None:
+            return info
+        try:
+            response = get_client('ec2', self.region).describe_instance_types(InstanceTypes=[instance_type])
+            description = response['InstanceTypes'][0]
+        except Exception as e:
+            logger.error(f"Error describing instance type {instance_type}: {str(e)}")
+            return None
+        info = {'vcpus': description['VCpuInfo']['DefaultVCpus'], 'memory': description['MemoryInfo']['SizeInMiB']}
+        self.instance_types[instance_type] = info
+        return info
+
+    def get_instance_vcpus(self, instance_type: str) -> int:
+        info = self.describe_instance_type(instance_type)
+        if info is None:
+            return FALLBACK_VCPUS.get(instance_type, 2)
+        return info['vcpus']
+
+    def get_quota(self) -> Union[float, str]:
+        if self.quota_value is not None and time.time() - self.quota_fetched_at < self.quota_ttl:
+            return self.quota_value
+        try:
+            quota_response = get_client('service-quotas', self.region).get_service_quota(
+                ServiceCode='ec2',
+                QuotaCode=SPOT_QUOTA_CODE
+            )
+            quota_value = quota_response['Quota']['Value']
+        except Exception as e:
+            logger.exception(f"Error getting quota: {str(e)}")
+            # keep serving the last known quota, retry on the next check
+            return self.quota_value if self.quota_value is not None else "Unknown"
+        self.quota_value = quota_value
+        self.quota_fetched_at = time.time()
+        return quota_value
+
+    def record_launch(self, instance_id: str, instance_type: str):
+        vcpus = self.get_instance_vcpus(instance_type)
+        with self.lock:
+            self.vcpu_usage += vcpus - self.usage.get(instance_id, 0)
+            self.usage[instance_id] = vcpus
+
+    def record_termination(self, instance_id: str):
+        with self.lock:
+            self.vcpu_usage -= self.usage.pop(instance_id, 0)
+
+    def reconcile(self):
+        try:
+            usage = {}
+            paginator = get_client('ec2', self.region).get_paginator('describe_spot_instance_requests')
+            for page in paginator.paginate(Filters=[{'Name': 'state', 'Values': ['open', 'active']}]):
+                for request in page['SpotInstanceRequests']:
+                    key = request.get('InstanceId') or request['SpotInstanceRequestId']
+                    usage[key] = self.get_instance_vcpus(request['LaunchSpecification']['InstanceType'])
+            with self.lock:
+                self.usage = usage
+                self.vcpu_usage = sum(usage.values())
+                self.reconciled_at = time.time()
+            logger.info(f"Reconciled Spot Instance vCPU usage in {self.region or home_region()}: {self.vcpu_usage}")
+        finally:
+            with self.lock:
+                self.reconciling = False
+
+    def _reconcile_in_background(self):
+        try:
+            self.reconcile()
+        except Exception as e:
+            logger.exception(f"Error reconciling spot usage: {str(e)}")
+
+    def get_usage(self) -> int:
+        with self.lock:
+            never_reconciled = self.reconciled_at == 0
+            stale = time.time() - self.reconciled_at >= self.reconcile_interval
+            start_background = stale and not never_reconciled and not self.reconciling
+            if start_background:
+                self.reconciling = True
+        if never_reconciled:
+            self.reconcile()
+        elif start_background:
+            threading.Thread(target=self._reconcile_in_background, daemon=True).start()
+        return self.vcpu_usage
+
+    def check(self) -> Tuple[int, Union[float, str]]:
+        with quota_check_seconds.time():
+            return self.get_usage(), self.get_quota()
+
+    def headroom(self) -> Optional[float]:
+        # vCPUs still free under the quota, None when the quota is unknown
+        usage, quota = self.check()
+        return None if quota == "Unknown" else quota - usage
+
+quota_tracker = QuotaTracker()
+regional_trackers: Dict[str, QuotaTracker] = {}
+_regional_lock = threading.Lock()
+
+def quota_for(region: Optional[str]) -> QuotaTracker:
+    if not region or region == home_region():
+        return quota_tracker
+    with _regional_lock:
+        tracker = regional_trackers.get(region)
+        if tracker is None:
+            tracker = regional_trackers[region] = QuotaTracker(region=region)
+        return tracker
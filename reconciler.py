@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from aws_clients import get_client
+from instance_stats import StatsFetcher
+from jobs import JobQueue
+from logging_config import logger
+from quota_tracker import quota_for
+from regions import home_region, region_of
+from state_manager import StateManager
+
+GONE_STATES = {'shutting-down', 'terminated', 'stopping', 'stopped'}
+# spot request status codes AWS sets once the two-minute interruption notice is out
+INTERRUPTION_CODES = {'marked-for-termination', 'marked-for-stop', 'marked-for-hibernation'}
+FILTER_BATCH_SIZE = 200
+
+def chunks(items: List[str], size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def describe_instances(ec2_client, instance_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    # filters (unlike InstanceIds) don't fail the whole call when one id no longer exists
+    observed = {}
+    for batch in chunks(instance_ids, FILTER_BATCH_SIZE):
+        instance_filter = [{'Name': 'instance-id', 'Values': batch}]
+        paginator = ec2_client.get_paginator('describe_instances')
+        for page in paginator.paginate(Filters=instance_filter):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    observed[instance['InstanceId']] = {'state': instance['State']['Name'], 'interrupted': False}
+        paginator = ec2_client.get_paginator('describe_spot_instance_requests')
+        for page in paginator.paginate(Filters=instance_filter):
+            for request in page['SpotInstanceRequests']:
+                instance_id = request.get('InstanceId')
+                if instance_id in observed and request.get('Status', {}).get('Code') in INTERRUPTION_CODES:
+                    observed[instance_id]['interrupted'] = True
+    return observed
+
+class Reconciler:
+    def __init__(self, state_manager: StateManager, job_queue: JobQueue,
+                 launch: Callable[[str, int], Any], stats_fetcher: Optional[StatsFetcher] = None,
+                 ec2_client=None, interval: Optional[float] = None):
+        # launch(app_name, count) starts provisioning replacements for an app
+        self.state_manager = state_manager
+        self.job_queue = job_queue
+        self.launch = launch
+        self.stats_fetcher = stats_fetcher
+        self.ec2_client = ec2_client
+        self.interval = interval if interval is not None else float(os.environ.get('SPOTTY_RECONCILE_INTERVAL', 30))
+        self.backoff = float(os.environ.get('SPOTTY_REPLACEMENT_BACKOFF', 300))
+        self.launch_grace = 120
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='reconciler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.exception(f"Error reconciling instances: {str(e)}")
+
+    def describe(self, instance_ids: List[str], region: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        # an injected client stands for the home region
+        if self.ec2_client and region in (None, home_region()):
+            return describe_instances(self.ec2_client, instance_ids)
+        return describe_instances(get_client('ec2', region), instance_ids)
+
+    def interruption_notices(self, instances: List[Dict[str, Any]]) -> set:
+        # the on-instance monitor relays the metadata-service spot/instance-action notice
+        if not self.stats_fetcher:
+            return set()
+        stats = self.stats_fetcher.fetch_many(instances)
+        return {instance_id for instance_id, s in stats.items() if s.get('spot_interruption')}
+
+    def reconcile(self):
+        apps = self.state_manager.get_apps()
+        for app_name, app in apps.items():
+            if 'target_replicas' not in app:
+                # pin what the app runs today before any of it gets reclaimed
+                self.state_manager.adjust_target_replicas(app_name, 0)
+        tracked = {instance['id']: (app_name, instance)
+                   for app_name, app in apps.items() for instance in app['instances']}
+        hosts = self.state_manager.get_hosts()
+        if tracked or hosts:
+            # packed replicas live and die with the host they were placed on; one describe per region
+            ec2_ids: Dict[str, set] = {}
+            for instance_id, (_, instance) in tracked.items():
+                ec2_ids.setdefault(region_of(instance), set()).add(instance.get('host_id') or instance_id)
+            for host_id, host in hosts.items():
+                ec2_ids.setdefault(region_of(host), set()).add(host_id)
+            observed = {}
+            for region, ids in ec2_ids.items():
+                observed.update(self.describe(sorted(ids), region))
+            notices = self.interruption_notices([instance for _, instance in tracked.values()])
+        else:
+            observed, notices = {}, set()
+
+        for instance_id, (app_name, instance) in tracked.items():
+            status = observed.get(instance.get('host_id') or instance_id)
+            if status is None and time.time() - instance['time_now'] < self.launch_grace:
+                continue  # describe calls are eventually consistent for fresh launches
+            if status is None or status['state'] in GONE_STATES:
+                logger.info(f"Instance {instance_id} of {app_name} was reclaimed ({status['state'] if status else 'missing'}), closing it out")
+                self.state_manager.remove_instance(app_name, instance_id)
+                quota_for(region_of(instance)).record_termination(instance_id)
+                if self.stats_fetcher:
+                    self.stats_fetcher.forget(instance_id)
+            elif (status['interrupted'] or instance_id in notices) and not instance.get('interrupted'):
+                logger.info(f"Instance {instance_id} of {app_name} received a spot interruption notice")
+                self.state_manager.update_instance(app_name, instance_id, interrupted=True, interrupted_at=time.time())
+
+        for host_id, host in list(hosts.items()):
+            status = observed.get(host_id)
+            if status is None and time.time() - host['time_now'] < self.launch_grace:
+                continue
+            if status is None or status['state'] in GONE_STATES:
+                logger.info(f"Host {host_id} was reclaimed ({status['state'] if status else 'missing'}), closing it out")
+                self.state_manager.remove_host(host_id)
+                quota_for(region_of(host)).record_termination(host_id)
+
+        for app_name in apps:
+            self.replace_capacity(app_name)
+
+    def replace_capacity(self, app_name: str):
+        # instances under an interruption notice no longer count towards the target
+        healthy = sum(1 for instance in self.state_manager.get_instances(app_name) if not instance.get('interrupted'))
+        deficit = self.state_manager.get_target_replicas(app_name) - healthy - self.job_queue.pending_count(app_name)
+        if deficit <= 0:
+            return
+        last_failure = self.job_queue.last_failure(app_name, reason='replacement')
+        if last_failure and time.time() - last_failure < self.backoff:
+            logger.info(f"{app_name} is {deficit} instance(s) short but a recent replacement failed, backing off")
+            return
+        logger.info(f"Launching {deficit} replacement instance(s) for {app_name}")
+        self.launch(app_name, deficit)
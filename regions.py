@@ -0,0 +1,45 @@
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+# Regions Spotty may launch into. The home region (AWS_REGION) is described by the TF_* variables
+# as before; every other region terraform was asked to enable comes from TF_REGIONS, the JSON
+# `regions` output: {"us-west-2": {"ami_id": ..., "security_group_id": ..., "subnet_ids": [...]}}
+
+_parsed: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+def home_region() -> str:
+    return os.environ.get('AWS_REGION', '')
+
+def remote_regions() -> Dict[str, Dict[str, Any]]:
+    raw = os.environ.get('TF_REGIONS', '')
+    if raw not in _parsed:
+        regions = json.loads(raw) if raw else {}
+        for config in regions.values():
+            if isinstance(config.get('subnet_ids'), str):
+                config['subnet_ids'] = [s.strip() for s in config['subnet_ids'].split(',') if s.strip()]
+        _parsed[raw] = regions
+    return {name: config for name, config in _parsed[raw].items() if name != home_region()}
+
+def enabled_regions() -> List[str]:
+    return [home_region()] + sorted(remote_regions())
+
+def region_config(region: Optional[str]) -> Dict[str, Any]:
+    # AMI, security group and subnets to launch with in a region
+    if not region or region == home_region():
+        return {'ami_id': os.environ.get('TF_AMI_ID'), 'security_group_id': os.environ.get('TF_SECURITY_GROUP_ID'),
+                'subnet_ids': None}  # home subnets come from the launch spec / TF_SUBNET_IDS
+    config = remote_regions().get(region)
+    if config is None:
+        raise ValueError(f"Region '{region}' is not enabled, add it to the terraform extra_regions")
+    return config
+
+def region_of(instance: Dict[str, Any]) -> str:
+    # instances recorded before regions were tracked all run in the home region
+    return instance.get('region') or home_region()
+
+def group_by_region(instances: Iterable[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    grouped: Dict[str, List[Dict[str, Any]]] = {}
+    for instance in instances:
+        grouped.setdefault(region_of(instance), []).append(instance)
+    return grouped
@@ -17,8 +17,11 @@ fi
 # export outputs as envs
 export TF_AMI_ID=$(terraform output -raw ami_id)
 export TF_INSTANCE_TYPE=$(terraform output -raw instance_type)
+export TF_INSTANCE_TYPES=$(terraform output -raw instance_types)
 export TF_SECURITY_GROUP_ID=$(terraform output -raw security_group_id)
 export TF_SUBNET_ID=$(terraform output -raw subnet_id)
+export TF_SUBNET_IDS=$(terraform output -raw subnet_ids)
 export TF_INSTANCE_PROFILE_NAME=$(terraform output -raw instance_profile_name)
+export TF_REGIONS=$(terraform output -raw regions)
 
 cd "$ROOT_DIR"
\ No newline at end of file
@@ -0,0 +1,42 @@
+import time
+from typing import Dict, List, Optional
+from aws_clients import get_client
+from logging_config import logger
+
+PENDING_STATUSES = {'Pending', 'InProgress', 'Delayed'}
+
+def run_commands(instance_ids: List[str], commands: List[str], timeout: float = 120,
+                 comment: str = 'spotty', poll_interval: float = 2, region: Optional[str] = None) -> Dict[str, str]:
+    # runs a shell script on every instance (all in one region) through SSM Run Command and returns each one's final status
+    ssm_client = get_client('ssm', region)
+    response = ssm_client.send_command(
+        InstanceIds=instance_ids,
+        DocumentName='AWS-RunShellScript',
+        Parameters={'commands': commands},
+        Comment=comment[:100],
+        TimeoutSeconds=max(30, int(timeout))
+    )
+    command_id = response['Command']['CommandId']
+    deadline = time.time() + timeout
+    statuses: Dict[str, str] = {}
+    outputs: Dict[str, str] = {}
+    while True:
+        paginator = ssm_client.get_paginator('list_command_invocations')
+        for page in paginator.paginate(CommandId=command_id, Details=True):
+            for invocation in page['CommandInvocations']:
+                statuses[invocation['InstanceId']] = invocation['Status']
+                plugins = invocation.get('CommandPlugins') or [{}]
+                outputs[invocation['InstanceId']] = plugins[0].get('Output', '')
+        if len(statuses) == len(instance_ids) and not PENDING_STATUSES & set(statuses.values()):
+            break
+        if time.time() >= deadline:
+            break
+        time.sleep(poll_interval)
+
+    results = {}
+    for instance_id in instance_ids:
+        status = statuses.get(instance_id, 'Pending')
+        results[instance_id] = 'TimedOut' if status in PENDING_STATUSES else status
+        if results[instance_id] != 'Success':
+            logger.error(f"Command {command_id} {results[instance_id]} on {instance_id}: {outputs.get(instance_id, '')[-500:]}")
+    return results
@@ -0,0 +1,419 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Tuple
+from cost_ledger import bucket_of
+from telemetry import state_save_seconds
+
+# app keys that live in their own tables rather than the app row
+APP_CHILD_KEYS = ('instances', 'env_vars')
+
+def empty_state() -> Dict[str, Any]:
+    return {
+        'apps': {},
+        # shared instances that packed app containers are placed on
+        'hosts': {},
+        'total_cost': 0.0,
+        # cost_ledger accounts: running spend per app and in total, with hourly buckets
+        'costs': {'accounts': {}}
+    }
+
+class StateBackend:
+    name = 'base'
+
+    def __init__(self):
+        self.depth = 0
+
+    @contextmanager
+    def transaction(self):
+        # nested writes are committed together when the outermost block exits
+        if self.depth == 0:
+            self.begin()
+        self.depth += 1
+        try:
+            yield
+        except Exception:
+            self.depth -= 1
+            if self.depth == 0:
+                self.rollback()
+            raise
+        self.depth -= 1
+        if self.depth == 0:
+            try:
+                self.flush()
+            except Exception:
+                self.rollback()
+                raise
+
+    def _written(self):
+        if self.depth == 0:
+            self.flush()
+
+    def flush(self):
+        with state_save_seconds.labels(self.name).time():
+            self.commit()
+
+    def size(self) -> int:
+        # bytes the state takes up on disk
+        return 0
+
+    def load(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def reload_if_changed(self):
+        # returns a fresh state when another process has written since our last load
+        return None
+
+    def begin(self):
+        # called when the outermost transaction opens
+        pass
+
+    def save_all(self, state: Dict[str, Any]):
+        raise NotImplementedError
+
+    def save_app(self, app_name: str, app: Dict[str, Any]):
+        raise NotImplementedError
+
+    def delete_app(self, app_name: str):
+        raise NotImplementedError
+
+    def save_instances(self, app_name: str, instances: List[Dict[str, Any]]):
+        raise NotImplementedError
+
+    def delete_instances(self, app_name: str, instance_ids: List[str]):
+        raise NotImplementedError
+
+    def save_env_vars(self, app_name: str, env_vars: Dict[str, str]):
+        raise NotImplementedError
+
+    def save_hosts(self, hosts: List[Dict[str, Any]]):
+        raise NotImplementedError
+
+    def delete_hosts(self, host_ids: List[str]):
+        raise NotImplementedError
+
+    def record_cost(self, app_name: str, instance_id: str, cost: float, total_cost: float):
+        raise NotImplementedError
+
+    def save_costs(self, costs: Dict[str, Any], touched: List[Tuple[str, int]], cutoff: int):
+        # touched lists the (account, hour) buckets that changed; buckets before cutoff can go
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+    def rollback(self):
+        pass
+
+class JsonStateBackend(StateBackend):
+    name = 'json'
+
+    def __init__(self, filename: str = 'instance_state.json'):
+        super().__init__()
+        self.filename = filename
+        self.state = empty_state()
+
+    def load(self) -> Dict[str, Any]:
+        self.state = empty_state()
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as f:
+                self.state = {**empty_state(), **json.load(f)}
+        return self.state
+
+    def save_all(self, state: Dict[str, Any]):
+        self.state = state
+        self._written()
+
+    # every granular write lands in the shared state dict, so they all just flush it
+    def save_app(self, app_name: str, app: Dict[str, Any]):
+        self._written()
+
+    def delete_app(self, app_name: str):
+        self._written()
+
+    def save_instances(self, app_name: str, instances: List[Dict[str, Any]]):
+        self._written()
+
+    def delete_instances(self, app_name: str, instance_ids: List[str]):
+        self._written()
+
+    def save_env_vars(self, app_name: str, env_vars: Dict[str, str]):
+        self._written()
+
+    def save_hosts(self, hosts: List[Dict[str, Any]]):
+        self._written()
+
+    def delete_hosts(self, host_ids: List[str]):
+        self._written()
+
+    def record_cost(self, app_name: str, instance_id: str, cost: float, total_cost: float):
+        self._written()
+
+    def save_costs(self, costs: Dict[str, Any], touched: List[Tuple[str, int]], cutoff: int):
+        self._written()
+
+    def commit(self):
+        # write to a temp file and swap it in so a crash never leaves a half-written state
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_filename, self.filename)
+
+    def size(self) -> int:
+        return os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+
+class SqliteStateBackend(StateBackend):
+    name = 'sqlite'
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS apps (
+        name TEXT PRIMARY KEY,
+        ecr_image_uri TEXT,
+        instance_counter INTEGER NOT NULL DEFAULT 0,
+        data TEXT NOT NULL DEFAULT '{}'
+    );
+    CREATE TABLE IF NOT EXISTS instances (
+        id TEXT PRIMARY KEY,
+        app_name TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS instances_app_name ON instances (app_name, position);
+    CREATE TABLE IF NOT EXISTS env_vars (
+        app_name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT,
+        PRIMARY KEY (app_name, key)
+    );
+    CREATE TABLE IF NOT EXISTS cost_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        app_name TEXT,
+        instance_id TEXT,
+        cost REAL NOT NULL,
+        recorded_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS cost_ledger_app_name ON cost_ledger (app_name, recorded_at);
+    CREATE INDEX IF NOT EXISTS cost_ledger_instance_id ON cost_ledger (instance_id);
+    CREATE TABLE IF NOT EXISTS cost_hours (
+        account TEXT NOT NULL,
+        hour INTEGER NOT NULL,
+        cost REAL NOT NULL,
+        billed_from REAL,
+        billed_to REAL,
+        PRIMARY KEY (account, hour)
+    );
+    CREATE TABLE IF NOT EXISTS hosts (
+        id TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
+
+    def __init__(self, filename: str = 'instance_state.db', read_only: bool = False):
+        super().__init__()
+        self.filename = filename
+        import sqlite3  # only the SQLite backend pays for the import
+        if read_only:
+            # opened as it is on disk: no journal mode switch or schema; a missing store reads as empty
+            if os.path.exists(filename):
+                self.conn = sqlite3.connect(f"file:{os.path.abspath(filename)}?mode=ro", uri=True, check_same_thread=False)
+            else:
+                self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+                self.conn.executescript(self.SCHEMA)
+        else:
+            self.conn = sqlite3.connect(filename, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(self.SCHEMA)
+            if not self._has_billed_spans():
+                # stores from before the buckets kept the part of their hour that was billed
+                self.conn.execute('ALTER TABLE cost_hours ADD COLUMN billed_from REAL')
+                self.conn.execute('ALTER TABLE cost_hours ADD COLUMN billed_to REAL')
+            self.conn.commit()
+        self.billed_spans = self._has_billed_spans()
+        self.data_version = None
+
+    def _has_billed_spans(self) -> bool:
+        return 'billed_from' in {row[1] for row in self.conn.execute('PRAGMA table_info(cost_hours)')}
+
+    def is_empty(self) -> bool:
+        return self.conn.execute('SELECT COUNT(*) FROM apps').fetchone()[0] == 0
+
+    def load(self) -> Dict[str, Any]:
+        state = empty_state()
+        for name, ecr_image_uri, instance_counter, data in self.conn.execute(
+                'SELECT name, ecr_image_uri, instance_counter, data FROM apps'):
+            state['apps'][name] = {
+                **json.loads(data),
+                'ecr_image_uri': ecr_image_uri,
+                'instances': [],
+                'instance_counter': instance_counter,
+                'env_vars': {}
+            }
+        for app_name, data in self.conn.execute('SELECT app_name, data FROM instances ORDER BY app_name, position'):
+            if app_name in state['apps']:
+                state['apps'][app_name]['instances'].append(json.loads(data))
+        for app_name, key, value in self.conn.execute('SELECT app_name, key, value FROM env_vars'):
+            if app_name in state['apps']:
+                state['apps'][app_name]['env_vars'][key] = value
+        for host_id, data in self.conn.execute('SELECT id, data FROM hosts'):
+            state['hosts'][host_id] = json.loads(data)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'total_cost'").fetchone()
+        if row:
+            state['total_cost'] = float(row[0])
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'cost_accounts'").fetchone()
+        accounts = state['costs']['accounts'] = json.loads(row[0]) if row else {}
+        # a read-only store from before the billed spans has no columns for them; the ledger reads NULL as the whole hour
+        spans = 'billed_from, billed_to' if self.billed_spans else 'NULL, NULL'
+        for account, hour, cost, billed_from, billed_to in self.conn.execute(
+                f'SELECT account, hour, cost, {spans} FROM cost_hours'):
+            if account in accounts:
+                accounts[account].setdefault('hours', {})[hour] = [cost, billed_from, billed_to]
+        self.data_version = self._data_version()
+        return state
+
+    def _data_version(self) -> int:
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def reload_if_changed(self):
+        # data_version only moves when *another* connection commits
+        if self._data_version() != self.data_version:
+            return self.load()
+        return None
+
+    def begin(self):
+        # takes the database write lock up front, so another worker's write waits for this one
+        # (up to the connection timeout) instead of interleaving with it
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def save_all(self, state: Dict[str, Any]):
+        with self.transaction():
+            self.conn.execute('DELETE FROM apps')
+            self.conn.execute('DELETE FROM instances')
+            self.conn.execute('DELETE FROM env_vars')
+            self.conn.execute('DELETE FROM hosts')
+            for app_name, app in state['apps'].items():
+                self.save_app(app_name, app)
+                self.save_instances(app_name, app.get('instances', []))
+                self.save_env_vars(app_name, app.get('env_vars', {}))
+            self.save_hosts(list(state.get('hosts', {}).values()))
+            self._set_meta('total_cost', state.get('total_cost', 0.0))
+            self.conn.execute('DELETE FROM cost_hours')
+            self.conn.executemany('INSERT INTO cost_hours (account, hour, cost, billed_from, billed_to) VALUES (?, ?, ?, ?, ?)',
+                                  [(key, int(hour), *bucket_of(int(hour), bucket))
+                                   for key, account in state.get('costs', {}).get('accounts', {}).items()
+                                   for hour, bucket in account.get('hours', {}).items()])
+            self.save_costs(state.get('costs', {}), [], 0)
+
+    def save_app(self, app_name: str, app: Dict[str, Any]):
+        extra = {k: v for k, v in app.items() if k not in APP_CHILD_KEYS + ('ecr_image_uri', 'instance_counter')}
+        self.conn.execute(
+            'INSERT INTO apps (name, ecr_image_uri, instance_counter, data) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET ecr_image_uri = excluded.ecr_image_uri, '
+            'instance_counter = excluded.instance_counter, data = excluded.data',
+            (app_name, app.get('ecr_image_uri'), app.get('instance_counter', 0), json.dumps(extra))
+        )
+        self._written()
+
+    def delete_app(self, app_name: str):
+        self.conn.execute('DELETE FROM apps WHERE name = ?', (app_name,))
+        self.conn.execute('DELETE FROM instances WHERE app_name = ?', (app_name,))
+        self.conn.execute('DELETE FROM env_vars WHERE app_name = ?', (app_name,))
+        self._written()
+
+    def save_instances(self, app_name: str, instances: List[Dict[str, Any]]):
+        # new rows go after the app's existing ones; updated rows keep their position
+        position = self.conn.execute('SELECT COALESCE(MAX(position), -1) FROM instances WHERE app_name = ?',
+                                     (app_name,)).fetchone()[0]
+        for instance in instances:
+            position += 1
+            self.conn.execute(
+                'INSERT INTO instances (id, app_name, position, data) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET app_name = excluded.app_name, data = excluded.data',
+                (instance['id'], app_name, position, json.dumps(instance))
+            )
+        self._written()
+
+    def delete_instances(self, app_name: str, instance_ids: List[str]):
+        self.conn.executemany('DELETE FROM instances WHERE app_name = ? AND id = ?',
+                              [(app_name, instance_id) for instance_id in instance_ids])
+        self._written()
+
+    def save_env_vars(self, app_name: str, env_vars: Dict[str, str]):
+        self.conn.execute('DELETE FROM env_vars WHERE app_name = ?', (app_name,))
+        self.conn.executemany('INSERT INTO env_vars (app_name, key, value) VALUES (?, ?, ?)',
+                              [(app_name, k, v) for k, v in env_vars.items()])
+        self._written()
+
+    def save_hosts(self, hosts: List[Dict[str, Any]]):
+        self.conn.executemany('INSERT INTO hosts (id, data) VALUES (?, ?) '
+                              'ON CONFLICT(id) DO UPDATE SET data = excluded.data',
+                              [(host['id'], json.dumps(host)) for host in hosts])
+        self._written()
+
+    def delete_hosts(self, host_ids: List[str]):
+        self.conn.executemany('DELETE FROM hosts WHERE id = ?', [(host_id,) for host_id in host_ids])
+        self._written()
+
+    def record_cost(self, app_name: str, instance_id: str, cost: float, total_cost: float):
+        self.conn.execute('INSERT INTO cost_ledger (app_name, instance_id, cost, recorded_at) VALUES (?, ?, ?, ?)',
+                          (app_name, instance_id, cost, time.time()))
+        self._set_meta('total_cost', total_cost)
+        self._written()
+
+    def save_costs(self, costs: Dict[str, Any], touched: List[Tuple[str, int]], cutoff: int):
+        # the account totals are small and go in one row; buckets are upserted as they change
+        accounts = costs.get('accounts', {})
+        self._set_meta('cost_accounts', json.dumps({key: {k: v for k, v in account.items() if k != 'hours'}
+                                                    for key, account in accounts.items()}))
+        self.conn.executemany('INSERT INTO cost_hours (account, hour, cost, billed_from, billed_to) VALUES (?, ?, ?, ?, ?) '
+                              'ON CONFLICT(account, hour) DO UPDATE SET cost = excluded.cost, '
+                              'billed_from = excluded.billed_from, billed_to = excluded.billed_to',
+                              [(key, hour, *bucket_of(hour, accounts[key]['hours'].get(hour, 0.0))) for key, hour in touched])
+        self.conn.execute('DELETE FROM cost_hours WHERE hour < ?', (cutoff,))
+        self._written()
+
+    def _set_meta(self, key: str, value: Any):
+        self.conn.execute('INSERT INTO meta (key, value) VALUES (?, ?) '
+                          'ON CONFLICT(key) DO UPDATE SET value = excluded.value', (key, str(value)))
+
+    def commit(self):
+        self.conn.commit()
+        self.data_version = self._data_version()
+
+    def size(self) -> int:
+        page_count = self.conn.execute('PRAGMA page_count').fetchone()[0]
+        page_size = self.conn.execute('PRAGMA page_size').fetchone()[0]
+        wal = f"{self.filename}-wal"
+        return page_count * page_size + (os.path.getsize(wal) if os.path.exists(wal) else 0)
+
+    def rollback(self):
+        self.conn.rollback()
+
+def create_backend(filename: str = None, read_only: bool = False) -> StateBackend:
+    backend = os.environ.get('SPOTTY_STATE_BACKEND', 'json').lower()
+    if backend == 'sqlite':
+        return SqliteStateBackend(filename or os.environ.get('SPOTTY_STATE_DB', 'instance_state.db'), read_only)
+    if backend == 'json':
+        return JsonStateBackend(filename or 'instance_state.json')
+    raise ValueError(f"Unknown state backend '{backend}'")
+
+def migrate_json_to_sqlite(json_filename: str = 'instance_state.json', db_filename: str = 'instance_state.db'):
+    state = JsonStateBackend(json_filename).load()
+    backend = SqliteStateBackend(db_filename)
+    if not backend.is_empty():
+        raise ValueError(f"{db_filename} already has state, refusing to overwrite it")
+    backend.save_all(state)
+    instance_count = sum(len(app.get('instances', [])) for app in state['apps'].values())
+    print(f"Migrated {len(state['apps'])} apps and {instance_count} instances from {json_filename} to {db_filename}")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print("Usage: python state_backends.py migrate [instance_state.json] [instance_state.db]")
+        sys.exit(1)
+    migrate_json_to_sqlite(*sys.argv[2:4])
@@ -1,81 +1,474 @@
-import json
+import copy
 import os
-from typing import Dict, List, Any
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Any, Optional, Tuple
 from datetime import datetime
+from cost_ledger import TOTAL, CostLedger, new_account
+from state_backends import StateBackend, create_backend
+
+# (instance_type, az, region) -> current spot market price, or None when it isn't known
+PriceSource = Callable[[str, Optional[str], Optional[str]], Optional[float]]
 
 class StateManager:
-    def __init__(self, filename: str = 'instance_state.json'):
-        self.filename = filename
+    def __init__(self, filename: Optional[str] = None, backend: Optional[StateBackend] = None,
+                 price_source: Optional[PriceSource] = None, read_only: bool = False):
+        # read_only is for processes that only look, like the CLI: nothing they do reaches the store
+        self.read_only = read_only
+        self.backend = backend or create_backend(filename, read_only)
+        self.filename = getattr(self.backend, 'filename', filename)
+        self.price_source = price_source
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
         self.state: Dict[str, Any] = self.load_state()
+        self.index_instances()
+        self.ledger = self.load_ledger()
+        # change feed: version is bumped on every mutation; epoch tells restarts apart
+        self.epoch = os.urandom(4).hex()
+        self.version = 0
+        self.events = deque(maxlen=1000)
 
     def load_state(self) -> Dict[str, Any]:
-        if os.path.exists(self.filename):
-            with open(self.filename, 'r') as f:
-                return json.load(f)
-        return {
-            'apps': {},
-            'total_cost': 0.0
+        return self.backend.load()
+
+    def index_instances(self):
+        # instance id -> (app name, instance) so lookups by id don't scan every app
+        self.instance_index: Dict[str, Tuple[str, Dict[str, Any]]] = {
+            instance['id']: (app_name, instance)
+            for app_name, app in self.state['apps'].items()
+            for instance in app['instances']
         }
 
+    def load_ledger(self) -> CostLedger:
+        # running rates aren't stored; they are rebuilt from the open price segments of billing instances
+        costs = self.state.setdefault('costs', {})
+        if not costs.get('accounts') and self.state['total_cost']:
+            # state from before the ledger: the total carries over, per-app history starts now
+            costs['accounts'] = {TOTAL: {**new_account(time.time()), 'settled': self.state['total_cost']}}
+        ledger = CostLedger(costs)
+        unpriced = []
+        for app_name, instance in self.billing():
+            if 'priced_at' in instance:
+                ledger.resume(app_name, instance)
+            else:
+                unpriced.append((app_name, instance))
+        if unpriced:
+            now = time.time()
+            for app_name, instance in unpriced:
+                ledger.open(app_name, instance, self.market_price(instance), now)
+            ledger.flush()
+            if not self.read_only:
+                self.backend.save_all(self.state)
+        return ledger
+
+    def billing(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        # everything that is running up a bill: replicas and warm pool standbys
+        for app_name, app in self.state['apps'].items():
+            for instance in app['instances'] + app.get('standby', []):
+                yield app_name, instance
+
+    def market_price(self, instance: Dict[str, Any], fallback: bool = True) -> Optional[float]:
+        # what the instance is billed per hour right now; packed replicas pay their share of the host.
+        # Without price data it falls back to the bid, the most it can cost
+        price = None
+        if self.price_source and instance.get('instance_type'):
+            price = self.price_source(instance['instance_type'], instance.get('az'), instance.get('region'))
+        if price is not None and instance.get('host_id'):
+            host = self.state['hosts'].get(instance['host_id'])
+            price = price * instance['spot_price'] / host['spot_price'] if host and host.get('spot_price') else None
+        if price is None and fallback:
+            price = instance['spot_price']
+        return price
+
+    def save_costs(self):
+        self.backend.save_costs(self.state['costs'], self.ledger.flush(), self.ledger.cutoff(time.time()))
+
+    def refresh(self):
+        # pick up writes made by other workers sharing the same backend; never halfway through a write
+        with self.lock:
+            if not self.backend.depth:
+                self._reload_if_changed()
+
+    def _reload_if_changed(self):
+        state = self.backend.reload_if_changed()
+        if state is not None:
+            self._reset(state)
+
+    def _reset(self, state: Dict[str, Any]):
+        self.state = state
+        self.index_instances()
+        self.ledger = self.load_ledger()
+        self.emit('reset')
+
+    def check_writable(self):
+        if self.read_only:
+            raise RuntimeError("This StateManager is read-only")
+
+    @contextmanager
+    def write(self):
+        # every mutation runs under the process lock and the backend's write lock (BEGIN IMMEDIATE
+        # on SQLite, so other workers queue behind it), on top of whatever they committed last.
+        # A failed write reloads the store, so memory never keeps a change the store rolled back
+        with self.lock:
+            self.check_writable()
+            if self.backend.depth:
+                yield  # part of an enclosing write
+                return
+            try:
+                with self.backend.transaction():
+                    self._reload_if_changed()
+                    yield
+            except Exception:
+                self._reset(self.backend.load())
+                raise
+
     def save_state(self):
-        with open(self.filename, 'w') as f:
-            json.dump(self.state, f, indent=2)
+        with self.lock:
+            self.check_writable()
+            self.backend.save_all(self.state)
+            self.index_instances()
+            self.emit('reset')
 
-    def add_app(self, app_name: str, ecr_image_uri: str):
-        if app_name not in self.state['apps']:
-            self.state['apps'][app_name] = {
-                'ecr_image_uri': ecr_image_uri,
-                'instances': [],
-                'instance_counter': 0
+    def emit(self, event_type: str, app_name: Optional[str] = None, **data):
+        with self.changed:
+            self.version += 1
+            self.events.append({
+                'version': self.version,
+                'type': event_type,
+                'app_name': app_name,
+                'data': copy.deepcopy(data)
+            })
+            self.changed.notify_all()
+
+    def get_etag(self) -> str:
+        return f"{self.epoch}-{self.version}"
+
+    def parse_version(self, etag: Optional[str]) -> Optional[int]:
+        # a version from before a restart (other epoch) can't be replayed
+        if not etag or '-' not in etag:
+            return None
+        epoch, _, version = etag.partition('-')
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    def events_since(self, version: int, timeout: Optional[float] = None) -> Optional[List[Dict[str, Any]]]:
+        # returns None when the caller is too far behind and needs a full snapshot
+        with self.changed:
+            if timeout and self.version == version:
+                self.changed.wait_for(lambda: self.version != version, timeout)
+            if version > self.version:
+                return None
+            if version < self.version and (not self.events or version < self.events[0]['version'] - 1):
+                return None
+            return [event for event in self.events if event['version'] > version]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'version': self.get_etag(),
+                'apps': copy.deepcopy(self.state['apps']),
+                'total_cost': self.state['total_cost']
             }
-            self.save_state()
-            return True
-        return False
 
     def update_ecr_uri(self, app_name: str, ecr_image_uri: str):
-        if app_name in self.state['apps']:
-            self.state['apps'][app_name]['ecr_image_uri'] = ecr_image_uri
-            self.save_state()
-            return True
-        return False
+        with self.write():
+            if app_name in self.state['apps']:
+                self.state['apps'][app_name]['ecr_image_uri'] = ecr_image_uri
+                self.backend.save_app(app_name, self.state['apps'][app_name])
+                self.emit('ecr_uri_updated', app_name, ecr_image_uri=ecr_image_uri)
+                return True
+            return False
+
+    def reserve_instance_names(self, app_name: str, count: int = 1) -> List[str]:
+        # bump the counter up front so concurrent scale-up jobs never share a name
+        with self.write():
+            app = self.state['apps'][app_name]
+            first = app['instance_counter'] + 1
+            app['instance_counter'] += count
+            self.backend.save_app(app_name, app)
+            self.emit('app_updated', app_name, instance_counter=app['instance_counter'])
+            return [f"{app_name}-{n}" for n in range(first, first + count)]
+
+    def reserve_instance_name(self, app_name: str) -> str:
+        return self.reserve_instance_names(app_name)[0]
 
     def add_instance(self, app_name: str, instance: Dict[str, Any]):
-        if app_name in self.state['apps']:
-            self.state['apps'][app_name]['instances'].append(instance)
-            self.state['apps'][app_name]['instance_counter'] += 1
-            self.save_state()
-            return True
-        return False
+        return self.add_instances(app_name, [instance])
+
+    def add_instances(self, app_name: str, instances: List[Dict[str, Any]]):
+        with self.write():
+            if app_name in self.state['apps']:
+                self.state['apps'][app_name]['instances'].extend(instances)
+                now = time.time()
+                for instance in instances:
+                    self.instance_index[instance['id']] = (app_name, instance)
+                    # standbys handed out by the warm pool have been billing since they were launched
+                    if 'priced_at' not in instance:
+                        self.ledger.open(app_name, instance, self.market_price(instance), now)
+                with self.backend.transaction():
+                    self.backend.save_instances(app_name, instances)
+                    self.save_costs()
+                self.emit('instances_added', app_name, instances=instances)
+                return True
+            return False
 
     def remove_instance(self, app_name: str, instance_id: str) -> bool:
-        if app_name in self.state['apps']:
+        return bool(self.remove_instances(app_name, [instance_id]))
+
+    def remove_instances(self, app_name: str, instance_ids: List[str]) -> List[Dict[str, Any]]:
+        # closes out a batch in one transaction; returns the instances that were still tracked
+        with self.write():
+            app = self.state['apps'].get(app_name)
+            if app is None:
+                return []
+            wanted = set(instance_ids)
+            removed = [i for i in app['instances'] if i['id'] in wanted]
+            if not removed:
+                return []
+            with self.backend.transaction():
+                self.backend.delete_instances(app_name, [i['id'] for i in removed])
+                app['instances'] = [i for i in app['instances'] if i['id'] not in wanted]
+                for instance in removed:
+                    self.instance_index.pop(instance['id'], None)
+                    cost = self.calculate_and_add_cost(instance, app_name)
+                    if instance.get('host_id'):
+                        self._release(instance['host_id'], instance['id'], cost)
+                self.save_costs()
+            self.emit('instances_removed', app_name, instance_ids=[i['id'] for i in removed],
+                      total_cost=self.state['total_cost'])
+            return removed
+
+    def update_instance(self, app_name: str, instance_id: str, **fields) -> bool:
+        with self.write():
+            _, instance = self.instance_index.get(instance_id, (None, None))
+            if instance is None:
+                return False
+            instance.update(fields)
+            self.backend.save_instances(app_name, [instance])
+            self.emit('instance_updated', app_name, instance_id=instance_id, fields=fields)
+            return True
+
+    def get_target_replicas(self, app_name: str) -> int:
+        # apps that predate replica targets hold whatever they run today
+        app = self.state['apps'].get(app_name, {})
+        return app.get('target_replicas', len(app.get('instances', [])))
+
+    def adjust_target_replicas(self, app_name: str, delta: int) -> int:
+        with self.write():
+            return self.set_target_replicas(app_name, self.get_target_replicas(app_name) + delta)
+
+    def set_target_replicas(self, app_name: str, replicas: int) -> int:
+        with self.write():
             app = self.state['apps'][app_name]
-            instance = next((i for i in app['instances'] if i['id'] == instance_id), None)
-            if instance:
-                app['instances'] = [i for i in app['instances'] if i['id'] != instance_id]
-                self.calculate_and_add_cost(instance)
-                self.save_state()
-                return True
-        return False
+            app['target_replicas'] = max(0, replicas)
+            self.backend.save_app(app_name, app)
+            self.emit('app_updated', app_name, target_replicas=app['target_replicas'])
+            return app['target_replicas']
+
+    def get_launch_spec(self, app_name: str) -> Dict[str, List[str]]:
+        # instance types, subnets and regions an app may launch into; empty lists fall back to the
+        # TF_* defaults, and no regions means the home region only
+        return self.state['apps'].get(app_name, {}).get('launch_spec', {})
+
+    def set_launch_spec(self, app_name: str, instance_types: List[str], subnet_ids: List[str],
+                        regions: Optional[List[str]] = None):
+        with self.write():
+            if app_name not in self.state['apps']:
+                raise ValueError(f"App '{app_name}' not found")
+            app = self.state['apps'][app_name]
+            app['launch_spec'] = {'instance_types': instance_types, 'subnet_ids': subnet_ids, 'regions': regions or []}
+            self.backend.save_app(app_name, app)
+            self.emit('app_updated', app_name, launch_spec=app['launch_spec'])
+
+    def get_autoscaling(self, app_name: str) -> Optional[Dict[str, Any]]:
+        return self.state['apps'].get(app_name, {}).get('autoscaling')
+
+    def set_autoscaling(self, app_name: str, policy: Dict[str, Any]):
+        with self.write():
+            if app_name not in self.state['apps']:
+                raise ValueError(f"App '{app_name}' not found")
+            app = self.state['apps'][app_name]
+            app['autoscaling'] = policy
+            self.backend.save_app(app_name, app)
+            self.emit('app_updated', app_name, autoscaling=policy)
+
+    def get_warm_pool_size(self, app_name: str) -> int:
+        return self.state['apps'].get(app_name, {}).get('warm_pool_size', 0)
+
+    def set_warm_pool_size(self, app_name: str, size: int):
+        with self.write():
+            if app_name not in self.state['apps']:
+                raise ValueError(f"App '{app_name}' not found")
+            app = self.state['apps'][app_name]
+            app['warm_pool_size'] = max(0, size)
+            self.backend.save_app(app_name, app)
+            self.emit('app_updated', app_name, warm_pool_size=app['warm_pool_size'])
+
+    def get_standby(self, app_name: str) -> List[Dict[str, Any]]:
+        # pre-booted instances waiting to be assigned; they don't count as replicas
+        return self.state['apps'].get(app_name, {}).get('standby', [])
+
+    def add_standby(self, app_name: str, instances: List[Dict[str, Any]]) -> bool:
+        with self.write():
+            if app_name not in self.state['apps']:
+                return False
+            app = self.state['apps'][app_name]
+            app['standby'] = app.get('standby', []) + instances
+            now = time.time()
+            for instance in instances:
+                self.ledger.open(app_name, instance, self.market_price(instance), now)
+            with self.backend.transaction():
+                self.backend.save_app(app_name, app)
+                self.save_costs()
+            self.emit('app_updated', app_name, standby=app['standby'])
+            return True
+
+    def take_standby(self, app_name: str, count: int) -> List[Dict[str, Any]]:
+        with self.write():
+            standby = self.get_standby(app_name)
+            if not standby or count <= 0:
+                return []
+            app = self.state['apps'][app_name]
+            taken, app['standby'] = standby[:count], standby[count:]
+            self.backend.save_app(app_name, app)
+            self.emit('app_updated', app_name, standby=app['standby'])
+            return taken
 
-    def calculate_and_add_cost(self, instance: Dict[str, Any]):
-        start_time = datetime.fromtimestamp(instance['time_now'])
-        end_time = datetime.now()
-        duration_hours = (end_time - start_time).total_seconds() / 3600
-        cost = duration_hours * instance['spot_price']
+    def discard_standby(self, app_name: str, instance: Dict[str, Any]):
+        # a standby that was taken out of the pool but never became a replica still cost money
+        with self.write():
+            app = self.state['apps'].get(app_name)
+            if app is None:
+                return
+            app['standby'] = [i for i in app.get('standby', []) if i['id'] != instance['id']]
+            with self.backend.transaction():
+                self.backend.save_app(app_name, app)
+                self.calculate_and_add_cost(instance, app_name)
+                self.save_costs()
+            self.emit('app_updated', app_name, standby=app['standby'], total_cost=self.state['total_cost'])
+
+    def calculate_and_add_cost(self, instance: Dict[str, Any], app_name: str):
+        # billed at the market price over each of its price segments, not at the bid
+        now = time.time()
+        duration_hours = (now - instance['time_now']) / 3600
+        cost = self.ledger.close(app_name, instance, now)
         self.state['total_cost'] += cost
-        print(f"Instance {instance['id']} ran for {duration_hours:.2f} hours at ${instance['spot_price']}/hour. Cost: ${cost:.4f}")
+        self.backend.record_cost(app_name, instance['id'], cost, self.state['total_cost'])
+        print(f"Instance {instance['id']} ran for {duration_hours:.2f} hours, last at ${instance['market_price']:.4f}/hour (bid ${instance['spot_price']}). Cost: ${cost:.4f}")
         print(f"Total project cost so far: ${self.state['total_cost']:.4f}")
+        return cost
+
+    def reprice(self) -> int:
+        # moves billing instances onto the current market price, all in one write
+        with self.write():
+            now = time.time()
+            changed: Dict[str, List[Dict[str, Any]]] = {}
+            for app_name, instance in self.billing():
+                price = self.market_price(instance, fallback=False)
+                if price is not None and 'priced_at' in instance and abs(price - instance['market_price']) > 1e-9:
+                    self.ledger.reprice(app_name, instance, price, now)
+                    changed.setdefault(app_name, []).append(instance)
+            if not changed:
+                return 0
+            with self.backend.transaction():
+                for app_name, instances in changed.items():
+                    # standbys live in the app row rather than the instances table
+                    self.backend.save_instances(app_name, [i for i in instances if i['id'] in self.instance_index])
+                    self.backend.save_app(app_name, self.state['apps'][app_name])
+                self.save_costs()
+            for app_name, instances in changed.items():
+                for instance in instances:
+                    self.emit('instance_updated', app_name, instance_id=instance['id'],
+                              fields={k: instance[k] for k in ('market_price', 'priced_at', 'accrued_cost')})
+            return sum(len(instances) for instances in changed.values())
+
+    def get_hosts(self) -> Dict[str, Dict[str, Any]]:
+        self.refresh()
+        return self.state['hosts']
+
+    def add_host(self, host: Dict[str, Any]):
+        with self.write():
+            self.state['hosts'][host['id']] = host
+            self.backend.save_hosts([host])
+            self.emit('host_updated', host=host)
+
+    def allocate(self, host_id: str, replica_id: str, allocation: Dict[str, Any]) -> bool:
+        with self.write():
+            host = self.state['hosts'].get(host_id)
+            if host is None:
+                return False
+            host['allocations'][replica_id] = allocation
+            host.pop('idle_since', None)
+            self.backend.save_hosts([host])
+            self.emit('host_updated', host=host)
+            return True
+
+    def release(self, host_id: str, replica_id: str):
+        with self.write():
+            self._release(host_id, replica_id, 0.0)
+
+    def _release(self, host_id: str, replica_id: str, cost: float):
+        # the replica's share of the host was already charged to its app
+        host = self.state['hosts'].get(host_id)
+        if host is None or host['allocations'].pop(replica_id, None) is None:
+            return
+        host['attributed_cost'] = host.get('attributed_cost', 0.0) + cost
+        if not host['allocations']:
+            host['idle_since'] = datetime.now().timestamp()
+        self.backend.save_hosts([host])
+        self.emit('host_updated', host=host)
+
+    def remove_host(self, host_id: str) -> bool:
+        # charges whatever part of the host's running time no replica paid for
+        with self.write():
+            host = self.state['hosts'].pop(host_id, None)
+            if host is None:
+                return False
+            now = time.time()
+            duration_hours = (now - host['time_now']) / 3600
+            cost = max(0.0, duration_hours * self.market_price(host) - host.get('attributed_cost', 0.0))
+            with self.backend.transaction():
+                self.backend.delete_hosts([host_id])
+                self.state['total_cost'] += cost
+                self.backend.record_cost(None, host_id, cost, self.state['total_cost'])
+                self.ledger.charge(None, cost, now)
+                self.save_costs()
+            self.emit('host_removed', host_id=host_id, total_cost=self.state['total_cost'])
+            return True
+
+    def set_placement(self, app_name: str, mode: str, resources: Dict[str, float]):
+        with self.write():
+            if app_name not in self.state['apps']:
+                raise ValueError(f"App '{app_name}' not found")
+            app = self.state['apps'][app_name]
+            app['placement'] = mode
+            app['resources'] = resources
+            self.backend.save_app(app_name, app)
+            self.emit('app_updated', app_name, placement=mode, resources=resources)
 
     def get_apps(self) -> Dict[str, Dict[str, Any]]:
+        self.refresh()
         return self.state['apps']
 
     def get_app(self, app_name: str) -> Dict[str, Any]:
+        self.refresh()
         return self.state['apps'].get(app_name, {})
 
     def get_instances(self, app_name: str) -> List[Dict[str, Any]]:
+        self.refresh()
         return self.state['apps'].get(app_name, {}).get('instances', [])
 
+    def find_instance(self, instance_id: str) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        self.refresh()
+        return self.instance_index.get(instance_id, (None, None))
+
+    def get_all_instances(self) -> List[Dict[str, Any]]:
+        self.refresh()
+        return [instance for _, instance in self.instance_index.values()]
+
     def get_ecr_image_uri(self, app_name: str) -> str:
         return self.state['apps'].get(app_name, {}).get('ecr_image_uri')
 
@@ -84,12 +477,37 @@ class StateManager:
 
     def get_total_cost(self) -> float:
         return self.state['total_cost']
-    
+
+    def get_spend(self, app_name: Optional[str] = None) -> float:
+        # everything spent so far, running instances included
+        with self.lock:
+            return self.ledger.spend(app_name or TOTAL)
+
+    def get_cost_rate(self, app_name: Optional[str] = None) -> float:
+        # $/hour at current market prices
+        with self.lock:
+            return self.ledger.rate(app_name or TOTAL)
+
+    def get_cost_window(self, app_name: Optional[str], start: float, end: float) -> float:
+        with self.lock:
+            return self.ledger.window(app_name or TOTAL, start, end)
+
+    def get_hourly_costs(self, app_name: Optional[str], start: float, end: float) -> List[Tuple[int, float]]:
+        with self.lock:
+            return self.ledger.hourly(app_name or TOTAL, start, end)
+
+    def get_cost_summary(self, app_name: Optional[str], start: float, end: float) -> Dict[str, float]:
+        with self.lock:
+            return {'spend': self.get_spend(app_name), 'cost_per_hour': self.get_cost_rate(app_name),
+                    'window_spend': self.get_cost_window(app_name, start, end)}
+
     def save_env_vars(self, app_name: str, env_vars: Dict[str, str]):
-        if app_name not in self.state['apps']:
-            raise ValueError(f"App '{app_name}' not found")
-        self.state['apps'][app_name]['env_vars'] = env_vars
-        self.save_state()
+        with self.write():
+            if app_name not in self.state['apps']:
+                raise ValueError(f"App '{app_name}' not found")
+            self.state['apps'][app_name]['env_vars'] = env_vars
+            self.backend.save_env_vars(app_name, env_vars)
+            self.emit('env_vars_saved', app_name, env_vars=env_vars)
 
     def get_env_vars(self, app_name: str) -> Dict[str, str]:
         if app_name not in self.state['apps']:
@@ -97,13 +515,30 @@ class StateManager:
         return self.state['apps'][app_name].get('env_vars', {})
 
     def add_app(self, app_name: str, ecr_image_uri: str):
-        if app_name not in self.state['apps']:
-            self.state['apps'][app_name] = {
-                'ecr_image_uri': ecr_image_uri,
-                'instances': [],
-                'instance_counter': 0,
-                'env_vars': {}
-            }
-            self.save_state()
-            return True
-        return False
\ No newline at end of file
+        with self.write():
+            if app_name not in self.state['apps']:
+                self.state['apps'][app_name] = {
+                    'ecr_image_uri': ecr_image_uri,
+                    'instances': [],
+                    'instance_counter': 0,
+                    'env_vars': {}
+                }
+                self.backend.save_app(app_name, self.state['apps'][app_name])
+                self.emit('app_added', app_name, app=self.state['apps'][app_name])
+                return True
+            return False
+
+_shared: Optional[StateManager] = None
+_shared_lock = threading.Lock()
+
+def shared_state_manager(price_source: Optional[PriceSource] = None, read_only: bool = False) -> StateManager:
+    # the process-wide StateManager, loaded on first use. Modules share it rather than building
+    # their own, which would each read the state store into a separate copy. read_only applies
+    # to the first call, which loads it
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = StateManager(price_source=price_source, read_only=read_only)
+        elif price_source and not _shared.price_source:
+            _shared.price_source = price_source
+        return _shared
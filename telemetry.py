@@ -0,0 +1,202 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Prometheus text exposition of Spotty's own counters. Hot paths only touch a
+# per-series lock and a couple of additions; everything else happens at scrape time.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PHASE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 90, 120, 180, 300, 600)
+
+LabelValues = Tuple[str, ...]
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{escape(str(value))}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series: Dict[LabelValues, object] = {}
+        self.lookup: Dict[tuple, object] = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        # looked up by the values as passed, so callers using ints or enums skip the str() conversion
+        series = self.lookup.get(values)
+        if series is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}, got {values}")
+            with self.lock:
+                series = self.series.setdefault(tuple(str(value) for value in values), self.new_series())
+                self.lookup[values] = series
+        return series
+
+    def new_series(self):
+        raise NotImplementedError
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples()]
+        return lines
+
+class CounterSeries:
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_series(self):
+        return CounterSeries()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        return [(f"{self.name}_total", format_labels(self.labelnames, values), series.value)
+                for values, series in list(self.series.items())]
+
+class GaugeSeries:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 collect: Optional[Callable[[], Dict[LabelValues, float]]] = None):
+        # collect() is called at scrape time and returns {label values: value}, for gauges derived from state
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def new_series(self):
+        return GaugeSeries()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, collect: Callable[[], Dict[LabelValues, float]]):
+        self.collect = collect
+
+    def samples(self):
+        values = self.collect() if self.collect else {v: s.value for v, s in list(self.series.items())}
+        return [(self.name, format_labels(self.labelnames, labels), value) for labels, value in values.items()]
+
+class HistogramSeries:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # per bucket, not cumulative; the last one is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_series(self):
+        return HistogramSeries(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self):
+        samples = []
+        for values, series in list(self.series.items()):
+            with series.lock:
+                counts, total = list(series.counts), series.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = format_labels(self.labelnames + ('le',), values + (format_value(float(bound)),))
+                samples.append((f"{self.name}_bucket", labels, cumulative))
+            labels = format_labels(self.labelnames, values)
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+aws_call_seconds = registry.register(Histogram(
+    'spotty_aws_call_seconds', 'AWS API call latency, including retries', ('service', 'operation', 'outcome')))
+provisioning_phase_seconds = registry.register(Histogram(
+    'spotty_provisioning_phase_seconds', 'Duration of each provisioning and boot phase', ('phase',), PHASE_BUCKETS))
+bid_attempts = registry.register(Histogram(
+    'spotty_bid_attempts', 'Spot requests made per launch', ('outcome',), (1, 2, 3, 4, 5, 6, 8, 10)))
+quota_check_seconds = registry.register(Histogram(
+    'spotty_quota_check_seconds', 'Latency of the spot vCPU quota check'))
+state_save_seconds = registry.register(Histogram(
+    'spotty_state_save_seconds', 'Time to commit a state write to the backend', ('backend',)))
+state_size_bytes = registry.register(Gauge(
+    'spotty_state_size_bytes', 'Size of the persisted state', ('backend',)))
+http_request_seconds = registry.register(Histogram(
+    'spotty_http_request_seconds', 'Control plane request latency per route', ('method', 'route', 'status')))
+instances = registry.register(Gauge(
+    'spotty_instances', 'Instances currently tracked per app', ('app',)))
+running_cost = registry.register(Gauge(
+    'spotty_running_cost_dollars_per_hour', 'Market price of the instances each app runs', ('app',)))
+spend = registry.register(Gauge(
+    'spotty_spend_dollars', 'Spend per app so far, running instances included', ('app',)))
+total_cost = registry.register(Gauge(
+    'spotty_total_cost_dollars', 'Cost accrued by terminated instances so far'))
@@ -32,4 +32,25 @@ resource "aws_iam_instance_profile" "ec2_ecr_profile" {
 
 output "instance_profile_name" {
   value = aws_iam_instance_profile.ec2_ecr_profile.name
-}
\ No newline at end of file
+}
+# lets instances report their boot phase timestamps back as spotty:phase:* tags
+resource "aws_iam_role_policy" "boot_phase_tags" {
+  name = "spotty_boot_phase_tags"
+  role = aws_iam_role.ec2_ecr_role.name
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action   = "ec2:CreateTags"
+        Effect   = "Allow"
+        Resource = "arn:aws:ec2:*:*:instance/*"
+        Condition = {
+          "ForAllValues:StringLike" = {
+            "aws:TagKeys" = ["spotty:phase:*"]
+          }
+        }
+      }
+    ]
+  })
+}
@@ -1,6 +1,9 @@
 # main.tf
 
 terraform {
+  # variable validations refer to other variables
+  required_version = ">= 1.9"
+
   required_providers {
     aws = {
       source  = "hashicorp/aws"
@@ -25,16 +28,28 @@ resource "aws_vpc" "main" {
   }
 }
 
+data "aws_availability_zones" "available" {
+  state = "available"
+}
+
+# one subnet per AZ so Spotty can fail over when a spot pool runs dry
 resource "aws_subnet" "main" {
+  count                   = min(var.subnet_count, length(data.aws_availability_zones.available.names))
   vpc_id                  = aws_vpc.main.id
-  cidr_block              = "10.0.1.0/24"
+  cidr_block              = "10.0.${count.index + 1}.0/24"
+  availability_zone       = data.aws_availability_zones.available.names[count.index]
   map_public_ip_on_launch = true
 
   tags = {
-    Name = "spot-instance-subnet"
+    Name = "spot-instance-subnet-${count.index}"
   }
 }
 
+moved {
+  from = aws_subnet.main
+  to   = aws_subnet.main[0]
+}
+
 resource "aws_internet_gateway" "main" {
   vpc_id = aws_vpc.main.id
 
@@ -57,10 +72,16 @@ resource "aws_route_table" "main" {
 }
 
 resource "aws_route_table_association" "main" {
-  subnet_id      = aws_subnet.main.id
+  count          = length(aws_subnet.main)
+  subnet_id      = aws_subnet.main[count.index].id
   route_table_id = aws_route_table.main.id
 }
 
+moved {
+  from = aws_route_table_association.main
+  to   = aws_route_table_association.main[0]
+}
+
 resource "aws_security_group" "main" {
   name        = "spot-instance-sg"
   description = "Security group for spot instance"
@@ -87,6 +108,14 @@ resource "aws_security_group" "main" {
     cidr_blocks = ["0.0.0.0/0"]
   }
 
+  # app and monitor ports of containers packed onto shared hosts
+  ingress {
+    from_port   = 8000
+    to_port     = 8999
+    protocol    = "tcp"
+    cidr_blocks = ["0.0.0.0/0"]
+  }
+
   egress {
     from_port   = 0
     to_port     = 0
@@ -119,7 +148,11 @@ output "ami_id" {
 }
 
 output "instance_type" {
-  value = "t2.micro"
+  value = var.instance_types[0]
+}
+
+output "instance_types" {
+  value = join(",", var.instance_types)
 }
 
 output "security_group_id" {
@@ -128,6 +161,11 @@ output "security_group_id" {
 }
 
 output "subnet_id" {
-  value     = aws_subnet.main.id
+  value     = aws_subnet.main[0].id
+  sensitive = true
+}
+
+output "subnet_ids" {
+  value     = join(",", aws_subnet.main[*].id)
   sensitive = true
 }
\ No newline at end of file
@@ -0,0 +1,50 @@
+# regions.tf
+#
+# Extra regions Spotty may place instances in, besides var.aws_region. Provider
+# configurations can't be generated from a list, so each extra region has a slot;
+# copy a slot to allow more than two.
+
+locals {
+  extra_regions = [for region in var.extra_regions : region if region != var.aws_region]
+}
+
+provider "aws" {
+  alias      = "extra_0"
+  region     = length(local.extra_regions) > 0 ? local.extra_regions[0] : var.aws_region
+  access_key = var.aws_access_key
+  secret_key = var.aws_secret_key
+}
+
+module "extra_0" {
+  source       = "./modules/region"
+  count        = length(local.extra_regions) > 0 ? 1 : 0
+  subnet_count = var.subnet_count
+  providers = {
+    aws = aws.extra_0
+  }
+}
+
+provider "aws" {
+  alias      = "extra_1"
+  region     = length(local.extra_regions) > 1 ? local.extra_regions[1] : var.aws_region
+  access_key = var.aws_access_key
+  secret_key = var.aws_secret_key
+}
+
+module "extra_1" {
+  source       = "./modules/region"
+  count        = length(local.extra_regions) > 1 ? 1 : 0
+  subnet_count = var.subnet_count
+  providers = {
+    aws = aws.extra_1
+  }
+}
+
+# exported as TF_REGIONS: {"<region>": {"ami_id": ..., "security_group_id": ..., "subnet_ids": [...]}}
+output "regions" {
+  value = jsonencode(merge(
+    { for m in module.extra_0 : local.extra_regions[0] => m },
+    { for m in module.extra_1 : local.extra_regions[1] => m }
+  ))
+  sensitive = true
+}
@@ -14,4 +14,28 @@ variable "aws_secret_key" {
   description = "AWS secret key"
   type        = string
   sensitive = true
-}
\ No newline at end of file
+}
+
+variable "subnet_count" {
+  description = "Number of availability zones to create a public subnet in"
+  type        = number
+  default     = 3
+}
+
+variable "instance_types" {
+  description = "Instance types spot capacity may be drawn from, in order of preference"
+  type        = list(string)
+  default     = ["t2.micro", "t3.micro", "t3a.micro"]
+}
+
+variable "extra_regions" {
+  description = "Regions besides aws_region to provision a VPC in, so spot capacity can be placed there too (up to two)"
+  type        = list(string)
+  default     = []
+
+  # regions.tf has two extra region slots; aws_region itself doesn't take one
+  validation {
+    condition     = length([for region in var.extra_regions : region if region != var.aws_region]) <= 2
+    error_message = "At most two regions besides aws_region can be given; add a slot in regions.tf for more."
+  }
+}
@@ -0,0 +1,29 @@
+# Shared setup for the unit tests: puts the repository on the path, pins the region,
+# and loads recorded AWS responses from tests/fixtures.
+#
+#   python -m unittest discover tests
+
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+# failures the code under test logs and recovers from aren't test failures
+logging.disable(logging.CRITICAL)
+
+def fixture(name: str):
+    # JSON fixtures keep timestamps as ISO strings; botocore hands them back as datetimes
+    def revive(obj):
+        return {k: datetime.fromisoformat(v) if k == 'Timestamp' else v for k, v in obj.items()}
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f, object_hook=revive)
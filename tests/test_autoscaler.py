@@ -0,0 +1,118 @@
+import unittest
+
+import support  # noqa: F401  (path and region setup)
+
+from autoscaler import DEFAULT_POLICY, ScalingDecider, make_policy, recommend, replay
+
+def trace(name: str):
+    return support.fixture(f'autoscale_trace_{name}.json')['samples']
+
+def changes(decisions):
+    # (time, replicas) at each point the replica count moved
+    moved, last = [], None
+    for t, replicas in decisions:
+        if replicas != last:
+            moved.append((t, replicas))
+            last = replicas
+    return moved
+
+class MakePolicyTest(unittest.TestCase):
+    def test_defaults(self):
+        self.assertEqual(make_policy(), DEFAULT_POLICY)
+        self.assertEqual(make_policy({'max_replicas': 3})['max_replicas'], 3)
+
+    def test_bounds(self):
+        with self.assertRaises(ValueError):
+            make_policy({'min_replicas': -1})
+        with self.assertRaises(ValueError):
+            make_policy({'min_replicas': 5, 'max_replicas': 4})
+
+    def test_targets_must_be_a_mapping(self):
+        for targets in (['cpu_usage_percentage'], 'cpu_usage_percentage', 60, None, {}):
+            with self.assertRaises(ValueError):
+                make_policy({'targets': targets})
+
+    def test_targets_must_be_positive_numbers(self):
+        for target in (0, -5, '60', True):
+            with self.assertRaises(ValueError):
+                make_policy({'targets': {'cpu_usage_percentage': target}})
+
+    def test_unknown_settings_rejected(self):
+        with self.assertRaises(ValueError) as raised:
+            make_policy({'max_replica': 3, 'cooldown': 60})
+        self.assertIn('cooldown, max_replica', str(raised.exception))
+
+class RecommendTest(unittest.TestCase):
+    def test_within_tolerance_left_alone(self):
+        self.assertEqual(recommend(DEFAULT_POLICY, {'cpu_usage_percentage': [64.0, 62.0]}, 2), 2)
+
+    def test_proportional(self):
+        self.assertEqual(recommend(DEFAULT_POLICY, {'cpu_usage_percentage': [90.0, 90.0]}, 2), 3)
+        self.assertEqual(recommend(DEFAULT_POLICY, {'cpu_usage_percentage': [15.0] * 4}, 4), 1)
+
+    def test_no_samples(self):
+        self.assertEqual(recommend(DEFAULT_POLICY, {'cpu_usage_percentage': []}, 3), 3)
+
+class ReplayTest(unittest.TestCase):
+    # recorded fleet-wide CPU traces replayed through ScalingDecider with the default policy
+    policy = {'enabled': True}
+
+    def assert_cooldowns_held(self, decisions):
+        policy = make_policy(self.policy)
+        last_up = last_change = float('-inf')
+        previous = decisions[0][1]
+        for t, replicas in decisions[1:]:
+            if replicas > previous:
+                self.assertGreaterEqual(t - last_up, policy['scale_up_cooldown'])
+                last_up = last_change = t
+            elif replicas < previous:
+                self.assertGreaterEqual(t - last_change, policy['scale_down_cooldown'])
+                last_change = t
+            previous = replicas
+
+    def test_spike(self):
+        decisions = replay(self.policy, trace('spike'), replicas=2)
+        # the spike quadruples the load: four replicas at most per step, the rest after the cooldown,
+        # and nothing is shed until the quiet stretch has lasted the whole scale-down window
+        self.assertEqual(changes(decisions), [(0, 2), (600, 6), (720, 8), (1800, 3)])
+        self.assert_cooldowns_held(decisions)
+
+    def test_brief_dips_keep_capacity(self):
+        decisions = replay(self.policy, trace('bursty'), replicas=4)
+        self.assertEqual(changes(decisions), [(0, 4)])
+
+    def test_dips_shed_capacity_without_hysteresis(self):
+        # the same trace with the scale-down window and cooldown turned off flaps on every dip
+        policy = {**self.policy, 'scale_down_window': 0, 'scale_down_cooldown': 0}
+        moved = changes(replay(policy, trace('bursty'), replicas=4))
+        self.assertGreater(len(moved), 10)
+
+    def test_flood_capped_at_max_then_floored_at_min(self):
+        decisions = replay(self.policy, trace('flood'), replicas=2)
+        self.assertEqual(changes(decisions), [(0, 6), (120, 10), (1500, 1)])
+        self.assertEqual(max(replicas for _, replicas in decisions), DEFAULT_POLICY['max_replicas'])
+        self.assert_cooldowns_held(decisions)
+
+    def test_tighter_bounds(self):
+        policy = {**self.policy, 'min_replicas': 2, 'max_replicas': 5}
+        decisions = replay(policy, trace('flood'), replicas=2)
+        self.assertEqual(changes(decisions), [(0, 5), (1500, 2)])
+
+class ScalingDeciderTest(unittest.TestCase):
+    def test_out_of_bounds_corrected_at_once(self):
+        decider = ScalingDecider(make_policy({'min_replicas': 2, 'max_replicas': 4}))
+        loads = {'cpu_usage_percentage': [60.0]}
+        self.assertEqual(decider.decide(loads, 0, now=0), 2)
+        self.assertEqual(decider.decide(loads, 9, now=1), 4)
+
+    def test_scale_down_waits_out_a_scale_up(self):
+        decider = ScalingDecider(make_policy())
+        self.assertEqual(decider.decide({'cpu_usage_percentage': [120.0] * 2}, 2, now=0), 4)
+        idle = {'cpu_usage_percentage': [6.0] * 4}
+        self.assertEqual(decider.decide(idle, 4, now=299), 4)
+        # past the cooldown, but the scale-up recommendation still sits in the window
+        self.assertEqual(decider.decide(idle, 4, now=300), 4)
+        self.assertEqual(decider.decide(idle, 4, now=601), 1)
+
+if __name__ == '__main__':
+    unittest.main()
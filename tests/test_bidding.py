@@ -0,0 +1,105 @@
+import os
+import time
+import unittest
+from unittest import mock
+
+import support  # noqa: F401  (path and region setup)
+
+import boto3
+from botocore.stub import ANY, Stubber
+
+from bidding import DEFAULT_BID, BidPlanner, SpotPriceHistory
+
+def stubbed_ec2(pages):
+    # a real EC2 client whose describe_spot_price_history answers with recorded pages, in order
+    client = boto3.client('ec2', region_name='us-east-1')
+    stubber = Stubber(client)
+    for page in pages:
+        stubber.add_response('describe_spot_price_history', page,
+                             {'InstanceTypes': ['t3.micro'], 'ProductDescriptions': ['Linux/UNIX'],
+                              'StartTime': ANY, **({'NextToken': ANY} if page is not pages[0] else {})})
+    stubber.activate()
+    return client, stubber
+
+class SpotPriceHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.pages = support.fixture('spot_price_history_t3_micro.json')
+        self.history = SpotPriceHistory(ttl=300, lookback_hours=6)
+
+    def test_fetch_reads_every_page(self):
+        client, stubber = stubbed_ec2(self.pages)
+        history = self.history.get('t3.micro', client)
+        stubber.assert_no_pending_responses()
+        self.assertEqual(len(history), 10)
+        self.assertEqual({entry['az'] for entry in history}, {'us-east-1a', 'us-east-1b'})
+
+    def test_cached_within_ttl(self):
+        client, stubber = stubbed_ec2(self.pages)
+        first = self.history.get('t3.micro', client)
+        # a second call would find no stubbed response left and raise
+        self.assertIs(self.history.get('t3.micro', client), first)
+        self.assertEqual(self.history.prices('t3.micro', 'us-east-1b', client), [0.0044, 0.004, 0.0052, 0.0048])
+
+    def test_refetched_after_ttl(self):
+        client, stubber = stubbed_ec2(self.pages + self.pages)
+        self.history.get('t3.micro', client)
+        with mock.patch('bidding.time.time', return_value=time.time() + 301):
+            self.history.get('t3.micro', client)
+        stubber.assert_no_pending_responses()
+
+    def test_stale_history_kept_when_refresh_fails(self):
+        client, stubber = stubbed_ec2(self.pages)
+        stubber.add_client_error('describe_spot_price_history', 'RequestLimitExceeded')
+        first = self.history.get('t3.micro', client)
+        with mock.patch('bidding.time.time', return_value=time.time() + 301):
+            self.assertIs(self.history.get('t3.micro', client), first)
+
+    def test_regions_cached_apart(self):
+        client, stubber = stubbed_ec2(self.pages)
+        self.history.get('t3.micro', client)
+        self.history.set('t3.micro', [], region='us-west-2')
+        self.assertEqual(len(self.history.prices('t3.micro', region='us-east-1')), 10)
+        self.assertEqual(self.history.prices('t3.micro', region='us-west-2'), [])
+
+    def test_latest(self):
+        client, stubber = stubbed_ec2(self.pages)
+        self.assertIsNone(self.history.latest('t3.micro'))
+        self.history.get('t3.micro', client)
+        self.assertEqual(self.history.latest('t3.micro', 'us-east-1a'), 0.0031)
+        # without a zone, the mean of each zone's newest price
+        self.assertAlmostEqual(self.history.latest('t3.micro'), (0.0031 + 0.0044) / 2)
+
+class BidPlannerTest(unittest.TestCase):
+    def setUp(self):
+        self.history = SpotPriceHistory(ttl=300)
+        # the defaults: p90, a 10% margin and 20% steps, no cap
+        with mock.patch.dict(os.environ):
+            for name in ('SPOTTY_BID_PERCENTILE', 'SPOTTY_BID_MARGIN', 'SPOTTY_BID_STEP', 'SPOTTY_MAX_BID'):
+                os.environ.pop(name, None)
+            self.planner = BidPlanner(self.history)
+        client, _ = stubbed_ec2(support.fixture('spot_price_history_t3_micro.json'))
+        self.history.get('t3.micro', client)
+
+    def test_opening_bid_per_az(self):
+        # p90 of each zone's recent prices plus a 10% margin
+        self.assertEqual(self.planner.opening_bid('t3.micro', 'us-east-1a'), 0.004)
+        self.assertEqual(self.planner.opening_bid('t3.micro', 'us-east-1b'), 0.0057)
+        self.assertEqual(self.planner.opening_bid('t3.micro'), 0.0053)
+
+    def test_opening_bid_capped(self):
+        self.planner.max_bid = 0.0045
+        self.assertEqual(self.planner.opening_bid('t3.micro', 'us-east-1b'), 0.0045)
+
+    def test_next_bid_jumps_past_recent_prices(self):
+        self.assertEqual(self.planner.next_bid(0.003, 't3.micro', 'us-east-1b'), 0.0062)
+        self.assertEqual(self.planner.next_bid(0.004, 't3.micro', 'us-east-1a'), 0.005)
+
+    def test_empty_history(self):
+        self.history.set('t2.micro', [])
+        self.assertEqual(self.planner.opening_bid('t2.micro'), DEFAULT_BID)
+        self.assertEqual(self.planner.next_bid(DEFAULT_BID, 't2.micro'), 0.006)
+        # a zone the history has nothing for bids blind too
+        self.assertEqual(self.planner.opening_bid('t3.micro', 'us-east-1f'), DEFAULT_BID)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import support  # noqa: F401  (path and region setup)
+
+from cost_ledger import HOUR, TOTAL, CostLedger
+from cost_watcher import CostWatcher
+from state_backends import JsonStateBackend, SqliteStateBackend, empty_state
+from state_manager import StateManager
+
+T0 = 1_700_000_000 // HOUR * HOUR  # on the hour
+
+class LedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.costs = {}
+        self.ledger = CostLedger(self.costs, retention_hours=48)
+
+    def launch(self, price: float, at: float, app_name: str = 'web') -> dict:
+        instance = {'id': 'i-1', 'spot_price': price, 'time_now': at}
+        self.ledger.open(app_name, instance, price, at)
+        return instance
+
+    def test_spread_splits_at_the_hour(self):
+        self.ledger.spread('web', 2.0, T0 + 1800, T0 + 2 * HOUR + 900)
+        hours = self.ledger.accounts['web']['hours']
+        self.assertEqual(hours[T0], [1.0, T0 + 1800, T0 + HOUR])
+        self.assertEqual(hours[T0 + HOUR], [2.0, T0 + HOUR, T0 + 2 * HOUR])
+        self.assertEqual(hours[T0 + 2 * HOUR], [0.5, T0 + 2 * HOUR, T0 + 2 * HOUR + 900])
+        self.assertAlmostEqual(self.ledger.accounts['web']['settled'], 3.5)
+        self.assertEqual(self.ledger.flush(), [('web', T0), ('web', T0 + HOUR), ('web', T0 + 2 * HOUR)])
+
+    def test_settle_books_the_rate(self):
+        self.ledger.adjust('web', 1.0, T0)
+        self.ledger.settle('web', T0 + 5400)
+        self.assertAlmostEqual(self.ledger.accounts['web']['settled'], 1.5)
+        self.assertEqual(self.ledger.accounts['web']['settled_at'], T0 + 5400)
+        # settling at or before settled_at books nothing
+        self.ledger.settle('web', T0)
+        self.assertAlmostEqual(self.ledger.accounts['web']['settled'], 1.5)
+
+    def test_settle_prunes_past_retention(self):
+        self.ledger.adjust('web', 1.0, T0)
+        self.ledger.settle('web', T0 + 80 * HOUR)
+        hours = self.ledger.accounts['web']['hours']
+        self.assertEqual(min(hours), self.ledger.cutoff(T0 + 80 * HOUR))
+        self.assertEqual(len(hours), 48)
+        # pruned buckets leave the running total alone
+        self.assertAlmostEqual(self.ledger.spend('web', T0 + 80 * HOUR), 80.0)
+
+    def test_window_of_an_instance_opened_mid_hour(self):
+        start = T0 + 1800
+        instance = self.launch(1.0, start)
+        self.ledger.close('web', instance, start + HOUR)
+        self.assertAlmostEqual(self.ledger.window('web', start, start + 1800, at=start + 2 * HOUR), 0.5)
+        self.assertAlmostEqual(self.ledger.window('web', start + 1800, start + HOUR, at=start + 2 * HOUR), 0.5)
+        self.assertAlmostEqual(self.ledger.window('web', T0, start, at=start + 2 * HOUR), 0.0)
+
+    def test_window_matches_close_across_a_reprice(self):
+        start = T0 + 1200
+        instance = self.launch(1.0, start)
+        self.ledger.reprice('web', instance, 2.0, start + HOUR)
+        cost = self.ledger.close('web', instance, start + 2 * HOUR)
+        self.assertAlmostEqual(cost, 3.0)
+        self.assertAlmostEqual(self.ledger.spend('web', start + 3 * HOUR), 3.0)
+        self.assertAlmostEqual(self.ledger.window('web', start, start + 2 * HOUR, at=start + 3 * HOUR), 3.0)
+        self.assertAlmostEqual(self.ledger.window('web', start, T0 + HOUR, at=start + 3 * HOUR), 2 / 3)
+
+    def test_window_includes_the_unsettled_rate(self):
+        self.launch(1.0, T0 + 600)
+        self.assertAlmostEqual(self.ledger.window('web', T0, T0 + 2 * HOUR, at=T0 + 4200), 1.0)
+        self.assertAlmostEqual(self.ledger.window('web', T0 + 2400, T0 + 2 * HOUR, at=T0 + 4200), 0.5)
+
+    def test_hourly(self):
+        start = T0 + 1800
+        instance = self.launch(1.0, start)
+        self.ledger.reprice('web', instance, 3.0, T0 + HOUR)
+        self.ledger.close('web', instance, T0 + HOUR + 1200)
+        hourly = self.ledger.hourly('web', T0, T0 + 2 * HOUR, at=T0 + 3 * HOUR)
+        self.assertEqual([hour for hour, _ in hourly], [T0, T0 + HOUR])
+        self.assertAlmostEqual(hourly[0][1], 0.5)
+        self.assertAlmostEqual(hourly[1][1], 1.0)
+
+    def test_reprice_accrues_the_old_segment(self):
+        instance = self.launch(1.0, T0)
+        self.ledger.reprice('web', instance, 0.5, T0 + 1800)
+        self.assertAlmostEqual(instance['accrued_cost'], 0.5)
+        self.assertEqual(instance['priced_at'], T0 + 1800)
+        self.assertAlmostEqual(self.ledger.rate('web'), 0.5)
+        self.assertAlmostEqual(self.ledger.rate(TOTAL), 0.5)
+        self.assertAlmostEqual(self.ledger.spend('web', T0 + HOUR), 0.75)
+
+    def test_charge_is_a_lump_sum(self):
+        self.ledger.charge(None, 2.0, T0 + 1800)
+        self.ledger.charge('web', 1.0, T0 + 1800)
+        self.assertNotIn(None, self.ledger.accounts)
+        self.assertAlmostEqual(self.ledger.spend(TOTAL, T0 + HOUR), 3.0)
+        self.assertAlmostEqual(self.ledger.window('web', T0, T0 + 1800, at=T0 + HOUR), 0.0)
+        self.assertAlmostEqual(self.ledger.window('web', T0 + 1800, T0 + HOUR, at=T0 + HOUR), 1.0)
+
+    def test_buckets_from_before_billed_spans(self):
+        ledger = CostLedger({'accounts': {'web': {'settled': 1.0, 'settled_at': T0 + HOUR, 'hours': {str(T0): 1.0}}}})
+        self.assertEqual(ledger.accounts['web']['hours'][T0], [1.0, T0, T0 + HOUR])
+        self.assertAlmostEqual(ledger.window('web', T0, T0 + 1800, at=T0 + HOUR), 0.5)
+
+class SqliteBucketsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 's.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_billed_spans_round_trip(self):
+        backend = SqliteStateBackend(self.filename)
+        state = empty_state()
+        ledger = CostLedger(state['costs'])
+        ledger.spread('web', 1.0, T0 + 1800, T0 + HOUR)
+        with backend.transaction():
+            backend.save_costs(state['costs'], ledger.flush(), ledger.cutoff(T0))
+        loaded = CostLedger(SqliteStateBackend(self.filename).load()['costs'])
+        self.assertEqual(loaded.accounts['web']['hours'][T0], [0.5, T0 + 1800, T0 + HOUR])
+
+    def test_store_from_before_billed_spans(self):
+        conn = sqlite3.connect(self.filename)
+        conn.executescript(SqliteStateBackend.SCHEMA.replace('billed_from REAL,', '').replace('billed_to REAL,', ''))
+        conn.execute('INSERT INTO cost_hours VALUES (?, ?, ?)', ('web', T0, 1.0))
+        conn.execute("INSERT INTO meta VALUES ('cost_accounts', ?)",
+                     ('{"web": {"settled": 1.0, "settled_at": %d, "rate": 0.0}}' % (T0 + HOUR),))
+        conn.commit()
+        conn.close()
+        for read_only in (True, False):
+            ledger = CostLedger(SqliteStateBackend(self.filename, read_only=read_only).load()['costs'])
+            self.assertEqual(ledger.accounts['web']['hours'][T0], [1.0, T0, T0 + HOUR])
+
+class PriceCache:
+    # a price history that only knows the prices it was asked to fetch
+    def __init__(self, prices):
+        self.prices = prices
+        self.cached = set()
+
+    def get(self, instance_type, region=None):
+        self.cached.add((instance_type, region))
+
+    def price(self, instance_type, az, region):
+        return self.prices[instance_type] if (instance_type, region) in self.cached else None
+
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.prices = PriceCache({'t3.micro': 0.003, 't3a.micro': 0.002})
+        self.state_manager = StateManager(backend=JsonStateBackend(os.path.join(self.dir, 'state.json')),
+                                          price_source=self.prices.price)
+        self.state_manager.add_app('web', 'uri')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_standbys_repriced(self):
+        self.state_manager.add_instances('web', [{'id': 'i-1', 'spot_price': 0.01, 'time_now': time.time(),
+                                                  'instance_type': 't3.micro', 'region': 'us-east-1'}])
+        self.state_manager.add_standby('web', [{'id': 'i-2', 'spot_price': 0.01, 'time_now': time.time(),
+                                                'instance_type': 't3a.micro', 'region': 'us-east-1'}])
+        CostWatcher(self.state_manager, self.prices, interval=0).refresh()
+        self.assertEqual(self.prices.cached, {('t3.micro', 'us-east-1'), ('t3a.micro', 'us-east-1')})
+        self.assertAlmostEqual(self.state_manager.get_standby('web')[0]['market_price'], 0.002)
+        self.assertAlmostEqual(self.state_manager.get_instances('web')[0]['market_price'], 0.003)
+
+if __name__ == '__main__':
+    unittest.main()
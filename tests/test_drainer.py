@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import support  # noqa: F401  (path and region setup)
+
+import fake_aws
+from drainer import Drainer
+from fake_aws import FakeEC2, client_error
+from load_balancer import LoadBalancer
+from placement import PlacementEngine
+from state_backends import JsonStateBackend
+from state_manager import StateManager
+
+class RetireTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.state_manager = StateManager(backend=JsonStateBackend(os.path.join(self.dir, 'state.json')))
+        self.state_manager.add_app('web', 'uri')
+        self.ec2 = fake_aws.install(FakeEC2(delay=0))
+        self.ids = [self.ec2._launch('t3.micro', 'subnet-a', 0.01) for _ in range(3)]
+        self.state_manager.add_instances('web', [{'id': instance_id, 'ip': f"10.0.0.{n}", 'spot_price': 0.01,
+                                                  'time_now': time.time()} for n, instance_id in enumerate(self.ids)])
+        self.state_manager.set_target_replicas('web', 3)
+        self.load_balancer = LoadBalancer(self.state_manager, interval=0)
+        self.drainer = Drainer(self.state_manager, self.load_balancer, PlacementEngine(self.state_manager, interval=0),
+                               mock.Mock(), grace=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def draining(self):
+        return {backend['instance_id'] for backend in self.load_balancer.snapshot()['web'] if backend['draining']}
+
+    def test_retired(self):
+        victims = self.drainer.claim('web', 2)
+        self.assertEqual(self.state_manager.get_target_replicas('web'), 1)
+        result = self.drainer.retire('web', victims)
+        self.assertEqual(len(result['terminated_instance_ids']), 2)
+        self.assertEqual(len(self.state_manager.get_instances('web')), 1)
+        self.assertEqual(self.state_manager.get_target_replicas('web'), 1)
+        self.assertEqual(self.drainer.draining, {})
+
+    def test_refused_single_termination_kept(self):
+        victims = self.drainer.claim('web', 1)
+        self.load_balancer.drain('web', [victims[0]['id']], 0)
+        with mock.patch.object(self.ec2, 'terminate_instances',
+                               side_effect=client_error('UnauthorizedOperation', 'denied', 'TerminateInstances')):
+            result = self.drainer.retire('web', victims)
+        self.assertEqual(result['failed_instance_ids'], [victims[0]['id']])
+        # still running, so it serves and counts again
+        self.assertEqual(len(self.state_manager.get_instances('web')), 3)
+        self.assertEqual(self.state_manager.get_target_replicas('web'), 3)
+        self.assertEqual(self.draining(), set())
+
+    def test_partly_refused_batch(self):
+        victims = self.drainer.claim('web', 2)
+        refused = victims[0]['id']
+        terminate = self.ec2.terminate_instances
+
+        def refuse_one(InstanceIds):
+            if refused in InstanceIds:
+                raise client_error('IncorrectInstanceState', 'no', 'TerminateInstances')
+            return terminate(InstanceIds=InstanceIds)
+        with mock.patch.object(self.ec2, 'terminate_instances', side_effect=refuse_one):
+            result = self.drainer.retire('web', victims)
+        self.assertEqual(result['terminated_instance_ids'], [victims[1]['id']])
+        self.assertEqual(self.state_manager.get_target_replicas('web'), 2)
+        self.assertEqual(self.draining(), set())
+
+    def test_aborted_retire_restores_everything(self):
+        victims = self.drainer.claim('web', 2)
+        with mock.patch('drainer.terminate_instances', side_effect=ConnectionError('endpoint unreachable')):
+            with self.assertRaises(ConnectionError):
+                self.drainer.retire('web', victims, grace=0.01)
+        self.assertEqual(self.state_manager.get_target_replicas('web'), 3)
+        self.assertEqual(self.draining(), set())
+        self.assertEqual(self.drainer.draining, {})
+
+if __name__ == '__main__':
+    unittest.main()
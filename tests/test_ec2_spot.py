@@ -0,0 +1,157 @@
+import asyncio
+import functools
+import os
+import unittest
+from unittest import mock
+
+import support  # noqa: F401  (path and region setup)
+
+for name, value in {'TF_AMI_ID': 'ami-test', 'TF_SECURITY_GROUP_ID': 'sg-test', 'TF_INSTANCE_PROFILE_NAME': 'test-profile',
+                    'TF_INSTANCE_TYPES': 't3.micro,t3a.micro', 'TF_SUBNET_IDS': 'subnet-a,subnet-b'}.items():
+    os.environ.setdefault(name, value)
+
+import ec2_spot
+import ec2_spot_async
+import fake_aws
+from fake_aws import FakeEC2, client_error
+from launch_templates import launch_template_manager
+from pool_selector import pool_selector
+
+# fields that differ from one launch to the next whichever path made it
+VOLATILE = ('id', 'ip', 'time_now', 'provisioning', 'trace')
+
+def launch_sync(names):
+    pool_selector.stats.clear()  # so both paths rank the pools alike
+    return ec2_spot.create_instances('uri', names, {'KEY': 'value'}, app_name='web')
+
+def launch_async(names):
+    pool_selector.stats.clear()
+    return asyncio.run(ec2_spot_async.create_instances('uri', names, {'KEY': 'value'}, app_name='web'))
+
+class LaunchPathsTest(unittest.TestCase):
+    # the sync and async launch paths run the same SpotLaunch bookkeeping against the fake EC2
+    def setUp(self):
+        self.ec2 = FakeEC2(delay=0, price_volatility=0)
+        fake_aws.install(self.ec2)
+        fake_aws.install_async(self.ec2)
+        launch_template_manager.templates.clear()
+        for patcher in (mock.patch.dict(os.environ, {'SPOTTY_ASYNC_POLL_INTERVAL': '0', 'SPOTTY_LAUNCH_TEMPLATES': ''}),
+                        # requests the fake will never fulfil would otherwise be polled for 30s each
+                        mock.patch.object(ec2_spot_async, 'wait_fulfilled',
+                                          functools.partial(ec2_spot_async.wait_fulfilled, timeout=0)),
+                        mock.patch.object(ec2_spot, 'get_instance_public_ips',
+                                          functools.partial(ec2_spot.get_instance_public_ips, max_retries=2, delay=0))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def stable(self, instances):
+        return [{k: v for k, v in instance.items() if k not in VOLATILE} for instance in instances]
+
+    def assert_same_launch(self):
+        names = ['web-1', 'web-2', 'web-3']
+        sync, async_ = launch_sync(names), launch_async(names)
+        self.assertEqual(len(sync), 3)
+        self.assertEqual(self.stable(sync), self.stable(async_))
+        for instance in sync + async_:
+            self.assertTrue(instance['ip'])
+            self.assertEqual(instance['provisioning']['attempts'], 1)
+        return sync
+
+    def test_spot_requests(self):
+        instances = self.assert_same_launch()
+        self.assertEqual(instances[0]['region'], 'us-east-1')
+        self.assertEqual(instances[0]['boot_mode'], 'standard')
+        self.assertEqual(self.ec2.calls['request_spot_instances'], 2)
+
+    def test_launch_templates(self):
+        os.environ['SPOTTY_LAUNCH_TEMPLATES'] = '1'
+        self.assert_same_launch()
+        self.assertEqual(self.ec2.calls['run_instances'], 2)
+        self.assertEqual(self.ec2.calls['request_spot_instances'], 0)
+
+    def test_no_capacity_spends_every_attempt(self):
+        self.ec2.capacity_error_rate = 1.0
+        for launch in (launch_sync, launch_async):
+            self.assertEqual(launch(['web-1']), [])
+        self.assertEqual(self.ec2.calls['request_spot_instances'], 2 * ec2_spot.SpotLaunch.max_attempts)
+
+    def test_quota_limit_stops_at_once(self):
+        def refuse(**kwargs):
+            self.ec2.calls['request_spot_instances'] += 1
+            raise client_error('MaxSpotInstanceCountExceeded', 'limit', 'RequestSpotInstances')
+        self.ec2.request_spot_instances = refuse
+        for launch in (launch_sync, launch_async):
+            self.assertEqual(launch(['web-1']), [])
+        self.assertEqual(self.ec2.calls['request_spot_instances'], 2)
+
+    def test_untagged_instances_kept(self):
+        with mock.patch.object(self.ec2, 'create_tags',
+                               side_effect=client_error('InvalidInstanceID.NotFound', 'not yet', 'CreateTags')):
+            self.assert_same_launch()
+
+    def test_ips_once_described(self):
+        describe = self.ec2.describe_instances
+        calls = []
+
+        def not_found_at_first(**kwargs):
+            # EC2 is eventually consistent, so a fresh instance can be unknown to describe_instances
+            calls.append(kwargs)
+            if len(calls) % 2:
+                raise client_error('InvalidInstanceID.NotFound', 'not yet', 'DescribeInstances')
+            return describe(**kwargs)
+        with mock.patch.object(self.ec2, 'describe_instances', side_effect=not_found_at_first):
+            self.assert_same_launch()
+
+    def test_instances_kept_without_ips(self):
+        with mock.patch.object(self.ec2, 'describe_instances',
+                               side_effect=client_error('InvalidInstanceID.NotFound', 'gone', 'DescribeInstances')):
+            for launch in (launch_sync, launch_async):
+                instances = launch(['web-1', 'web-2'])
+                self.assertEqual(len(instances), 2)
+                self.assertEqual([instance['ip'] for instance in instances], [None, None])
+        self.assertFalse([i for i in self.ec2.instances.values() if i['State']['Name'] != 'running'])
+
+    def test_failed_launch_terminates_what_it_got(self):
+        with mock.patch.object(ec2_spot, 'build_instances', side_effect=RuntimeError('boom')), \
+                mock.patch.object(ec2_spot_async, 'build_instances', side_effect=RuntimeError('boom')):
+            for launch in (launch_sync, launch_async):
+                self.assertEqual(launch(['web-1', 'web-2']), [])
+        self.assertEqual(len(self.ec2.instances), 4)
+        self.assertEqual({i['State']['Name'] for i in self.ec2.instances.values()}, {'terminated'})
+
+class SpotLaunchTest(unittest.TestCase):
+    def setUp(self):
+        self.cursor = mock.Mock(pool=mock.Mock(region=None, instance_type='t3.micro', az='us-east-1a'), price=0.004)
+        self.launch = ec2_spot.SpotLaunch(['web-1', 'web-2'], self.cursor)
+
+    def test_attempts(self):
+        self.assertEqual(self.launch.next_attempt(), (self.cursor.pool, 0.004, 2))
+        self.launch.record_fulfilled(['i-1'], 0.004, self.cursor.pool, requested_at=0)
+        self.assertEqual(self.launch.next_attempt()[2], 1)
+        self.launch.record_fulfilled(['i-2'], 0.004, self.cursor.pool, requested_at=0)
+        self.assertIsNone(self.launch.next_attempt())
+        self.assertEqual(self.launch.result()[1], 2)
+
+    def test_attempts_run_out(self):
+        while self.launch.next_attempt():
+            pass
+        self.assertEqual(self.launch.requests_made, ec2_spot.SpotLaunch.max_attempts)
+
+    def test_moves(self):
+        pool = self.cursor.pool
+        self.assertIs(self.launch.client_error(client_error('InsufficientInstanceCapacity', '', 'Run'), pool),
+                      self.cursor.fail_over)
+        self.assertIs(self.launch.client_error(client_error('SpotMaxPriceTooLow', '', 'Run'), pool),
+                      self.cursor.escalate)
+        self.assertIsNone(self.launch.client_error(client_error('InstanceLimitExceeded', '', 'Run'), pool))
+        self.assertIs(self.launch.unfulfilled([{'Status': {'Code': 'capacity-not-available'}}]), self.cursor.fail_over)
+        self.assertIs(self.launch.unfulfilled([{'Status': {'Code': 'price-too-low'}}]), self.cursor.escalate)
+
+    def test_split_requests(self):
+        instance_ids, unfulfilled = ec2_spot.split_requests([{'SpotInstanceRequestId': 'sir-1', 'InstanceId': 'i-1'},
+                                                             {'SpotInstanceRequestId': 'sir-2'}])
+        self.assertEqual(instance_ids, ['i-1'])
+        self.assertEqual(unfulfilled, [{'SpotInstanceRequestId': 'sir-2'}])
+
+if __name__ == '__main__':
+    unittest.main()
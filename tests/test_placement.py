@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import support  # noqa: F401  (path and region setup)
+
+from placement import HOST_PORT_RANGE, PlacementEngine
+from state_backends import JsonStateBackend
+from state_manager import StateManager
+
+class PackTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.state_manager = StateManager(backend=JsonStateBackend(os.path.join(self.dir, 'state.json')))
+        self.state_manager.add_app('web', 'https://repo/web:1')
+        self.state_manager.add_host({'id': 'i-host', 'ip': '10.0.0.1', 'spot_price': 0.04, 'time_now': time.time(),
+                                     'instance_type': 't3.large', 'capacity': {'cpu': 2.0, 'memory': 7680.0},
+                                     'allocations': {}, 'attributed_cost': 0.0, 'idle_since': time.time()})
+        self.placement = PlacementEngine(self.state_manager, interval=0)
+        self.scripts = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_commands(self, instance_ids, commands, **kwargs):
+        self.scripts.append(commands)
+        return {instance_id: 'Success' for instance_id in instance_ids}
+
+    def test_two_replicas_on_one_host(self):
+        with mock.patch('placement.run_commands', side_effect=self.run_commands), \
+                mock.patch('placement.create_instances') as create_instances:
+            placed = self.placement.place('web', ['web-1', 'web-2'], {'KEY': 'value'})
+        create_instances.assert_not_called()
+
+        first, second = HOST_PORT_RANGE[0], HOST_PORT_RANGE[0] + 2
+        self.assertEqual([(r['id'], r['port'], r['stats_port']) for r in placed],
+                         [(f"i-host:{first}", first, first + 1), (f"i-host:{second}", second, second + 1)])
+        self.assertEqual({r['host_id'] for r in placed}, {'i-host'})
+        self.assertAlmostEqual(placed[0]['spot_price'], 0.04 * 0.25 / 2)
+
+        host = self.state_manager.get_hosts()['i-host']
+        self.assertEqual(host['allocations'], {
+            f"i-host:{first}": {'app_name': 'web', 'name': 'web-1', 'port': first, 'cpu': 0.25, 'memory': 256},
+            f"i-host:{second}": {'app_name': 'web', 'name': 'web-2', 'port': second, 'cpu': 0.25, 'memory': 256}})
+        self.assertNotIn('idle_since', host)
+
+        # one script per host: a single preamble and pull, then each replica's containers
+        self.assertEqual(len(self.scripts), 1)
+        commands = self.scripts[0]
+        self.assertEqual(commands[0], 'set -e')
+        self.assertEqual(sum(c.startswith('ECR_URI=') for c in commands), 1)
+        self.assertEqual(sum(c.startswith('docker pull') for c in commands), 1)
+        self.assertIn('docker rm -f web-2-monitor web-2 || true', commands)
+        runs = [c for c in commands if c.startswith('docker run -d --name web-') and ' -p ' in c]
+        self.assertEqual(len(runs), 2)
+        self.assertTrue(runs[0].startswith(f"docker run -d --name web-1 -p {first}:80 -p {first + 1}:3928 "
+                                           f"--cpus 0.25 --memory 256m -e KEY=\"value\""))
+        self.assertTrue(runs[1].startswith(f"docker run -d --name web-2 -p {second}:80 -p {second + 1}:3928 "))
+
+    def test_failed_start_releases_the_allocations(self):
+        with mock.patch('placement.run_commands', return_value={'i-host': 'Failed'}):
+            self.assertEqual(self.placement.place('web', ['web-1', 'web-2'], {}), [])
+        host = self.state_manager.get_hosts()['i-host']
+        self.assertEqual(host['allocations'], {})
+        self.assertIn('idle_since', host)
+
+if __name__ == '__main__':
+    unittest.main()
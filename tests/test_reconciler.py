@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import support  # noqa: F401  (path and region setup)
+
+import fake_aws
+from fake_aws import FakeEC2
+from jobs import JobQueue
+from reconciler import Reconciler
+from state_backends import JsonStateBackend
+from state_manager import StateManager
+
+HOUR = 3600
+
+class ReconcilerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.state_manager = StateManager(backend=JsonStateBackend(os.path.join(self.dir, 'state.json')))
+        self.state_manager.add_app('web', 'uri')
+        self.state_manager.adjust_target_replicas('web', 0)
+        self.ec2 = fake_aws.install(FakeEC2(delay=0, price_volatility=0))
+        self.job_queue = JobQueue(max_workers=1)
+        self.launched = []
+        self.stats_fetcher = mock.Mock()
+        self.stats_fetcher.fetch_many.return_value = {}
+        self.reconciler = Reconciler(self.state_manager, self.job_queue,
+                                     lambda app_name, count: self.launched.append((app_name, count)),
+                                     stats_fetcher=self.stats_fetcher, ec2_client=self.ec2, interval=0)
+
+    def tearDown(self):
+        self.job_queue.executor.shutdown()
+        shutil.rmtree(self.dir)
+
+    def launch(self, age: float = HOUR, spot_price: float = 0.01) -> dict:
+        # a fulfilled spot request in the fake, tracked in state as if it was launched age seconds ago
+        request_id = self.ec2.request_spot_instances(
+            SpotPrice=str(spot_price), InstanceCount=1,
+            LaunchSpecification={'InstanceType': 't3.micro'})['SpotInstanceRequests'][0]['SpotInstanceRequestId']
+        response = self.ec2.describe_spot_instance_requests(SpotInstanceRequestIds=[request_id])
+        instance = {'id': response['SpotInstanceRequests'][0]['InstanceId'], 'spot_request_id': request_id,
+                    'instance_type': 't3.micro', 'spot_price': spot_price, 'time_now': time.time() - age}
+        self.state_manager.add_instance('web', instance)
+        self.state_manager.adjust_target_replicas('web', 1)
+        return instance
+
+    def ids(self):
+        return [instance['id'] for instance in self.state_manager.get_instances('web')]
+
+    def test_running_instances_left_alone(self):
+        self.launch()
+        self.launch()
+        self.reconciler.reconcile()
+        self.assertEqual(len(self.ids()), 2)
+        self.assertEqual(self.launched, [])
+
+    def test_gone_instance_closed_out_and_replaced(self):
+        kept, gone = self.launch(), self.launch()
+        self.ec2.terminate_instances(InstanceIds=[gone['id']])
+        self.reconciler.reconcile()
+        self.assertEqual(self.ids(), [kept['id']])
+        self.stats_fetcher.forget.assert_called_once_with(gone['id'])
+        self.assertEqual(self.launched, [('web', 1)])
+
+    def test_missing_instance_waits_out_the_launch_grace(self):
+        # describe calls are eventually consistent, so a fresh launch EC2 doesn't know yet is kept
+        self.state_manager.add_instance('web', {'id': 'i-fresh', 'spot_price': 0.01, 'time_now': time.time()})
+        self.state_manager.add_instance('web', {'id': 'i-lost', 'spot_price': 0.01, 'time_now': time.time() - HOUR})
+        self.reconciler.reconcile()
+        self.assertEqual(self.ids(), ['i-fresh'])
+
+    def test_cost_closed_out(self):
+        # with no price source an instance bills at its bid: two hours at $0.01
+        gone = self.launch(age=2 * HOUR, spot_price=0.01)
+        self.ec2.terminate_instances(InstanceIds=[gone['id']])
+        self.reconciler.reconcile()
+        self.assertAlmostEqual(self.state_manager.get_total_cost(), 0.02, places=5)
+        self.assertAlmostEqual(self.state_manager.get_spend('web'), 0.02, places=5)
+        self.assertEqual(self.state_manager.get_cost_rate('web'), 0.0)
+
+    def test_interruption_replaced_early(self):
+        instance = self.launch()
+        self.ec2.spot_requests[instance['spot_request_id']]['code'] = 'marked-for-termination'
+        self.reconciler.reconcile()
+        # still running out its two minutes, but no longer counted towards the target
+        tracked = self.state_manager.get_instances('web')[0]
+        self.assertTrue(tracked['interrupted'])
+        self.assertEqual(self.launched, [('web', 1)])
+
+    def test_interruption_notice_from_the_instance(self):
+        instance = self.launch()
+        self.stats_fetcher.fetch_many.return_value = {instance['id']: {'spot_interruption': True}}
+        self.reconciler.reconcile()
+        self.assertTrue(self.state_manager.get_instances('web')[0]['interrupted'])
+        self.assertEqual(self.launched, [('web', 1)])
+
+    def test_deficit_filled_up_to_target(self):
+        self.launch()
+        self.state_manager.adjust_target_replicas('web', 3)
+        self.reconciler.reconcile()
+        self.assertEqual(self.launched, [('web', 3)])
+
+    def test_deficit_counts_pending_jobs(self):
+        self.launch()
+        self.state_manager.adjust_target_replicas('web', 3)
+        self.job_queue.create('web', 2, 'replacement')
+        self.reconciler.reconcile()
+        self.assertEqual(self.launched, [('web', 1)])
+
+    def test_surplus_not_touched(self):
+        self.launch()
+        self.launch()
+        self.state_manager.adjust_target_replicas('web', -1)
+        self.reconciler.reconcile()
+        self.assertEqual(len(self.ids()), 2)
+        self.assertEqual(self.launched, [])
+
+    def test_backs_off_after_a_failed_replacement(self):
+        self.state_manager.adjust_target_replicas('web', 2)
+        job_id = self.job_queue.create('web', 2, 'replacement')
+        self.job_queue.fail(job_id, RuntimeError('no capacity'))
+        self.reconciler.reconcile()
+        self.assertEqual(self.launched, [])
+        with mock.patch('reconciler.time.time', return_value=time.time() + self.reconciler.backoff + 1):
+            self.reconciler.reconcile()
+        self.assertEqual(self.launched, [('web', 2)])
+
+    def test_target_pinned_for_apps_without_one(self):
+        self.state_manager.add_app('api', 'uri')
+        self.state_manager.add_instance('api', {'id': 'i-old', 'spot_price': 0.01, 'time_now': time.time()})
+        self.assertNotIn('target_replicas', self.state_manager.get_app('api'))
+        self.reconciler.reconcile()
+        self.assertEqual(self.state_manager.get_app('api')['target_replicas'], 1)
+        self.assertEqual(self.launched, [])
+
+if __name__ == '__main__':
+    unittest.main()
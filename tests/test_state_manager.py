@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import support  # noqa: F401  (path and region setup)
+
+from state_backends import JsonStateBackend, SqliteStateBackend
+from state_manager import StateManager
+
+class SharedSqliteTest(unittest.TestCase):
+    # two workers, each with its own connection to one database
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 's.db')
+        self.first = StateManager(backend=SqliteStateBackend(self.filename))
+        self.first.add_app('web', 'uri')
+        self.second = StateManager(backend=SqliteStateBackend(self.filename))
+
+    def tearDown(self):
+        for manager in (self.first, self.second):
+            manager.backend.conn.close()
+        shutil.rmtree(self.dir)
+
+    def test_names_never_shared(self):
+        self.assertEqual(self.first.reserve_instance_names('web', 2), ['web-1', 'web-2'])
+        self.assertEqual(self.second.reserve_instance_names('web', 2), ['web-3', 'web-4'])
+        self.assertEqual(self.first.reserve_instance_name('web'), 'web-5')
+
+    def test_target_adjustments_add_up(self):
+        self.first.adjust_target_replicas('web', 3)
+        self.assertEqual(self.second.adjust_target_replicas('web', 2), 5)
+        self.first.refresh()
+        self.assertEqual(self.first.get_target_replicas('web'), 5)
+
+    def test_writes_keep_each_others_instances(self):
+        self.first.add_instance('web', {'id': 'i-1', 'spot_price': 0.01, 'time_now': time.time()})
+        self.second.add_instance('web', {'id': 'i-2', 'spot_price': 0.01, 'time_now': time.time()})
+        self.first.remove_instance('web', 'i-1')
+        self.second.refresh()
+        self.assertEqual([i['id'] for i in self.second.get_instances('web')], ['i-2'])
+
+    def test_second_writer_waits_for_the_first(self):
+        with self.first.write():
+            self.first.state['apps']['web']['target_replicas'] = 1
+            self.first.backend.save_app('web', self.first.state['apps']['web'])
+            self.second.backend.conn.execute('PRAGMA busy_timeout = 0')
+            with self.assertRaises(Exception):
+                self.second.adjust_target_replicas('web', 1)
+        self.assertEqual(self.second.adjust_target_replicas('web', 1), 2)
+
+class ReadOnlyTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 's.db')
+        # an instance from before the cost ledger, which a loading StateManager prices
+        state = {'apps': {'web': {'ecr_image_uri': 'uri', 'instance_counter': 1, 'env_vars': {}, 'instances': [
+            {'id': 'i-1', 'spot_price': 0.01, 'time_now': time.time() - 3600}]}}, 'hosts': {}, 'total_cost': 0.0,
+            'costs': {'accounts': {}}}
+        backend = SqliteStateBackend(self.filename)
+        backend.save_all(state)
+        backend.conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def contents(self):
+        with open(self.filename, 'rb') as f:
+            return f.read()
+
+    def test_never_writes(self):
+        before = self.contents()
+        manager = StateManager(backend=SqliteStateBackend(self.filename, read_only=True), read_only=True)
+        self.assertAlmostEqual(manager.get_cost_rate('web'), 0.01)
+        stored = SqliteStateBackend(self.filename, read_only=True).load()
+        self.assertNotIn('priced_at', stored['apps']['web']['instances'][0])
+        with self.assertRaises(RuntimeError):
+            manager.adjust_target_replicas('web', 1)
+        with self.assertRaises(RuntimeError):
+            manager.save_state()
+        self.assertEqual(self.contents(), before)
+
+    def test_missing_store_reads_empty(self):
+        manager = StateManager(backend=SqliteStateBackend(os.path.join(self.dir, 'none.db'), read_only=True),
+                               read_only=True)
+        self.assertEqual(manager.get_apps(), {})
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'none.db')))
+
+class FailedWriteTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_memory_rolled_back(self, manager):
+        manager.add_instance('web', {'id': 'i-1', 'spot_price': 0.01, 'time_now': time.time()})
+        with mock.patch.object(manager.backend, 'commit', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                manager.remove_instance('web', 'i-1')
+        self.assertEqual([i['id'] for i in manager.get_instances('web')], ['i-1'])
+        self.assertEqual(manager.find_instance('i-1')[0], 'web')
+
+    def test_sqlite(self):
+        manager = StateManager(backend=SqliteStateBackend(os.path.join(self.dir, 's.db')))
+        manager.add_app('web', 'uri')
+        self.check_memory_rolled_back(manager)
+
+    def test_json(self):
+        manager = StateManager(backend=JsonStateBackend(os.path.join(self.dir, 's.json')))
+        manager.add_app('web', 'uri')
+        self.check_memory_rolled_back(manager)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import threading
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+# (resolution in seconds, number of points kept); 0 means "as collected"
+DEFAULT_TIERS = [(0, 360), (60, 1440), (900, 672)]
+
+class Ring:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def append(self, t: float, value: float):
+        end = (self.start + self.size) % self.capacity
+        self.times[end] = t
+        self.values[end] = value
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def oldest(self) -> Optional[float]:
+        return self.times[self.start] if self.size else None
+
+    def points(self, since: float = 0) -> List[Tuple[float, float]]:
+        points = []
+        for i in range(self.size):
+            index = (self.start + i) % self.capacity
+            if self.times[index] >= since:
+                points.append((self.times[index], self.values[index]))
+        return points
+
+class DownsampledSeries:
+    def __init__(self, tiers=DEFAULT_TIERS):
+        self.tiers = [(resolution, Ring(capacity)) for resolution, capacity in tiers]
+        # running (bucket start, sum, count) for each coarser tier
+        self.buckets: List[Optional[List[float]]] = [None] * len(self.tiers)
+
+    def add(self, t: float, value: float):
+        for i, (resolution, ring) in enumerate(self.tiers):
+            if resolution == 0:
+                ring.append(t, value)
+                continue
+            bucket_start = t - t % resolution
+            bucket = self.buckets[i]
+            if bucket is not None and bucket[0] != bucket_start:
+                ring.append(bucket[0], bucket[1] / bucket[2])
+                bucket = None
+            if bucket is None:
+                bucket = self.buckets[i] = [bucket_start, 0.0, 0]
+            bucket[1] += value
+            bucket[2] += 1
+
+    def query(self, since: float, step: float = 0) -> List[Tuple[float, float]]:
+        # tiers that still hold everything back to `since`; a ring that hasn't wrapped holds all of it
+        covering = [(resolution, ring) for resolution, ring in self.tiers
+                    if ring.size < ring.capacity or ring.oldest() <= since] or self.tiers[-1:]
+        # the coarsest of those that is still at least as fine as the requested step
+        resolution, ring = covering[0]
+        for tier_resolution, tier_ring in covering:
+            if tier_resolution <= step:
+                resolution, ring = tier_resolution, tier_ring
+        points = ring.points(since)
+        if step <= resolution:
+            return points
+        return resample(points, step)
+
+def resample(points: List[Tuple[float, float]], step: float) -> List[Tuple[float, float]]:
+    resampled = []
+    bucket_start, total, count = None, 0.0, 0
+    for t, value in points:
+        start = t - t % step
+        if bucket_start is not None and start != bucket_start:
+            resampled.append((bucket_start, total / count))
+            total, count = 0.0, 0
+        bucket_start = start
+        total += value
+        count += 1
+    if count:
+        resampled.append((bucket_start, total / count))
+    return resampled
+
+class MetricsStore:
+    def __init__(self, tiers=DEFAULT_TIERS):
+        self.tiers = tiers
+        self.series: Dict[str, Dict[str, DownsampledSeries]] = {}
+        self.lock = threading.Lock()
+
+    def record(self, instance_id: str, t: float, sample: Dict[str, object]):
+        with self.lock:
+            series = self.series.setdefault(instance_id, {})
+            for metric, value in sample.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    if metric not in series:
+                        series[metric] = DownsampledSeries(self.tiers)
+                    series[metric].add(t, float(value))
+
+    def query(self, instance_id: str, since: float, step: float = 0,
+              metrics: Optional[List[str]] = None) -> Optional[Dict[str, List[Tuple[float, float]]]]:
+        with self.lock:
+            series = self.series.get(instance_id)
+            if series is None:
+                return None
+            return {
+                metric: s.query(since, step)
+                for metric, s in series.items()
+                if not metrics or metric in metrics
+            }
+
+    def instance_ids(self) -> List[str]:
+        with self.lock:
+            return list(self.series)
+
+    def drop(self, instance_id: str):
+        with self.lock:
+            self.series.pop(instance_id, None)
@@ -0,0 +1,66 @@
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Iterable, List, Optional
+from bidding import percentile
+from telemetry import provisioning_phase_seconds
+
+# instance-side phases in boot order; each one's duration is measured from the previous phase present
+BOOT_PHASES = ['launched', 'user_data_started', 'docker_installed', 'ecr_login',
+               'image_pulled', 'containers_started', 'healthy']
+
+class Trace:
+    def __init__(self):
+        self.started = time.time()
+        self.spans: List[Dict[str, Any]] = []
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            self.spans.append({'name': name, 'start': start, 'duration': round(duration, 3), **attrs})
+            provisioning_phase_seconds.labels(name).observe(duration)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'started': self.started, 'spans': list(self.spans)}
+
+def span(trace: Optional[Trace], name: str, **attrs):
+    return trace.span(name, **attrs) if trace else nullcontext()
+
+def phase_durations(trace: Dict[str, Any]) -> Dict[str, float]:
+    durations: Dict[str, float] = {}
+    for s in trace.get('spans', []):
+        durations[s['name']] = durations.get(s['name'], 0.0) + s['duration']
+    timestamps = {**trace.get('boot', {}), 'launched': trace.get('launched'), 'healthy': trace.get('healthy_at')}
+    previous = None
+    for phase in BOOT_PHASES:
+        if timestamps.get(phase) is None:
+            continue
+        if previous is not None:
+            durations[phase] = round(timestamps[phase] - timestamps[previous], 3)
+        previous = phase
+    if trace.get('healthy_at') and trace.get('started'):
+        durations['total'] = round(trace['healthy_at'] - trace['started'], 3)
+    return durations
+
+def observe_boot(trace: Dict[str, Any]):
+    # control-plane spans are observed as they end; the instance-side phases only once the boot is complete
+    durations = phase_durations({k: v for k, v in trace.items() if k != 'spans'})
+    for phase, duration in durations.items():
+        provisioning_phase_seconds.labels(phase).observe(duration)
+
+def summarize(traces: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    samples: Dict[str, List[float]] = {}
+    for trace in traces:
+        for phase, duration in phase_durations(trace).items():
+            samples.setdefault(phase, []).append(duration)
+    return {
+        phase: {
+            'count': len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95)
+        }
+        for phase, values in samples.items()
+    }
@@ -0,0 +1,158 @@
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from aws_clients import get_client
+from bidding import percentile
+from ec2_spot import create_instances, start_containers_script, terminate_instance
+from logging_config import logger
+from reconciler import GONE_STATES, describe_instances
+from ssm_commands import run_commands
+from state_manager import StateManager
+
+class WarmPool:
+    def __init__(self, state_manager: StateManager, interval: Optional[float] = None):
+        self.state_manager = state_manager
+        self.interval = interval if interval is not None else float(os.environ.get('SPOTTY_WARM_POOL_INTERVAL', 30))
+        self.assign_timeout = float(os.environ.get('SPOTTY_WARM_POOL_ASSIGN_TIMEOUT', 120))
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='warm-pool')
+        self.refilling: Dict[str, int] = {}  # app name -> standby instances being launched
+        self.stats: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='warm-pool', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.maintain()
+            except Exception as e:
+                logger.exception(f"Error maintaining warm pools: {str(e)}")
+
+    def maintain(self):
+        apps = self.state_manager.get_apps()
+        standby = {instance['id']: app_name for app_name in apps for instance in self.state_manager.get_standby(app_name)}
+        if standby:
+            observed = describe_instances(get_client('ec2'), list(standby))
+            for app_name in set(standby.values()):
+                for instance in self.state_manager.get_standby(app_name):
+                    status = observed.get(instance['id'])
+                    if time.time() - instance['time_now'] < 120 and status is None:
+                        continue  # describe calls are eventually consistent for fresh launches
+                    if status is None or status['state'] in GONE_STATES or status['interrupted']:
+                        logger.info(f"Standby instance {instance['id']} of {app_name} was reclaimed, dropping it")
+                        self.state_manager.discard_standby(app_name, instance)
+                        if status and status['state'] not in GONE_STATES:
+                            terminate_instance(instance['id'])
+        for app_name in apps:
+            self.refill(app_name)
+
+    def _stats(self, app_name: str) -> Dict[str, Any]:
+        return self.stats.setdefault(app_name, {'hits': 0, 'misses': 0, 'assign_seconds': deque(maxlen=200)})
+
+    def refill(self, app_name: str):
+        with self.lock:
+            refilling = self.refilling.get(app_name, 0)
+            deficit = self.state_manager.get_warm_pool_size(app_name) - len(self.state_manager.get_standby(app_name)) - refilling
+            if deficit <= 0:
+                return
+            self.refilling[app_name] = refilling + deficit
+        logger.info(f"Refilling the warm pool of {app_name} with {deficit} standby instance(s)")
+        self.executor.submit(self._launch, app_name, deficit)
+
+    def _launch(self, app_name: str, count: int):
+        try:
+            ecr_image_uri = self.state_manager.get_ecr_image_uri(app_name)
+            names = [f"{app_name}-standby-{uuid.uuid4().hex[:6]}" for _ in range(count)]
+            # standbys stay in the home region, where the pool is watched and assigned from
+            launch_spec = {k: v for k, v in (self.state_manager.get_launch_spec(app_name) or {}).items() if k != 'regions'}
+            instances = create_instances(ecr_image_uri, names, {}, app_name=app_name,
+                                         launch_spec=launch_spec, standby=True)
+            if instances and not self.state_manager.add_standby(app_name, instances):
+                for instance in instances:
+                    terminate_instance(instance['id'])
+        except Exception as e:
+            logger.exception(f"Error refilling the warm pool of {app_name}: {str(e)}")
+        finally:
+            with self.lock:
+                self.refilling[app_name] -= count
+
+    def assign(self, app_name: str, instance_names: List[str], env_vars: Dict[str, str]) -> List[Dict[str, Any]]:
+        # hands out standby instances for the first names; the caller cold-launches the rest
+        if not self.state_manager.get_warm_pool_size(app_name) and not self.state_manager.get_standby(app_name):
+            return []
+        started = time.time()
+        standby = self.state_manager.take_standby(app_name, len(instance_names))
+        assigned = []
+        if standby:
+            ecr_image_uri = self.state_manager.get_ecr_image_uri(app_name)
+            by_image: Dict[str, List[Dict[str, Any]]] = {}
+            for instance in standby:
+                by_image.setdefault(instance.get('ecr_image_uri'), []).append(instance)
+            statuses = {}
+            for image, instances in by_image.items():
+                try:
+                    statuses.update(run_commands([i['id'] for i in instances],
+                                                 start_containers_script(ecr_image_uri, env_vars, pull=image != ecr_image_uri),
+                                                 timeout=self.assign_timeout, comment=f"spotty assign {app_name}"))
+                except Exception as e:
+                    logger.error(f"Error starting containers on standby instances of {app_name}: {str(e)}")
+            ec2_client = get_client('ec2')
+            names = iter(instance_names)
+            for instance in standby:
+                if statuses.get(instance['id']) != 'Success':
+                    self.state_manager.discard_standby(app_name, instance)
+                    terminate_instance(instance['id'])
+                    continue
+                name = next(names)
+                ec2_client.create_tags(Resources=[instance['id']], Tags=[{'Key': 'Name', 'Value': name}])
+                seconds = round(time.time() - started, 2)
+                assigned.append({
+                    **{k: v for k, v in instance.items() if k != 'trace'},
+                    'name': name,
+                    'ecr_image_uri': ecr_image_uri,
+                    'provisioning': {'attempts': 0, 'seconds': seconds},
+                    'boot_mode': 'warm'
+                })
+
+        with self.lock:
+            stats = self._stats(app_name)
+            stats['hits'] += len(assigned)
+            stats['misses'] += len(instance_names) - len(assigned)
+            if assigned:
+                stats['assign_seconds'].append(time.time() - started)
+        self.refill(app_name)
+        return assigned
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        apps = self.state_manager.get_apps()
+        with self.lock:
+            summary = {}
+            for app_name in apps:
+                stats = self._stats(app_name)
+                latencies = list(stats['assign_seconds'])
+                summary[app_name] = {
+                    'size': self.state_manager.get_warm_pool_size(app_name),
+                    'ready': len(self.state_manager.get_standby(app_name)),
+                    'refilling': self.refilling.get(app_name, 0),
+                    'hits': stats['hits'],
+                    'misses': stats['misses'],
+                    'assign_seconds': {
+                        'count': len(latencies),
+                        'p50': percentile(latencies, 50) if latencies else None,
+                        'p95': percentile(latencies, 95) if latencies else None
+                    }
+                }
+            return summary